@@ -0,0 +1,74 @@
+from collections import OrderedDict
+from typing import Optional
+import numpy as np
+
+# デフォルトの評価キャッシュのサイズ(MB、0の場合は使用しない)
+DEFAULT_EVAL_CACHE_MB = 0
+
+
+class EvalCache:
+    """
+    ニューラルネットワークの評価結果を局面ごとに保持するLRUキャッシュ
+
+    キーは(局面のハッシュ値, 入力特徴量のモード)。
+    合法手の方策と価値をfloat16の1つの配列(末尾が価値)にまとめて保持し、
+    合計サイズが上限を超えた場合は最も古く使われたエントリから削除する。
+    """
+
+    # 1エントリあたりの管理用のメモリ量の目安(byte)
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, megabytes: int) -> None:
+        self.megabytes = megabytes
+        self.capacity_bytes = megabytes * 1024 * 1024
+        self.entries: OrderedDict[tuple[int, int], np.ndarray] = OrderedDict()
+        self.used_bytes = 0
+
+        # 統計
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.used_bytes = 0
+
+    def reset_stats(self) -> None:
+        self.hits = 0
+        self.misses = 0
+
+    # 評価結果を取得する(戻り値は方策と価値、見つからない場合はNone)
+    def get(self, key: tuple[int, int]) -> Optional[tuple[np.ndarray, float]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[:-1], entry.item(-1)
+
+    # 評価結果を登録する
+    def put(self, key: tuple[int, int], policy: np.ndarray, value: float) -> None:
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        entry = np.empty(len(policy) + 1, dtype=np.float16)
+        entry[:-1] = policy
+        entry[-1] = value
+        self.entries[key] = entry
+        self.used_bytes += entry.nbytes + self.ENTRY_OVERHEAD
+
+        # 上限を超えた場合は古いエントリから削除する
+        while self.used_bytes > self.capacity_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.used_bytes -= evicted.nbytes + self.ENTRY_OVERHEAD
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    # 使用しているメモリ量(byte)
+    def memory_usage(self) -> int:
+        return self.used_bytes
@@ -1,4 +1,4 @@
-from typing import Callable
+from typing import Callable, Union
 from pydantic import BaseModel
 import cshogi
 from cshogi import (
@@ -51,6 +51,10 @@ FEATURES_SMALL_NUM = len(PIECE_TYPES) * 2 + len(MAX_PIECES_IN_HAND) * 2
 # 移動を表すラベルの数
 MOVE_PLANES_NUM = len(MOVE_DIRECTION) + len(HAND_PIECES)
 MOVE_LABELS_NUM = MOVE_PLANES_NUM * 81
+# 1局面の合法手の最大数
+MAX_LEGAL_MOVES = 593
+# 指し手(move16)の数
+MOVE16_NUM = 1 << 16
 
 FEATURES_MODE = [
     FEATURES_DEFAULT,
@@ -188,6 +192,66 @@ def make_move_label(move: int, color: int) -> int:
     return int(move_direction * 81 + to_sq)
 
 
+# 指し手(move16)から移動を表すラベルへの変換表を作成(手番ごと)
+def make_move_label_table() -> np.ndarray:
+    move = np.arange(MOVE16_NUM, dtype=np.int32)
+    to_sq_black = move & 0x7F
+    from_sq_black = (move >> 7) & 0x7F
+    is_promotion = (move & (1 << 14)) != 0
+    is_drop = from_sq_black >= 81
+    # 駒打ちの持ち駒の種類(移動元の値から決まる)
+    drop_hand_piece = np.array([move_drop_hand_piece(from_sq << 7) for from_sq in range(128)], dtype=np.int32)
+
+    table = np.empty((2, MOVE16_NUM), dtype=np.int32)
+    for color in (BLACK, WHITE):
+        # 後手の場合盤を回転
+        if color == WHITE:
+            to_sq = 80 - to_sq_black
+            from_sq = 80 - from_sq_black
+        else:
+            to_sq = to_sq_black
+            from_sq = from_sq_black
+
+        # 移動方向を割り出す(make_move_labelの条件分岐と同じ順で判定する)
+        to_x, to_y = np.divmod(to_sq, 9)
+        from_x, from_y = np.divmod(from_sq, 9)
+        dir_x = to_x - from_x
+        dir_y = to_y - from_y
+        move_direction = np.select(
+            [
+                (dir_y < 0) & (dir_x == 0),
+                (dir_y < 0) & (dir_y == -2) & (dir_x == -1),
+                (dir_y < 0) & (dir_y == -2) & (dir_x == 1),
+                (dir_y < 0) & (dir_x < 0),
+                dir_y < 0,
+                (dir_y == 0) & (dir_x < 0),
+                dir_y == 0,
+                dir_x == 0,
+                dir_x < 0,
+            ],
+            [UP, UP2_RIGHT, UP2_LEFT, UP_RIGHT, UP_LEFT, RIGHT, LEFT, DOWN, DOWN_RIGHT],
+            DOWN_LEFT,
+        )
+        # 成り
+        move_direction = np.where(is_promotion, move_direction + 10, move_direction)
+        # 駒打ちの移動方向
+        move_direction = np.where(is_drop, len(MOVE_DIRECTION) + drop_hand_piece[from_sq_black], move_direction)
+
+        table[color] = move_direction * 81 + to_sq
+
+    return table
+
+
+# 指し手から移動を表すラベルへの変換表
+MOVE_LABEL_TABLE = make_move_label_table()
+
+
+# 移動を表すラベルをまとめて作成(手番は全体で1つ、もしくは指し手ごとに指定する)
+def make_move_labels(moves: np.ndarray, color: Union[int, np.ndarray]) -> np.ndarray:
+    # 下位16ビットを符号なしで取り出す(hcpeのbestMove16はint16のため、0xFFFFとの論理積はNumPy 2でエラーになる)
+    return MOVE_LABEL_TABLE[color, np.asarray(moves).astype(np.uint16, copy=False)]
+
+
 # 対局結果から報酬を作成(価値ネットワーク出力)
 def make_result(game_result: int, color: int) -> float:
     if color == BLACK:
@@ -1,7 +1,9 @@
 import cshogi
 import numpy as np
+from typing_extensions import TypeAlias
 from cshogi import (
     BLACK,
+    WHITE,
     PIECE_TYPES,
     MAX_PIECES_IN_HAND,
 )
@@ -62,83 +64,91 @@ def flip_sfen(sfen: str) -> str:
     return f"{board} {turn} {hands} {ply}"
 
 
+# 駒の値の数(駒の種類 + 後手の駒は16を加える)
+PIECE_NUM = 32
+
+# 利きの表の要素の型(移動先のマス, 利きとヒモの平面上の位置(方向の平面 * 81 + マス))
+AttackTarget: TypeAlias = tuple[int, int]
+
+
+# 利きとヒモの特徴量を作成するための表を作成
+#   添字は[手番][駒][マス]で、値は(1マス移動の移動先, 複数マス移動の方向ごとの移動先(進む順))
+#   相手の駒は上下の方向を反転する(駒の手番ではなく、自分の駒か相手の駒かで向きが決まる)
+def make_attack_table() -> list[list[list[tuple[tuple[AttackTarget, ...], tuple[tuple[AttackTarget, ...], ...]]]]]:
+    table = [[[((), ())] * 81 for _ in range(PIECE_NUM)] for _ in (BLACK, WHITE)]
+    for turn in (BLACK, WHITE):
+        for color in (BLACK, WHITE):
+            is_own = color == turn
+            direction_offset = 0 if is_own else DIRECTION_NUM
+            for piece_type, (step_directions, ray_directions) in PIECE_DIRECTIONS.items():
+                piece = piece_type + (16 if color == WHITE else 0)
+                for square in range(81):
+                    # 1マス移動
+                    steps = []
+                    for direction in step_directions:
+                        move_y, move_x = MOVE_OFFSET[direction]
+                        x = square // 9 + move_x
+                        y = square % 9 + move_y * (-1 if not is_own else 1)
+                        if 0 <= y and y < 9 and 0 <= x and x < 9:
+                            steps.append((x * 9 + y, (direction_offset + direction) * 81 + x * 9 + y))
+
+                    # 複数マス移動
+                    rays = []
+                    for direction in ray_directions:
+                        move_y, move_x = MOVE_OFFSET[direction]
+                        x = square // 9
+                        y = square % 9
+                        ray = []
+                        while True:
+                            x += move_x
+                            y += move_y * (-1 if not is_own else 1)
+                            if not (0 <= y and y < 9 and 0 <= x and x < 9):
+                                break
+                            ray.append((x * 9 + y, (direction_offset + direction) * 81 + x * 9 + y))
+                        if ray:
+                            rays.append(tuple(ray))
+
+                    table[turn][piece][square] = (tuple(steps), tuple(rays))
+
+    return table
+
+
+ATTACK_TABLE = make_attack_table()
+
+
 # 駒の利きを表現する関数
+#   表を引いて利きのある位置を集め、最後にまとめて1を設定する
+#   (1局面の駒は高々40枚で、NumPyの演算を何度も呼ぶよりPythonのループで表を引くほうが速い)
 def make_kiki_features(board: cshogi.Board, features: np.ndarray) -> None:
-    attack_board = board.copy()
-
-    if board.turn != BLACK:
-        attack_board = cshogi.Board(sfen=attack_board.sfen())
-
-    for square, piece in enumerate(attack_board.pieces):
-        piece_type = cshogi.piece_to_piece_type(piece)
-        if piece_type:
-            piece_color = 0 if piece == piece_type else 1
-            piece_direction_list = PIECE_DIRECTIONS.get(piece_type, ([], []))
-
-            # 自分の駒と相手の駒で処理を共通化
-            is_own = piece_color == board.turn
-            direction_offset = BASE_INDEX + (0 if is_own else DIRECTION_NUM)
-
-            # 1マス移動
-            for direction in piece_direction_list[0]:
-                move_y, move_x = MOVE_OFFSET[direction]
-                x = square // 9 + move_x
-                y = square % 9 + move_y * (-1 if not is_own else 1)
-
-                if 0 <= y and y < 9 and 0 <= x and x < 9:
-                    features[direction_offset + direction][x][y] = 1
-
-            # 複数マス移動
-            for direction in piece_direction_list[1]:
-                move_y, move_x = MOVE_OFFSET[direction]
-                x = square // 9
-                y = square % 9
-                while True:
-                    x += move_x
-                    y += move_y * (-1 if not is_own else 1)
-                    if not (0 <= y and y < 9 and 0 <= x and x < 9):
-                        break
-                    features[direction_offset + direction][x][y] = 1
-                    if attack_board.piece_type(y + x * 9) != 0:
+    pieces = board.pieces
+    table = ATTACK_TABLE[board.turn]
+    positions = []
+    for square, piece in enumerate(pieces):
+        if piece:
+            steps, rays = table[piece][square]
+            positions.extend([position for _, position in steps])
+            # 最初に駒があるマスまで
+            for ray in rays:
+                for target, position in ray:
+                    positions.append(position)
+                    if pieces[target]:
                         break
+    features[BASE_INDEX : BASE_INDEX + DIRECTION_NUM * 2].put(positions, 1)
 
 
 # 駒のヒモを表現する関数
 def make_himo_features(board: cshogi.Board, features: np.ndarray) -> None:
-    attack_board = board.copy()
-
-    if board.turn != BLACK:
-        attack_board = cshogi.Board(sfen=attack_board.sfen())
-
-    for square, piece in enumerate(attack_board.pieces):
-        piece_type = cshogi.piece_to_piece_type(piece)
-        if piece_type:
-            piece_color = 0 if piece == piece_type else 1
-            piece_direction_list = PIECE_DIRECTIONS.get(piece_type, ([], []))
-
-            # 自分の駒と相手の駒で処理を共通化
-            is_own = piece_color == board.turn
-            direction_offset = BASE_INDEX + (0 if is_own else DIRECTION_NUM)
-
-            # 1マス移動
-            for direction in piece_direction_list[0]:
-                move_y, move_x = MOVE_OFFSET[direction]
-                x = square // 9 + move_x
-                y = square % 9 + move_y * (-1 if not is_own else 1)
-
-                if 0 <= y and y < 9 and 0 <= x and x < 9 and attack_board.piece_type(y + x * 9) != 0:
-                    features[direction_offset + direction][x][y] = 1
-
-            # 複数マス移動
-            for direction in piece_direction_list[1]:
-                move_y, move_x = MOVE_OFFSET[direction]
-                x = square // 9
-                y = square % 9
-                while True:
-                    x += move_x
-                    y += move_y * (-1 if not is_own else 1)
-                    if not (0 <= y and y < 9 and 0 <= x and x < 9):
-                        break
-                    if attack_board.piece_type(y + x * 9) != 0:
-                        features[direction_offset + direction][x][y] = 1
+    pieces = board.pieces
+    table = ATTACK_TABLE[board.turn]
+    positions = []
+    for square, piece in enumerate(pieces):
+        if piece:
+            steps, rays = table[piece][square]
+            positions.extend([position for target, position in steps if pieces[target]])
+            # 最初に駒があるマスのみ
+            for ray in rays:
+                for target, position in ray:
+                    if pieces[target]:
+                        positions.append(position)
                         break
+    features[BASE_INDEX : BASE_INDEX + DIRECTION_NUM * 2].put(positions, 1)
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 from app.domain.features import MOVE_PLANES_NUM, MOVE_LABELS_NUM
 from app.domain.activation_function import ACTIVATION_FUNCTION_SETTING
@@ -14,14 +15,28 @@ class Bias(nn.Module):
         return input + self.bias
 
 
+# バッチ正規化(畳み込みに畳み込み済みの推論用モデルでは何もしない)
+def batch_norm(channels: int, fused_batch_norm: bool) -> nn.Module:
+    return nn.Identity() if fused_batch_norm else nn.BatchNorm2d(channels)
+
+
+# 畳み込みとその直後のバッチ正規化を1つの畳み込みにまとめる(評価モードの統計量を使う)
+def fuse_conv_batch_norm(module: nn.Module, conv_name: str, bn_name: str) -> None:
+    bn = getattr(module, bn_name)
+    if isinstance(bn, nn.Identity):
+        return
+    setattr(module, conv_name, fuse_conv_bn_eval(getattr(module, conv_name), bn))
+    setattr(module, bn_name, nn.Identity())
+
+
 # ニューラルネットワーク構築class
 class ResNetBlock(nn.Module):
-    def __init__(self, channels: int, activation_function_mode: int = 0):
+    def __init__(self, channels: int, activation_function_mode: int = 0, fused_batch_norm: bool = False):
         super(ResNetBlock, self).__init__()
-        self.conv1 = nn.Conv2d(channels, channels, kernel_size=3, padding=1, bias=False)
-        self.bn1 = nn.BatchNorm2d(channels)
-        self.conv2 = nn.Conv2d(channels, channels, kernel_size=3, padding=1, bias=False)
-        self.bn2 = nn.BatchNorm2d(channels)
+        self.conv1 = nn.Conv2d(channels, channels, kernel_size=3, padding=1, bias=fused_batch_norm)
+        self.bn1 = batch_norm(channels, fused_batch_norm)
+        self.conv2 = nn.Conv2d(channels, channels, kernel_size=3, padding=1, bias=fused_batch_norm)
+        self.bn2 = batch_norm(channels, fused_batch_norm)
 
         self.activation_function = ACTIVATION_FUNCTION_SETTING[activation_function_mode]
 
@@ -35,6 +50,10 @@ class ResNetBlock(nn.Module):
 
         return self.activation_function(out + x)
 
+    def fuse_batch_norm(self) -> None:
+        fuse_conv_batch_norm(self, "conv1", "bn1")
+        fuse_conv_batch_norm(self, "conv2", "bn2")
+
 
 class PolicyValueNetwork(nn.Module):
     def __init__(
@@ -44,27 +63,43 @@ class PolicyValueNetwork(nn.Module):
         blocks: int = 10,
         channels: int = 192,
         fcl: int = 256,
+        fused_batch_norm: bool = False,
     ):
         super(PolicyValueNetwork, self).__init__()
-        self.conv1 = nn.Conv2d(in_channels=input_features, out_channels=channels, kernel_size=3, padding=1, bias=False)
-        self.norm1 = nn.BatchNorm2d(channels)
+        self.conv1 = nn.Conv2d(
+            in_channels=input_features, out_channels=channels, kernel_size=3, padding=1, bias=fused_batch_norm
+        )
+        self.norm1 = batch_norm(channels, fused_batch_norm)
 
         # resnet blocks
-        self.blocks = nn.Sequential(*[ResNetBlock(channels, activation_function_mode) for _ in range(blocks)])
+        self.blocks = nn.Sequential(
+            *[ResNetBlock(channels, activation_function_mode, fused_batch_norm) for _ in range(blocks)]
+        )
 
         # policy head
         self.policy_conv = nn.Conv2d(in_channels=channels, out_channels=MOVE_PLANES_NUM, kernel_size=1, bias=False)
         self.policy_bias = Bias(MOVE_LABELS_NUM)
 
         # value head
-        self.value_conv1 = nn.Conv2d(in_channels=channels, out_channels=MOVE_PLANES_NUM, kernel_size=1, bias=False)
-        self.value_norm1 = nn.BatchNorm2d(MOVE_PLANES_NUM)
+        self.value_conv1 = nn.Conv2d(
+            in_channels=channels, out_channels=MOVE_PLANES_NUM, kernel_size=1, bias=fused_batch_norm
+        )
+        self.value_norm1 = batch_norm(MOVE_PLANES_NUM, fused_batch_norm)
         self.value_fc1 = nn.Linear(MOVE_LABELS_NUM, fcl)
         self.value_fc2 = nn.Linear(fcl, 1)
 
         # activation function
         self.activation_function = ACTIVATION_FUNCTION_SETTING[activation_function_mode]
 
+    # 推論用にすべてのバッチ正規化を直前の畳み込みに畳み込む(学習には使えなくなる)
+    # 畳み込み後のモデルはfused_batch_norm=Trueで作成したモデルとパラメータの形が同じになる
+    def fuse_batch_norm(self) -> None:
+        self.eval()
+        fuse_conv_batch_norm(self, "conv1", "norm1")
+        for block in self.blocks:
+            block.fuse_batch_norm()
+        fuse_conv_batch_norm(self, "value_conv1", "value_norm1")
+
     def forward(self, x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
         x = self.conv1(x)
         x = self.activation_function(self.norm1(x))
@@ -0,0 +1,173 @@
+import math
+import numpy as np
+from typing import Callable
+from app.domain.features import MAX_LEGAL_MOVES
+from app.domain.uct_node import NULL_NODE, NodePool
+
+# Numbaがある場合は選択をコンパイルする(ない場合はNumPyで計算する)
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# 1回の呼び出しで辿る最大の深さ
+MAX_DESCEND_LEVELS = 64
+
+
+# UCB値が最大の子の辺を求める(子ごとにQ+Uを計算しながら最大値を求め、一時配列を作らない)
+def select_max_ucb_child_loop(
+    child_sum_value: np.ndarray,
+    child_move_count: np.ndarray,
+    policy: np.ndarray,
+    first: int,
+    child_num: int,
+    move_count: int,
+    c_puct: float,
+    scratch: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray],
+) -> int:
+    # NumPyで計算していたときと同じ精度で計算する(未訪問のノードはfloat32、それ以外はfloat64)
+    sqrt_move_count = np.float32(math.sqrt(move_count))
+    c_puct_float32 = np.float32(c_puct)
+    best_edge = first
+    best_ucb = -math.inf
+    for edge in range(first, first + child_num):
+        count = child_move_count[edge]
+        q = np.float32(child_sum_value[edge] / count) if count != 0 else np.float32(0.0)
+        if move_count == 0:
+            ucb = float(np.float32(q + np.float32(c_puct_float32 * policy[edge])))
+        else:
+            ucb = q + c_puct * (sqrt_move_count / (1 + count)) * policy[edge]
+        if ucb > best_ucb:
+            best_ucb = ucb
+            best_edge = edge
+    return best_edge
+
+
+# NumPy版の選択で使う作業用の配列(Q値, UCB値, 未訪問のノードのUCB値, 訪問回数)
+# 探索スレッドごとに持ち、スレッド間で共有しない(ループ版では使わない)
+def make_ucb_scratch() -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    return (
+        np.zeros(MAX_LEGAL_MOVES, dtype=np.float32),
+        np.zeros(MAX_LEGAL_MOVES, dtype=np.float64),
+        np.zeros(MAX_LEGAL_MOVES, dtype=np.float32),
+        np.zeros(MAX_LEGAL_MOVES, dtype=np.int32),
+    )
+
+
+# select_max_ucb_child_loopのNumPy版(作業用の配列を使い回し、呼び出しごとに配列を確保しない)
+def select_max_ucb_child_numpy(
+    child_sum_value: np.ndarray,
+    child_move_count: np.ndarray,
+    policy: np.ndarray,
+    first: int,
+    child_num: int,
+    move_count: int,
+    c_puct: float,
+    scratch: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray],
+) -> int:
+    q_buffer, ucb_buffer, ucb_float32_buffer, count_buffer = scratch
+    last = first + child_num
+    counts = child_move_count[first:last]
+    q = q_buffer[:child_num]
+    count = count_buffer[:child_num]
+    # 未訪問の子は勝率の合計も0のため、訪問回数を1として割る
+    np.maximum(counts, 1, out=count)
+    np.divide(child_sum_value[first:last], count, out=q)
+    if move_count == 0:
+        ucb = ucb_float32_buffer[:child_num]
+        np.multiply(policy[first:last], np.float32(c_puct), out=ucb)
+    else:
+        # 定数をまとめて掛け、配列の演算の回数を減らす(丸め誤差の範囲でループ版と異なる)
+        ucb = ucb_buffer[:child_num]
+        np.add(counts, 1, out=count)
+        np.divide(policy[first:last], count, out=ucb)
+        ucb *= c_puct * float(np.float32(math.sqrt(move_count)))
+    ucb += q
+    return first + int(ucb.argmax())
+
+
+# 子の選択関数selectを使い、経路を辿る関数を作る(NumbaではNumba版の選択関数を渡してコンパイルする)
+def make_descend_max_ucb_path(select: Callable[..., int]) -> Callable[..., int]:
+    # UCB値が最大の子を選んでVirtual Lossを加算し、評価済みの子ノードが続く限り深く辿る
+    # (辿った経路のノードと辺をnodesとedgesに書き込み、経路の長さを返す。
+    # 最後の辺の子ノードは、未作成、未評価、詰みや千日手、子がない、もしくは最大の深さのいずれか)
+    def descend_max_ucb_path(
+        move_count: np.ndarray,
+        value: np.ndarray,
+        first_child: np.ndarray,
+        child_num: np.ndarray,
+        child_move_count: np.ndarray,
+        child_sum_value: np.ndarray,
+        policy: np.ndarray,
+        child_node: np.ndarray,
+        node: int,
+        c_puct: float,
+        virtual_loss: int,
+        nodes: np.ndarray,
+        edges: np.ndarray,
+        scratch: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray],
+    ) -> int:
+        # NumPyのスカラーの演算は遅いため、Pythonの数値に変換して計算する(Numbaでは変換は不要だが影響しない)
+        depth = 0
+        max_depth = len(edges)
+        while True:
+            node_move_count = int(move_count[node])
+            edge = select(
+                child_sum_value,
+                child_move_count,
+                policy,
+                int(first_child[node]),
+                int(child_num[node]),
+                node_move_count,
+                c_puct,
+                scratch,
+            )
+            move_count[node] = node_move_count + virtual_loss
+            child_move_count[edge] = int(child_move_count[edge]) + virtual_loss
+            nodes[depth] = node
+            edges[depth] = edge
+            depth += 1
+
+            next_node = int(child_node[edge])
+            if depth == max_depth or next_node == NULL_NODE:
+                return depth
+            # 勝率(0〜1)以外の値は、未評価(NaN)、もしくは詰みや千日手
+            next_value = float(value[next_node])
+            if not (0.0 <= next_value <= 1.0) or int(child_num[next_node]) == 0:
+                return depth
+            node = next_node
+
+    return descend_max_ucb_path
+
+
+descend_max_ucb_path_numpy = make_descend_max_ucb_path(select_max_ucb_child_numpy)
+if numba is not None:
+    select_max_ucb_child = numba.njit(cache=True)(select_max_ucb_child_loop)
+    descend_max_ucb_path = numba.njit(cache=True)(make_descend_max_ucb_path(select_max_ucb_child))
+else:
+    select_max_ucb_child = select_max_ucb_child_numpy
+    descend_max_ucb_path = descend_max_ucb_path_numpy
+
+
+# 探索を始める前にNumbaのコンパイルを済ませておく
+def compile_ucb_kernels() -> None:
+    pool = NodePool(node_capacity=2, edge_capacity=1)
+    pool.first_child[0] = 0
+    pool.child_num[0] = 1
+    pool.child_node[0] = 1
+    descend_max_ucb_path(
+        pool.move_count,
+        pool.value,
+        pool.first_child,
+        pool.child_num,
+        pool.child_move_count,
+        pool.child_sum_value,
+        pool.policy,
+        pool.child_node,
+        0,
+        1.0,
+        1,
+        np.zeros(MAX_DESCEND_LEVELS, dtype=np.int64),
+        np.zeros(MAX_DESCEND_LEVELS, dtype=np.int64),
+        make_ucb_scratch(),
+    )
@@ -2,82 +2,384 @@ from typing import Optional
 import numpy as np
 import cshogi
 
+# 未作成のノードを表すインデックス
+NULL_NODE = -1
+# 未展開のノードの子ノードの開始位置
+NOT_EXPANDED = -1
+# 1ノードあたりの子ノード(辺)の数の目安(メモリ量からの容量見積もりに使用)
+EDGES_PER_NODE = 64
+# デフォルトのノードプールのサイズ(MB)
+DEFAULT_NODE_POOL_MB = 128
+# デフォルトの置換表のサイズ(MB)
+DEFAULT_TRANSPOSITION_TABLE_MB = 16
 
-class UctNode:
-    def __init__(self) -> None:
-        self.move_count: int = 0  # ノードの訪問回数
-        self.sum_value: float = 0.0  # 勝率の合計
-        self.child_move: Optional[list[int]] = None  # 子ノードの指し手(リスト)
-        self.child_move_count: Optional[np.ndarray] = None  # 子ノードの訪問回数(ndarray)
-        self.child_sum_value: Optional[np.ndarray] = None  # 子ノードの勝率の合計(ndarray)
-        self.child_node: Optional[list[UctNode]] = None  # 子ノード(リスト)
-        self.policy: Optional[np.ndarray] = None  # 方策ネットワークの予測確率(ndarray)
-        self.value: Optional[float] = None  # 価値
+
+# 連続する複数の範囲のインデックスを1つの配列にまとめる
+def concat_ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    total = int(counts.sum())
+    offsets = np.cumsum(counts) - counts
+    return np.repeat(starts - offsets, counts) + np.arange(total, dtype=np.int64)
+
+
+# 配列の容量を変更する(既存の要素は保持する)
+def resize_array(array: np.ndarray, capacity: int, size: int, fill_value: float = 0) -> np.ndarray:
+    new_array = np.full(capacity, fill_value, dtype=array.dtype)
+    new_array[:size] = array[:size]
+    return new_array
+
+
+class NodePool:
+    """
+    ノードと子ノード(辺)をNumPy配列で保持するノードプール
+
+    ノードと辺はそれぞれ整数のインデックスで参照する。
+    ノードの子ノードは辺の配列上の連続した領域 first_child[node] から child_num[node] 個に配置される。
+    容量が不足した場合は配列を拡張する。
+    """
+
+    # ノードの配列(dtype)
+    NODE_FIELDS = {
+        "move_count": np.int32,  # ノードの訪問回数
+        "sum_value": np.float32,  # 勝率の合計
+        "value": np.float32,  # 価値(未評価の場合はNaN)
+        "evaluated": np.bool_,  # 方策が設定済みか
+        "first_child": np.int64,  # 子ノードの開始位置(未展開の場合はNOT_EXPANDED)
+        "child_num": np.int32,  # 子ノードの数
+    }
+    # 辺の配列(dtype)
+    EDGE_FIELDS = {
+        "child_move": np.int32,  # 子ノードの指し手
+        "child_move_count": np.int32,  # 子ノードの訪問回数
+        "child_sum_value": np.float32,  # 子ノードの勝率の合計
+        "policy": np.float32,  # 方策ネットワークの予測確率
+        "child_node": np.int32,  # 子ノードのインデックス(未作成の場合はNULL_NODE)
+    }
+    NODE_BYTES = sum(np.dtype(dtype).itemsize for dtype in NODE_FIELDS.values())
+    EDGE_BYTES = sum(np.dtype(dtype).itemsize for dtype in EDGE_FIELDS.values())
+
+    def __init__(self, node_capacity: int = 1024, edge_capacity: Optional[int] = None) -> None:
+        self.node_capacity = max(1, node_capacity)
+        self.edge_capacity = max(1, edge_capacity if edge_capacity is not None else node_capacity * EDGES_PER_NODE)
+        # 使用中のノード数と辺の数
+        self.node_size = 0
+        self.edge_size = 0
+
+        self.move_count = np.zeros(self.node_capacity, dtype=np.int32)
+        self.sum_value = np.zeros(self.node_capacity, dtype=np.float32)
+        self.value = np.full(self.node_capacity, np.nan, dtype=np.float32)
+        self.evaluated = np.zeros(self.node_capacity, dtype=np.bool_)
+        self.first_child = np.full(self.node_capacity, NOT_EXPANDED, dtype=np.int64)
+        self.child_num = np.zeros(self.node_capacity, dtype=np.int32)
+
+        self.child_move = np.zeros(self.edge_capacity, dtype=np.int32)
+        self.child_move_count = np.zeros(self.edge_capacity, dtype=np.int32)
+        self.child_sum_value = np.zeros(self.edge_capacity, dtype=np.float32)
+        self.policy = np.zeros(self.edge_capacity, dtype=np.float32)
+        self.child_node = np.full(self.edge_capacity, NULL_NODE, dtype=np.int32)
+
+    @classmethod
+    def from_megabytes(cls, megabytes: int) -> "NodePool":
+        # 指定したメモリ量に収まるように容量を見積もる
+        node_capacity = megabytes * 1024 * 1024 // (cls.NODE_BYTES + cls.EDGE_BYTES * EDGES_PER_NODE)
+        return cls(node_capacity=node_capacity)
+
+    # すべてのノードを解放する(配列は再利用する)
+    def clear(self) -> None:
+        self.node_size = 0
+        self.edge_size = 0
+
+    # 使用しているメモリ量(byte)
+    def memory_usage(self) -> int:
+        return self.node_capacity * self.NODE_BYTES + self.edge_capacity * self.EDGE_BYTES
+
+    def _reserve_nodes(self, size: int) -> None:
+        if size <= self.node_capacity:
+            return
+        capacity = max(size, self.node_capacity * 2)
+        self.move_count = resize_array(self.move_count, capacity, self.node_size)
+        self.sum_value = resize_array(self.sum_value, capacity, self.node_size)
+        self.value = resize_array(self.value, capacity, self.node_size, np.nan)
+        self.evaluated = resize_array(self.evaluated, capacity, self.node_size)
+        self.first_child = resize_array(self.first_child, capacity, self.node_size, NOT_EXPANDED)
+        self.child_num = resize_array(self.child_num, capacity, self.node_size)
+        self.node_capacity = capacity
+
+    def _reserve_edges(self, size: int) -> None:
+        if size <= self.edge_capacity:
+            return
+        capacity = max(size, self.edge_capacity * 2)
+        self.child_move = resize_array(self.child_move, capacity, self.edge_size)
+        self.child_move_count = resize_array(self.child_move_count, capacity, self.edge_size)
+        self.child_sum_value = resize_array(self.child_sum_value, capacity, self.edge_size)
+        self.policy = resize_array(self.policy, capacity, self.edge_size)
+        self.child_node = resize_array(self.child_node, capacity, self.edge_size, NULL_NODE)
+        self.edge_capacity = capacity
+
+    # 辺の領域を確保する
+    def _allocate_edges(self, num: int) -> int:
+        self._reserve_edges(self.edge_size + num)
+        first = self.edge_size
+        self.edge_size += num
+        self.child_move_count[first : first + num] = 0
+        self.child_sum_value[first : first + num] = 0
+        self.policy[first : first + num] = 0
+        self.child_node[first : first + num] = NULL_NODE
+        return first
+
+    # ノード作成
+    def new_node(self) -> int:
+        self._reserve_nodes(self.node_size + 1)
+        node = self.node_size
+        self.node_size += 1
+        self.move_count[node] = 0
+        self.sum_value[node] = 0
+        self.value[node] = np.nan
+        self.evaluated[node] = False
+        self.first_child[node] = NOT_EXPANDED
+        self.child_num[node] = 0
+        return node
 
     # 子ノード作成
-    def create_child_node(self, index: int) -> Optional["UctNode"]:
-        self.child_node[index] = UctNode()
-        return self.child_node[index]
+    def create_child_node(self, edge: int) -> int:
+        child = self.new_node()
+        self.child_node[edge] = child
+        return child
 
     # ノードの展開
-    def expand_node(self, board: cshogi.Board) -> None:
-        self.child_move = list(board.legal_moves)
-        child_num = len(self.child_move)
-        self.child_move_count = np.zeros(child_num, dtype=np.int32)
-        self.child_sum_value = np.zeros(child_num, dtype=np.float32)
+    def expand_node(self, node: int, board: cshogi.Board) -> None:
+        legal_moves = list(board.legal_moves)
+        child_num = len(legal_moves)
+        first = self._allocate_edges(child_num)
+        self.child_move[first : first + child_num] = legal_moves
+        self.first_child[node] = first
+        self.child_num[node] = child_num
+
+    # ノードが展開済みか
+    def is_expanded(self, node: int) -> bool:
+        return bool(self.first_child[node] != NOT_EXPANDED)
+
+    # 子ノード(辺)の範囲
+    def child_range(self, node: int) -> range:
+        first = int(self.first_child[node])
+        return range(first, first + int(self.child_num[node]))
 
     # 1つを除くすべての子を削除する
-    def release_children_except_one(self, move: int) -> "UctNode":
-        if self.child_move and self.child_node:
+    def release_children_except_one(self, node: int, move: int) -> int:
+        first = int(self.first_child[node])
+        child_num = int(self.child_num[node])
+        if first != NOT_EXPANDED and child_num > 0:
             # 一つを残して削除する
-            for i in range(len(self.child_move)):
-                if self.child_move[i] == move:
-                    if self.child_node[i] is None:
+            for edge in range(first, first + child_num):
+                if self.child_move[edge] == move:
+                    child = int(self.child_node[edge])
+                    if child == NULL_NODE:
                         # 新しいノードを作成する
-                        self.child_node[i] = UctNode()
+                        child = self.new_node()
                     # 子ノードを一つにする
-                    if len(self.child_move) > 1:
-                        self.child_move = [move]
-                        self.child_move_count = None
-                        self.child_sum_value = None
-                        self.policy = None
-                        self.child_node = [self.child_node[i]]
-                    return self.child_node[0]
-
-        # 子ノードが見つからなかった場合、または子ノードが未展開、または子ノードリストが未初期化の場合
-        self.child_move = [move]
-        self.child_move_count = None
-        self.child_sum_value = None
-        self.policy = None
-        # 子ノードのリストを初期化する
-        self.child_node = [UctNode()]
-        return self.child_node[0]
+                    if child_num > 1:
+                        self._set_single_child(node, first, move, child)
+                    else:
+                        self.child_node[edge] = child
+                    return child
+        else:
+            first = self._allocate_edges(1)
+
+        # 子ノードが見つからなかった場合、または子ノードが未展開の場合
+        child = self.new_node()
+        self._set_single_child(node, first, move, child)
+        return child
+
+    def _set_single_child(self, node: int, first: int, move: int, child: int) -> None:
+        self.child_move[first] = move
+        self.child_move_count[first] = 0
+        self.child_sum_value[first] = 0
+        self.policy[first] = 0
+        self.child_node[first] = child
+        self.first_child[node] = first
+        self.child_num[node] = 1
+        self.evaluated[node] = False
+
+    # rootから到達できるノードだけを残して詰め直す(戻り値は新旧インデックスの対応表)
+    def compact(self, root: int) -> np.ndarray:
+        remap = np.full(self.node_size, NULL_NODE, dtype=np.int64)
+        if root == NULL_NODE:
+            self.clear()
+            return remap
+
+        # 幅優先で到達可能なノードを列挙する
+        reached = np.zeros(self.node_size, dtype=np.bool_)
+        levels = []
+        frontier = np.array([root], dtype=np.int64)
+        while frontier.size > 0:
+            reached[frontier] = True
+            levels.append(frontier)
+            first = self.first_child[frontier]
+            expanded = first != NOT_EXPANDED
+            edges = concat_ranges(first[expanded], self.child_num[frontier][expanded].astype(np.int64))
+            children = self.child_node[edges].astype(np.int64)
+            children = np.unique(children[children != NULL_NODE])
+            frontier = children[~reached[children]]
+        old_nodes = np.concatenate(levels)
+        node_size = len(old_nodes)
+        remap[old_nodes] = np.arange(node_size)
+
+        # 辺を新しいノードの順に詰め直す
+        first = self.first_child[old_nodes]
+        expanded = first != NOT_EXPANDED
+        child_num = np.where(expanded, self.child_num[old_nodes], 0).astype(np.int64)
+        old_edges = concat_ranges(first[expanded], child_num[expanded])
+        new_first = np.where(expanded, np.cumsum(child_num) - child_num, NOT_EXPANDED)
+        edge_size = len(old_edges)
+
+        child_node = self.child_node[old_edges].astype(np.int64)
+        child_node = np.where(child_node != NULL_NODE, remap[child_node], NULL_NODE)
+        self.child_move[:edge_size] = self.child_move[old_edges]
+        self.child_move_count[:edge_size] = self.child_move_count[old_edges]
+        self.child_sum_value[:edge_size] = self.child_sum_value[old_edges]
+        self.policy[:edge_size] = self.policy[old_edges]
+        self.child_node[:edge_size] = child_node
+
+        self.move_count[:node_size] = self.move_count[old_nodes]
+        self.sum_value[:node_size] = self.sum_value[old_nodes]
+        self.value[:node_size] = self.value[old_nodes]
+        self.evaluated[:node_size] = self.evaluated[old_nodes]
+        self.first_child[:node_size] = new_first
+        self.child_num[:node_size] = self.child_num[old_nodes]
+
+        self.node_size = node_size
+        self.edge_size = edge_size
+        return remap
+
+
+class TranspositionTable:
+    """
+    局面のハッシュ値(zobrist hash)からノードを引く置換表
+
+    同じ局面に別の手順で到達した場合にノードを共有し、ゲーム木をDAGにする。
+    BUCKET_SIZE個のエントリをまとめたバケットを配列で持ち、容量は固定。
+    バケットが埋まっている場合は、最も古い世代のエントリを置き換える。
+    """
+
+    BUCKET_SIZE = 4
+    ENTRY_BYTES = 8 + 4 + 1
+
+    def __init__(self, megabytes: int = DEFAULT_TRANSPOSITION_TABLE_MB) -> None:
+        # バケット数は2のべき乗にする
+        bucket_num = 1 << max(0, (megabytes * 1024 * 1024 // (self.ENTRY_BYTES * self.BUCKET_SIZE)).bit_length() - 1)
+        self.mask = bucket_num - 1
+        self.capacity = bucket_num * self.BUCKET_SIZE
+        self.keys = np.zeros(self.capacity, dtype=np.uint64)
+        self.nodes = np.full(self.capacity, NULL_NODE, dtype=np.int32)
+        self.generations = np.zeros(self.capacity, dtype=np.uint8)
+        # 探索ごとに進める世代
+        self.generation = 0
+
+        # 統計
+        self.probes = 0
+        self.hits = 0
+        self.stores = 0
+        self.replacements = 0
+
+    # すべてのエントリを削除する
+    def clear(self) -> None:
+        self.nodes.fill(NULL_NODE)
+        self.generation = 0
+
+    # 世代を進める(探索開始時に呼ぶ)
+    def new_generation(self) -> None:
+        self.generation = (self.generation + 1) & 0xFF
+
+    def reset_stats(self) -> None:
+        self.probes = 0
+        self.hits = 0
+        self.stores = 0
+        self.replacements = 0
+
+    # 局面のノードを検索する(見つからない場合はNULL_NODE)
+    def probe(self, key: int) -> int:
+        self.probes += 1
+        base = (key & self.mask) * self.BUCKET_SIZE
+        for i in range(base, base + self.BUCKET_SIZE):
+            node = self.nodes.item(i)
+            if node != NULL_NODE and self.keys.item(i) == key:
+                self.generations[i] = self.generation
+                self.hits += 1
+                return node
+        return NULL_NODE
+
+    # 局面のノードを登録する
+    def store(self, key: int, node: int) -> None:
+        self.stores += 1
+        base = (key & self.mask) * self.BUCKET_SIZE
+        replace = base
+        oldest_age = -1
+        for i in range(base, base + self.BUCKET_SIZE):
+            if self.nodes.item(i) == NULL_NODE or self.keys.item(i) == key:
+                replace = i
+                break
+            # 世代が古いエントリほど置き換えやすい
+            age = (self.generation - self.generations.item(i)) & 0xFF
+            if age > oldest_age:
+                oldest_age = age
+                replace = i
+        else:
+            self.replacements += 1
+        self.keys[replace] = key
+        self.nodes[replace] = node
+        self.generations[replace] = self.generation
+
+    # ノードプールの詰め直しに合わせてノードのインデックスを付け替える
+    def remap(self, remap: np.ndarray) -> None:
+        used = self.nodes != NULL_NODE
+        self.nodes[used] = remap[self.nodes[used]]
+
+    # 指定したノードのエントリを削除する
+    def remove_nodes(self, nodes: list[int]) -> None:
+        self.nodes[np.isin(self.nodes, nodes)] = NULL_NODE
+
+    # 使用中のエントリ数
+    def used(self) -> int:
+        return int(np.count_nonzero(self.nodes != NULL_NODE))
+
+    def hit_rate(self) -> float:
+        return self.hits / self.probes if self.probes > 0 else 0.0
+
+    # 使用しているメモリ量(byte)
+    def memory_usage(self) -> int:
+        return self.capacity * self.ENTRY_BYTES
 
 
 class NodeTree:
-    def __init__(self) -> None:
-        self.current_head: Optional[UctNode] = None
-        self.gamebegin_node: Optional[UctNode] = None
+    def __init__(self, pool: Optional[NodePool] = None, tt: Optional[TranspositionTable] = None) -> None:
+        self.pool: NodePool = pool if pool is not None else NodePool()
+        # 置換表(Noneの場合はノードを共有しない)
+        self.tt: Optional[TranspositionTable] = tt
+        self.current_head: int = NULL_NODE
+        self.gamebegin_node: int = NULL_NODE
         self.history_starting_pos_key: Optional[int] = None
 
     # ゲーム木内の位置を設定し、サブツリーの再利用を試みる
     def reset_to_position(self, starting_pos_key: int, moves: list[int]) -> None:
-        if self.history_starting_pos_key != starting_pos_key:
+        pool = self.pool
+        if self.history_starting_pos_key != starting_pos_key or self.gamebegin_node == NULL_NODE:
             # 開始位置が異なる場合、ゲーム木を作り直す
-            self.gamebegin_node = UctNode()
+            pool.clear()
+            if self.tt is not None:
+                self.tt.clear()
+            self.gamebegin_node = pool.new_node()
             self.current_head = self.gamebegin_node
 
         self.history_starting_pos_key = starting_pos_key
 
         # 開始位置から順に、子ノード一つだけ残して、それ以外を解放する
         old_head = self.current_head
-        prev_head = None
+        prev_head = NULL_NODE
         self.current_head = self.gamebegin_node
         seen_old_head = self.gamebegin_node == old_head
         for move in moves:
             prev_head = self.current_head
             # current_headに着手を追加する
-            self.current_head = self.current_head.release_children_except_one(move)
+            self.current_head = pool.release_children_except_one(self.current_head, move)
             if old_head == self.current_head:
                 seen_old_head = True
 
@@ -85,11 +387,46 @@ class NodeTree:
         # つまり、古い子が以前にトリミングされていても、current_headは古いデータを保持する可能性がある
         # その場合、current_headをリセットする必要がある
         if not seen_old_head and self.current_head != old_head:
-            if prev_head:
-                assert len(prev_head.child_move) == 1
-                prev_head.child_node[0] = UctNode()
-                self.current_head = prev_head.child_node[0]
+            if prev_head != NULL_NODE:
+                assert pool.child_num[prev_head] == 1
+                self.current_head = pool.create_child_node(int(pool.first_child[prev_head]))
             else:
                 # 開始局面に戻った場合
-                self.gamebegin_node = UctNode()
+                self.gamebegin_node = pool.new_node()
                 self.current_head = self.gamebegin_node
+
+        # 解放したノードの領域を回収する
+        self.garbage_collect()
+
+    # ゲーム開始局面から到達できないノードの領域を回収する
+    def garbage_collect(self) -> None:
+        remap = self.pool.compact(self.gamebegin_node)
+        self.gamebegin_node = int(remap[self.gamebegin_node])
+        self.current_head = int(remap[self.current_head])
+
+        if self.tt is not None:
+            self.tt.remap(remap)
+            # 対局中に現れた局面のノードは子ノードを1つにしているため共有しない
+            pool = self.pool
+            history_nodes = []
+            node = self.gamebegin_node
+            while node != self.current_head:
+                history_nodes.append(node)
+                node = pool.child_node.item(pool.first_child.item(node))
+            if history_nodes:
+                self.tt.remove_nodes(history_nodes)
+
+    # 子ノードを作成する(置換表がある場合は同一局面のノードを共有する)
+    def create_child_node(self, edge: int, board: cshogi.Board) -> tuple[int, bool]:
+        if self.tt is None:
+            return self.pool.create_child_node(edge), True
+
+        key = board.zobrist_hash()
+        node = self.tt.probe(key)
+        if node != NULL_NODE:
+            self.pool.child_node[edge] = node
+            return node, False
+
+        node = self.pool.create_child_node(edge)
+        self.tt.store(key, node)
+        return node, True
@@ -0,0 +1,120 @@
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Optional
+import numpy as np
+
+# 推論関数(入力特徴量とバッチサイズを受け取り、方策と価値を返す)
+InferFunction = Callable[[Any, int], tuple[np.ndarray, np.ndarray]]
+
+
+# 入力特徴量(配列、もしくは配列のリスト)の先頭size行をoffset行目以降にコピーする
+def copy_features(dst: Any, offset: int, src: Any, size: int) -> None:
+    if isinstance(dst, (list, tuple)):
+        for dst_features, src_features in zip(dst, src):
+            copy_features(dst_features, offset, src_features, size)
+    else:
+        dst[offset : offset + size] = src[:size]
+
+
+class BatchEvaluator:
+    """
+    複数の探索スレッドからの推論要求をまとめて評価する推論スレッド
+
+    探索スレッドはsubmit()で自分の入力特徴量を渡し、返されたFutureから結果を受け取る。
+    推論スレッドはその時点で待っている要求をすべて1つのバッチにまとめて推論するため、
+    推論中も他の探索スレッドは次のバッチの選択を続けられる。
+    まとめたバッチの入力特徴量は、すべての探索スレッドのバッチを合わせた大きさを確保しておく。
+    """
+
+    def __init__(self, infer: InferFunction, features: Any, max_batch_size: int) -> None:
+        self.infer = infer
+        # まとめたバッチの入力特徴量
+        self.features = features
+        self.max_batch_size = max_batch_size
+        # 推論要求(入力特徴量, バッチサイズ, Future)、Noneは終了要求
+        self.requests: queue.SimpleQueue[Optional[tuple[Any, int, Future]]] = queue.SimpleQueue()
+        # バッチに入りきらず次に回した要求
+        self.pending: Optional[tuple[Any, int, Future]] = None
+        self.thread: Optional[threading.Thread] = None
+
+        # 統計
+        self.batches = 0
+        self.positions = 0
+
+    def start(self) -> None:
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self) -> None:
+        if self.thread is not None:
+            self.requests.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def reset_stats(self) -> None:
+        self.batches = 0
+        self.positions = 0
+
+    # 推論要求を追加する(結果は方策と価値)
+    def submit(self, features: Any, size: int) -> Future:
+        future: Future = Future()
+        self.requests.put((features, size, future))
+        return future
+
+    def run(self) -> None:
+        while True:
+            # 要求が来るまで待つ
+            request = self.pending if self.pending is not None else self.requests.get()
+            self.pending = None
+            if request is None:
+                return
+
+            # 待っている要求をバッチサイズの上限までまとめる
+            requests = [request]
+            total = request[1]
+            stopping = False
+            while True:
+                try:
+                    request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                if total + request[1] > self.max_batch_size:
+                    self.pending = request
+                    break
+                requests.append(request)
+                total += request[1]
+
+            self.evaluate(requests, total)
+            if stopping:
+                return
+
+    def evaluate(self, requests: list[tuple[Any, int, Future]], total: int) -> None:
+        try:
+            if len(requests) == 1:
+                # 要求が1つの場合はコピーせずにそのまま推論する
+                features, size, _ = requests[0]
+                policies, values = self.infer(features, size)
+            else:
+                offset = 0
+                for features, size, _ in requests:
+                    copy_features(self.features, offset, features, size)
+                    offset += size
+                policies, values = self.infer(self.features, total)
+        except BaseException as e:
+            for _, _, future in requests:
+                future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.positions += total
+
+        # 要求ごとに結果を分ける
+        offset = 0
+        for _, size, future in requests:
+            future.set_result((policies[offset : offset + size], values[offset : offset + size]))
+            offset += size
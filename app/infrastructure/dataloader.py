@@ -1,16 +1,181 @@
+import json
 import os
-from typing import Union
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from typing import Iterator, Union
+from concurrent.futures import ThreadPoolExecutor, Future
+from multiprocessing import shared_memory
+import multiprocessing
 import numpy as np
 import logging
 import torch
 from typing import Optional
 
 from cshogi import Board, HuffmanCodedPosAndEval
-from app.domain.features import FEATURES_SETTINGS, make_move_label, make_result
+from app.domain.features import FEATURES_SETTINGS, FeaturesSetting, make_move_labels, make_result
 
 from app.interfaces.logger import Logger
 
+# デフォルトの先読みするバッチ数(ワーカープロセスを使う場合)
+DEFAULT_PREFETCH = 4
+# ストリーミングで読み込む場合のデフォルトのシャッフルバッファの局面数、1回に読み込む局面数、同時に読むファイル数
+DEFAULT_SHUFFLE_BUFFER = 1_000_000
+DEFAULT_READ_AHEAD = 65536
+DEFAULT_FILES_IN_FLIGHT = 4
+# 入力特徴量を詰めた学習データのファイルの拡張子
+PACKED_FEATURES_EXTENSION = ".npy"
+# 入力特徴量を詰めた学習データの作成条件を記録するファイルの拡張子(学習データのパスに付加する)
+PACKED_FEATURES_METADATA_EXTENSION = ".json"
+
+
+# 入力特徴量をビット単位で詰めた学習データの要素の型
+def packed_features_dtype(features_num: int) -> np.dtype:
+    return np.dtype(
+        [
+            ("features", np.uint8, ((features_num * 81 + 7) // 8,)),
+            ("moveLabel", np.int16),
+            ("result", np.float32),
+        ]
+    )
+
+
+# 入力特徴量を詰めた学習データの作成条件を保存する
+# (利きとヒモのモードは入力特徴量の数が同じため、要素の型だけではモードを区別できない)
+def save_packed_features_metadata(path: str, features_mode: int) -> None:
+    with open(path + PACKED_FEATURES_METADATA_EXTENSION, "w") as f:
+        json.dump({"features_mode": features_mode, "features_num": FEATURES_SETTINGS[features_mode].features_num}, f)
+
+
+def load_packed_features_metadata(path: str) -> dict:
+    metadata_path = path + PACKED_FEATURES_METADATA_EXTENSION
+    if not os.path.exists(metadata_path):
+        raise ValueError("{} not found, run preprocess again to record the input features mode".format(metadata_path))
+    with open(metadata_path) as f:
+        return json.load(f)
+
+
+# 入力特徴量を詰めた学習データか
+def is_packed_features(records: np.ndarray) -> bool:
+    return records.dtype.names is not None and "features" in records.dtype.names
+
+
+# 局面から入力特徴量と正解データのミニバッチを作成
+def make_batch(
+    board: Board,
+    features_setting: FeaturesSetting,
+    hcpevec: np.ndarray,
+    features: np.ndarray,
+    move_label: np.ndarray,
+    result: np.ndarray,
+    color: np.ndarray,
+) -> None:
+    features.fill(0)
+    for i, hcpe in enumerate(hcpevec):
+        board.set_hcp(hcpe["hcp"])  # ボードを設定
+        features_setting.make_features(board, features[i])  # 入力特徴量の作成
+        color[i] = board.turn
+        result[i] = make_result(hcpe["gameResult"], board.turn)  # 正解データ価値
+    # 正解データ方策
+    move_label[: len(hcpevec)] = make_move_labels(hcpevec["bestMove16"], color[: len(hcpevec)])
+
+
+# ビット単位で詰めた入力特徴量と正解データをまとめて展開してミニバッチを作成
+def unpack_batch(records: np.ndarray, features: np.ndarray, move_label: np.ndarray, result: np.ndarray) -> None:
+    size = len(records)
+    features[:size] = np.unpackbits(records["features"], axis=1, count=features[0].size).reshape(features[:size].shape)
+    features[size:].fill(0)
+    move_label[:size] = records["moveLabel"]
+    result[:size] = records["result"]
+
+
+# 学習データの種類に応じてミニバッチを作成
+def fill_batch(
+    board: Board,
+    features_setting: FeaturesSetting,
+    records: np.ndarray,
+    features: np.ndarray,
+    move_label: np.ndarray,
+    result: np.ndarray,
+    color: np.ndarray,
+) -> None:
+    if is_packed_features(records):
+        unpack_batch(records, features, move_label, result)
+    else:
+        make_batch(board, features_setting, records, features, move_label, result, color)
+
+
+# 共有メモリ上のバッチのリングバッファ(スロットごとに入力特徴量、正解データ方策、正解データ価値)
+def batch_ring_views(
+    buffer: memoryview, slots: int, batch_size: int, features_num: int
+) -> list[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    features = np.ndarray((slots, batch_size, features_num, 9, 9), dtype=np.float32, buffer=buffer)
+    offset = features.nbytes
+    move_label = np.ndarray((slots, batch_size), dtype=np.int64, buffer=buffer, offset=offset)
+    offset += move_label.nbytes
+    result = np.ndarray((slots, batch_size, 1), dtype=np.float32, buffer=buffer, offset=offset)
+    return [(features[slot], move_label[slot], result[slot]) for slot in range(slots)]
+
+
+# 共有メモリ上のバッチのリングバッファのサイズ(byte)
+def batch_ring_nbytes(slots: int, batch_size: int, features_num: int) -> int:
+    return slots * batch_size * (features_num * 81 * 4 + 8 + 4)
+
+
+# ワーカープロセス(割り当てられた局面からミニバッチを作成し、共有メモリのスロットに書き込む)
+def batch_worker(
+    shm_name: str,
+    slots: int,
+    batch_size: int,
+    features_mode: int,
+    task_queue: multiprocessing.Queue,
+    done_queue: multiprocessing.Queue,
+) -> None:
+    features_setting = FEATURES_SETTINGS[features_mode]
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        views = batch_ring_views(shm.buf, slots, batch_size, features_setting.features_num)
+        board = Board()
+        color = np.empty(batch_size, dtype=np.int32)
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            batch_id, slot, hcpevec = task
+            features, move_label, result = views[slot]
+            fill_batch(board, features_setting, hcpevec, features, move_label, result.reshape(-1), color)
+            done_queue.put((batch_id, slot))
+        del views, features, move_label, result
+    finally:
+        shm.close()
+
+
+class MemmapRecords:
+    """
+    メモリマップした複数の学習データのファイルを、ファイルをまたいだ通し番号で参照する
+
+    ファイルを連結しないため、読み込みは一瞬で終わり、メモリには参照した局面だけが読み込まれる。
+    """
+
+    def __init__(self, arrays: list[np.ndarray]) -> None:
+        self.arrays = arrays
+        self.dtype = arrays[0].dtype
+        # 各ファイルの先頭の局面の通し番号
+        self.offsets = np.cumsum([0] + [len(array) for array in arrays[:-1]])
+        self.size = sum(len(array) for array in arrays)
+
+    def __len__(self) -> int:
+        return self.size
+
+    # 通し番号の局面を取り出す
+    def take(self, indices: np.ndarray) -> np.ndarray:
+        if len(self.arrays) == 1:
+            return self.arrays[0][indices]
+        file_indices = np.searchsorted(self.offsets, indices, side="right") - 1
+        records = np.empty(len(indices), dtype=self.dtype)
+        for file_index in np.unique(file_indices):
+            mask = file_indices == file_index
+            records[mask] = self.arrays[file_index][indices[mask] - self.offsets[file_index]]
+        return records
+
 
 class HcpeDataLoader:
     def __init__(
@@ -21,15 +186,45 @@ class HcpeDataLoader:
         shuffle: bool = False,
         features_mode: int = 0,
         limit: Optional[int] = None,
+        workers: int = 0,
+        prefetch: int = DEFAULT_PREFETCH,
+        seed: Optional[int] = None,
+        mmap: bool = False,
+        probe: bool = False,
+        stream: bool = False,
+        shuffle_buffer: int = DEFAULT_SHUFFLE_BUFFER,
+        read_ahead: int = DEFAULT_READ_AHEAD,
+        files_in_flight: int = DEFAULT_FILES_IN_FLIGHT,
     ) -> None:
         self.logging = Logger("hcpe dataloder").get_logger()
         self.batch_size = batch_size
         self.device = device
         self.shuffle = shuffle
         self.limit = limit
+        # シャッフルの乱数(シードを指定した場合はバッチの順序が毎回同じになる)
+        self.rng = np.random.default_rng(seed)
+        # ワーカープロセス(0の場合はスレッドで1バッチ先読みする)
+        self.workers = workers
+        self.prefetch = max(1, prefetch)
+        self.processes: list[multiprocessing.Process] = []
+        self.shm: Optional[shared_memory.SharedMemory] = None
+        # ファイルをメモリマップし、局面の代わりに通し番号の配列をシャッフルする
+        self.mmap = mmap or stream
+        self.records: Optional[MemmapRecords] = None
+        self.indices: Optional[np.ndarray] = None
+        # sample()で毎回同じ局面のバッチ(最初に1度だけ作成して保持する)を返す
+        self.probe = probe
+        self.probe_batch: Optional[tuple[torch.Tensor, torch.Tensor, torch.Tensor]] = None
+        # ファイルを先頭から順に読み、シャッフルバッファで局所的にシャッフルする
+        self.stream = stream
+        self.shuffle_buffer = max(batch_size, shuffle_buffer)
+        self.read_ahead = max(1, read_ahead)
+        self.files_in_flight = max(1, files_in_flight)
+        self.stream_hcpevecs: Optional[Iterator[np.ndarray]] = None
+        self.features_mode = features_mode
+        self.features_settings = FEATURES_SETTINGS[features_mode]
         self.load(files)
 
-        self.features_settings = FEATURES_SETTINGS[features_mode]
         self.torch_features = torch.empty(
             (batch_size, self.features_settings.features_num, 9, 9),
             dtype=torch.float32,
@@ -41,13 +236,21 @@ class HcpeDataLoader:
         self.features = self.torch_features.numpy()
         self.move_label = self.torch_move_label.numpy()
         self.result = self.torch_result.numpy().reshape(-1)
+        self.color = np.empty(batch_size, dtype=np.int32)
 
         self.i = 0
-        self.l = 0
+        self.f: Optional[Future] = None
         self.executor = ThreadPoolExecutor(max_workers=1)
 
         self.board = Board()
 
+        # 次に返すバッチの番号と、作成を依頼したバッチの番号
+        self.next_batch_id = 0
+        self.submitted_batch_id = 0
+        # 作成済みのバッチ(バッチの番号 → スロット)
+        self.ready_slots: dict[int, int] = {}
+        self.free_slots: list[int] = []
+
     def load(self, files: Union[list[str], tuple[str], str]) -> None:
         data = []
         if isinstance(files, str):
@@ -55,70 +258,282 @@ class HcpeDataLoader:
         for path in files:
             if os.path.exists(path):
                 logging.info(path)
-                data.append(np.fromfile(path, dtype=HuffmanCodedPosAndEval))
+                if path.endswith(PACKED_FEATURES_EXTENSION):
+                    data.append(self.load_packed_features(path))
+                elif self.mmap:
+                    data.append(np.memmap(path, dtype=HuffmanCodedPosAndEval, mode="r"))
+                else:
+                    data.append(np.fromfile(path, dtype=HuffmanCodedPosAndEval))
             else:
                 logging.warn("{} not found, skipping".format(path))
 
+        if self.stream:
+            self.records = MemmapRecords(data)
+            return
+        if self.mmap:
+            self.load_indices(data)
+            return
+
         self.data = np.concatenate(data)
 
         if self.limit is not None:
             if self.shuffle:
-                np.random.shuffle(self.data)
+                self.rng.shuffle(self.data)
             self.data = self.data[: self.limit]
 
-    def mini_batch(self, hcpevec: np.ndarray) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
-        self.features.fill(0)
-        for i, hcpe in enumerate(hcpevec):
-            self.board.set_hcp(hcpe["hcp"])  # ボードを設定
-            self.features_settings.make_features(self.board, self.features[i])  # 入力特徴量の作成
-            self.move_label[i] = make_move_label(hcpe["bestMove16"], self.board.turn)  # 正解データ方策
-            self.result[i] = make_result(hcpe["gameResult"], self.board.turn)  # 正解データ価値
+    # メモリマップしたファイルの局面の通し番号の配列を作成する
+    def load_indices(self, data: list[np.ndarray]) -> None:
+        self.records = MemmapRecords(data)
+        # 通し番号は局面数に応じて小さい型で持つ(1局面あたり4byte)
+        dtype = np.uint32 if len(self.records) <= np.iinfo(np.uint32).max else np.int64
+        self.indices = np.arange(len(self.records), dtype=dtype)
+        if self.limit is not None:
+            if self.shuffle:
+                self.rng.shuffle(self.indices)
+            self.indices = self.indices[: self.limit]
+
+    # 入力特徴量を詰めた学習データを読み込む(入力特徴量のモードが一致するか確認する)
+    def load_packed_features(self, path: str) -> np.ndarray:
+        records = np.load(path, mmap_mode="r" if self.mmap else None)
+        metadata = load_packed_features_metadata(path)
+        if metadata["features_mode"] != self.features_mode or records.dtype != packed_features_dtype(
+            self.features_settings.features_num
+        ):
+            raise ValueError("{} was not preprocessed with input features mode {}".format(path, self.features_mode))
+        return records
 
+    # ミニバッチをデバイスに転送する(CPUの場合はバッファを再利用するためコピーする)
+    def to_device(
+        self, features: torch.Tensor, move_label: torch.Tensor, result: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         if self.device.type == "cpu":
             return (
-                self.torch_features.clone(),
-                self.torch_move_label.clone(),
-                self.torch_result.clone(),
+                features.clone(),
+                move_label.clone(),
+                result.clone(),
             )
         else:
             return (
-                self.torch_features.to(self.device),
-                self.torch_move_label.to(self.device),
-                self.torch_result.to(self.device),
+                features.to(self.device),
+                move_label.to(self.device),
+                result.to(self.device),
             )
 
+    def mini_batch(self, hcpevec: np.ndarray) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        fill_batch(self.board, self.features_settings, hcpevec, self.features, self.move_label, self.result, self.color)
+        return self.to_device(self.torch_features, self.torch_move_label, self.torch_result)
+
+    # ランダムに選んだバッチサイズ分の局面(非復元抽出)
+    # 局面ではなく通し番号を選ぶため、局面数が十分多ければ計算量はバッチサイズに比例する
+    def sample_hcpevec(self) -> np.ndarray:
+        indices = np.sort(self.rng.choice(len(self), self.batch_size, replace=False))
+        if self.records is not None:
+            return self.records.take(self.indices[indices] if self.indices is not None else indices)
+        return self.data[indices]
+
     def sample(self) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
-        return self.mini_batch(np.random.choice(self.data, self.batch_size, replace=False))
+        if self.probe:
+            if self.probe_batch is None:
+                self.probe_batch = self.mini_batch(self.sample_hcpevec())
+            return self.probe_batch
+        return self.mini_batch(self.sample_hcpevec())
 
-    def pre_fetch(self) -> None:
-        hcpevec = self.data[self.i : self.i + self.batch_size]
+    # 次のバッチの局面(バッチサイズに満たない場合はNone)
+    def next_hcpevec(self) -> Optional[np.ndarray]:
+        if self.stream_hcpevecs is not None:
+            return self.next_stream_hcpevec()
+        if self.records is not None:
+            hcpevec = self.records.take(self.indices[self.i : self.i + self.batch_size])
+        else:
+            hcpevec = self.data[self.i : self.i + self.batch_size]
         self.i += self.batch_size
         if len(hcpevec) < self.batch_size:
             self.logging.debug("len(hcpevec) < self.batch_size")
+            return None
+        return hcpevec
+
+    def next_stream_hcpevec(self) -> Optional[np.ndarray]:
+        if self.limit is not None and self.i + self.batch_size > self.limit:
+            return None
+        hcpevec = next(self.stream_hcpevecs, None)
+        self.i += self.batch_size
+        return hcpevec
+
+    # ファイルを先頭から順にread_ahead局面ずつ読み込む
+    # 同時にfiles_in_flight個のファイルを開き、シャッフルする場合はどのファイルから読むかをランダムに選ぶ
+    def read_chunks(self) -> Iterator[np.ndarray]:
+        arrays = self.records.arrays
+        order = self.rng.permutation(len(arrays)) if self.shuffle else range(len(arrays))
+        pending = deque(arrays[i] for i in order)
+        # 読み込み中のファイル([配列, 次に読む位置])
+        in_flight: list[list] = []
+        while pending or in_flight:
+            while pending and len(in_flight) < self.files_in_flight:
+                in_flight.append([pending.popleft(), 0])
+            k = self.rng.integers(len(in_flight)) if self.shuffle else 0
+            array, position = in_flight[k]
+            yield np.array(array[position : position + self.read_ahead])
+            position += self.read_ahead
+            if position >= len(array):
+                in_flight.pop(k)
+            else:
+                in_flight[k][1] = position
+
+    # 読み込んだ局面をシャッフルバッファに通してバッチサイズずつ返す
+    # バッファが一杯になった後は、バッファからランダムに選んだ局面を返し、空いた場所に読み込んだ局面を入れる
+    def stream_batches(self) -> Iterator[np.ndarray]:
+        # 構造体の配列のままよりも速いため、バッファ内では局面をバイト列として扱う
+        dtype = self.records.dtype
+        void_dtype = np.dtype((np.void, dtype.itemsize))
+        buffer = np.empty(self.shuffle_buffer if self.shuffle else 0, dtype=void_dtype)
+        filled = 0
+        incoming = np.empty(0, dtype=void_dtype)
+        for chunk in self.read_chunks():
+            chunk = chunk.view(void_dtype)
+            # バッファが一杯になるまで詰める
+            size = min(len(chunk), len(buffer) - filled)
+            buffer[filled : filled + size] = chunk[:size]
+            filled += size
+            incoming = np.concatenate((incoming, chunk[size:]))
+            while len(incoming) >= self.batch_size:
+                if not self.shuffle:
+                    yield incoming[: self.batch_size].view(dtype)
+                else:
+                    indices = self.rng.choice(len(buffer), self.batch_size, replace=False)
+                    yield buffer[indices].view(dtype)
+                    buffer[indices] = incoming[: self.batch_size]
+                incoming = incoming[self.batch_size :]
+
+        # 読み終わったらバッファに残った局面をシャッフルして返す
+        rest = np.concatenate((buffer[:filled], incoming))
+        if self.shuffle:
+            self.rng.shuffle(rest)
+        for i in range(0, len(rest) - self.batch_size + 1, self.batch_size):
+            yield rest[i : i + self.batch_size].view(dtype)
+
+    def pre_fetch(self) -> None:
+        hcpevec = self.next_hcpevec()
+        self.f = self.executor.submit(self.mini_batch, hcpevec) if hcpevec is not None else None
+
+    # ワーカープロセスと共有メモリのリングバッファを作成する
+    def start_workers(self) -> None:
+        if self.processes:
             return
-        # if len(hcpevec) <= 0:
-        #    return
+        nbytes = batch_ring_nbytes(self.prefetch, self.batch_size, self.features_settings.features_num)
+        self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.slot_views = [
+            tuple(torch.from_numpy(view) for view in views)
+            for views in batch_ring_views(
+                self.shm.buf, self.prefetch, self.batch_size, self.features_settings.features_num
+            )
+        ]
+        self.task_queue: multiprocessing.Queue = multiprocessing.Queue()
+        self.done_queue: multiprocessing.Queue = multiprocessing.Queue()
+        for _ in range(self.workers):
+            process = multiprocessing.Process(
+                target=batch_worker,
+                args=(
+                    self.shm.name,
+                    self.prefetch,
+                    self.batch_size,
+                    self.features_mode,
+                    self.task_queue,
+                    self.done_queue,
+                ),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+        self.free_slots = list(range(self.prefetch))
+
+    # ワーカープロセスを終了する
+    def close(self) -> None:
+        if self.processes:
+            for _ in self.processes:
+                self.task_queue.put(None)
+            for process in self.processes:
+                process.join()
+            self.processes = []
+        if self.shm is not None:
+            self.slot_views = []
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __del__(self) -> None:
+        self.close()
+
+    # 空いているスロットにバッチの作成を依頼する
+    def submit_batches(self) -> None:
+        while self.free_slots:
+            hcpevec = self.next_hcpevec()
+            if hcpevec is None:
+                return
+            self.task_queue.put((self.submitted_batch_id, self.free_slots.pop(), hcpevec))
+            self.submitted_batch_id += 1
 
-        self.f = self.executor.submit(self.mini_batch, hcpevec)
+    # 作成中のバッチをすべて受け取り、スロットを空ける
+    def drain_batches(self) -> None:
+        while len(self.ready_slots) < self.submitted_batch_id - self.next_batch_id:
+            batch_id, slot = self.done_queue.get()
+            self.ready_slots[batch_id] = slot
+        self.free_slots.extend(self.ready_slots.values())
+        self.ready_slots.clear()
+        self.next_batch_id = self.submitted_batch_id
 
     def __len__(self) -> int:
+        if self.stream:
+            return len(self.records) if self.limit is None else min(len(self.records), self.limit)
+        if self.indices is not None:
+            return len(self.indices)
         return len(self.data)
 
     def __iter__(self) -> "HcpeDataLoader":
         self.i = 0
-        self.l = 0
-        if self.shuffle:
-            np.random.shuffle(self.data)
-        self.pre_fetch()
+        if self.workers > 0:
+            self.start_workers()
+            self.drain_batches()
+        if self.stream:
+            self.stream_hcpevecs = self.stream_batches()
+        elif self.shuffle:
+            if self.indices is not None:
+                self.rng.shuffle(self.indices)
+            else:
+                self.rng.shuffle(self.data)
+        if self.workers > 0:
+            self.submit_batches()
+        else:
+            self.pre_fetch()
         return self
 
     def __next__(self) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
-        if self.l > len(self.data):
+        if self.workers > 0:
+            return self.next_from_workers()
+
+        if self.f is None:
             raise StopIteration()
 
         result = self.f.result()
-        self.l = self.i
         self.pre_fetch()
 
         return result
+
+    # ワーカープロセスが作成したバッチを順番通りに受け取る
+    def next_from_workers(self) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        if self.next_batch_id == self.submitted_batch_id:
+            raise StopIteration()
+
+        while self.next_batch_id not in self.ready_slots:
+            batch_id, slot = self.done_queue.get()
+            self.ready_slots[batch_id] = slot
+        slot = self.ready_slots.pop(self.next_batch_id)
+        self.next_batch_id += 1
+
+        result = self.to_device(*self.slot_views[slot])
+
+        # 空いたスロットで次のバッチの作成を依頼する
+        self.free_slots.append(slot)
+        self.submit_batches()
+
+        return result
         # dlshogi 1/6
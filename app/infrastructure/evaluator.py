@@ -0,0 +1,374 @@
+import numpy as np
+import onnxruntime
+import torch
+from concurrent.futures import Future
+from typing import Any, Optional
+
+from cshogi import Board
+from app.domain.features import MAX_LEGAL_MOVES, FeaturesSetting
+from app.domain.policy_value_network import PolicyValueNetwork
+from app.infrastructure.batch_evaluator import BatchEvaluator
+from app.infrastructure.inference_backend import (
+    INFERENCE_BACKEND_COMPILE,
+    INFERENCE_BACKEND_EAGER,
+    INFERENCE_BACKEND_SCRIPT,
+    compile_cache_path,
+    compile_model,
+    save_compile_cache,
+)
+from app.infrastructure.model_file import is_inference_model, load_model_file
+from app.infrastructure.precision import DEFAULT_PRECISION, autocast
+from app.infrastructure.quantization import is_quantized_model_file, load_quantized_model
+
+# 推論のバックエンド
+BACKEND_EAGER = INFERENCE_BACKEND_EAGER  # PyTorchのモデルをそのまま実行する
+BACKEND_SCRIPT = INFERENCE_BACKEND_SCRIPT  # TorchScriptに変換してfreezeする
+BACKEND_COMPILE = INFERENCE_BACKEND_COMPILE  # torch.compileでカーネルを融合する
+BACKEND_ONNXRUNTIME = "onnxruntime"  # export-onnxで出力したONNXモデルをONNX Runtime(CPU)で実行する
+BACKENDS = [BACKEND_EAGER, BACKEND_SCRIPT, BACKEND_COMPILE, BACKEND_ONNXRUNTIME]
+DEFAULT_BACKEND = BACKEND_EAGER
+
+# 推論のスレッド数(0はライブラリのデフォルト)
+DEFAULT_INTRA_OP_THREADS = 0
+DEFAULT_INTER_OP_THREADS = 0
+# ONNX Runtimeのグラフ最適化のレベル
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+DEFAULT_GRAPH_OPTIMIZATION_LEVEL = "all"
+
+
+def check_backend(backend: str) -> str:
+    if backend not in BACKENDS:
+        raise ValueError("unknown backend {} (choose from {})".format(backend, ", ".join(BACKENDS)))
+    return backend
+
+
+def check_graph_optimization_level(level: str) -> str:
+    if level not in GRAPH_OPTIMIZATION_LEVELS:
+        raise ValueError(
+            "unknown graph optimization level {} (choose from {})".format(level, ", ".join(GRAPH_OPTIMIZATION_LEVELS))
+        )
+    return level
+
+
+# 方策のロジットから合法手のロジットを集め、温度パラメータを適用したsoftmaxで確率にする(合法手の数以降は0)
+def softmax_legal_moves(
+    policy_logits: np.ndarray, move_labels: np.ndarray, legal_moves_num: np.ndarray, temperature: float
+) -> np.ndarray:
+    logits = np.take_along_axis(policy_logits, move_labels.astype(np.intp), axis=1)
+    logits /= temperature
+    logits[np.arange(move_labels.shape[1]) >= legal_moves_num[:, None]] = -np.inf
+    # オーバーフローを防止するため最大値で引く
+    logits -= logits.max(axis=1, keepdims=True)
+    np.exp(logits, out=logits)
+    logits /= logits.sum(axis=1, keepdims=True)
+    return logits
+
+
+# softmax_legal_movesを推論デバイス上で行う
+def softmax_legal_moves_tensor(
+    policy_logits: torch.Tensor, move_labels: torch.Tensor, legal_moves_num: torch.Tensor, temperature: float
+) -> torch.Tensor:
+    logits = torch.gather(policy_logits, 1, move_labels) / temperature
+    mask = torch.arange(move_labels.shape[1], device=move_labels.device) >= legal_moves_num[:, None]
+    return torch.softmax(logits.masked_fill(mask, -torch.inf), dim=1)
+
+
+class Evaluator:
+    """
+    ニューラルネットワークで局面を評価する(推論のバックエンドごとに実装する)
+
+    入力特徴量の配列の確保と作成、推論、推論スレッドによる複数の探索スレッドの推論要求のとりまとめ、
+    推論のスレッド数の設定を受け持つ。
+    探索はinit_inputs()で確保した配列にmake_input_features()で局面を、set_move_labels()で合法手のラベルを書き込み、
+    infer_legal_moves()(推論スレッドを使う場合はsubmit())で合法手の確率と勝率を受け取る。
+    合法手の確率は局面ごとに合法手の数だけ先頭から並び、大きさはバッチ内の合法手の最大数になる。
+    """
+
+    def __init__(
+        self,
+        features_setting: FeaturesSetting,
+        activation_function_mode: int = 0,
+        gpu_id: int = -1,
+        precision: str = DEFAULT_PRECISION,
+        intra_op_threads: int = DEFAULT_INTRA_OP_THREADS,
+        inter_op_threads: int = DEFAULT_INTER_OP_THREADS,
+        graph_optimization_level: str = DEFAULT_GRAPH_OPTIMIZATION_LEVEL,
+        temperature: float = 1.0,
+    ) -> None:
+        self.features_setting = features_setting
+        self.activation_function_mode = activation_function_mode
+        self.gpu_id = gpu_id
+        # 推論の数値精度(PyTorchのバックエンドのみ)
+        self.precision = precision
+        # 演算内の並列化のスレッド数
+        self.intra_op_threads = intra_op_threads
+        # 独立した演算を並列に実行するスレッド数
+        self.inter_op_threads = inter_op_threads
+        # グラフ最適化のレベル(ONNX Runtimeのみ)
+        self.graph_optimization_level = check_graph_optimization_level(graph_optimization_level)
+        # 方策の温度パラメータ
+        self.temperature = temperature
+        # 複数の探索スレッドの推論要求をまとめる推論スレッド
+        self.batch_evaluator: Optional[BatchEvaluator] = None
+
+    # モデルを読み込む
+    def load(self, modelfile: str) -> None:
+        raise NotImplementedError
+
+    # 探索で使うバッチサイズで推論しておく(コンパイルするバックエンドのみ)
+    def warmup(self, batch_sizes: list[int]) -> None:
+        pass
+
+    # 入力特徴量の配列を確保する
+    def init_features(self, batch_size: int) -> Any:
+        return np.zeros((batch_size, self.features_setting.features_num, 9, 9), dtype=np.float32)
+
+    # 合法手のラベルと合法手の数の配列を確保する(ラベルは局面ごとに合法手の数だけ先頭から使う)
+    def init_move_labels(self, batch_size: int) -> tuple[Any, Any]:
+        return np.zeros((batch_size, MAX_LEGAL_MOVES), dtype=np.int16), np.zeros(batch_size, dtype=np.int64)
+
+    # 推論の入力(入力特徴量, 合法手のラベル, 合法手の数)を確保する
+    def init_inputs(self, batch_size: int) -> tuple[Any, Any, Any]:
+        return (self.init_features(batch_size), *self.init_move_labels(batch_size))
+
+    # 入力特徴量のindex番目に局面を書き込む
+    def make_input_features(self, board: Board, features: Any, index: int) -> None:
+        self.features_setting.make_features(board, features[index])
+
+    # 合法手のラベルのindex番目に局面の合法手のラベルを書き込む
+    def set_move_labels(self, move_labels: Any, legal_moves_num: Any, index: int, labels: np.ndarray) -> None:
+        move_labels[index, : len(labels)] = labels
+        legal_moves_num[index] = len(labels)
+
+    # 入力特徴量の先頭size局面を推論し、方策のロジットと勝率を返す
+    def infer(self, features: Any, size: int) -> tuple[np.ndarray, np.ndarray]:
+        raise NotImplementedError
+
+    # 推論の入力の先頭size局面を推論し、合法手の確率と勝率を返す
+    def infer_legal_moves(self, inputs: tuple[Any, Any, Any], size: int) -> tuple[np.ndarray, np.ndarray]:
+        features, move_labels, legal_moves_num = inputs
+        policy_logits, values = self.infer(features, size)
+        max_legal_moves = int(legal_moves_num[:size].max())
+        probabilities = softmax_legal_moves(
+            policy_logits, move_labels[:size, :max_legal_moves], legal_moves_num[:size], self.temperature
+        )
+        return probabilities, values
+
+    # 推論スレッドを起動する(max_batch_sizeはまとめたバッチの最大の大きさ)
+    def start(self, max_batch_size: int) -> None:
+        self.stop()
+        self.batch_evaluator = BatchEvaluator(self.infer_legal_moves, self.init_inputs(max_batch_size), max_batch_size)
+        self.batch_evaluator.start()
+
+    # 推論スレッドに推論要求を追加する(結果は合法手の確率と勝率)
+    def submit(self, inputs: tuple[Any, Any, Any], size: int) -> Future:
+        if self.batch_evaluator is None:
+            raise ValueError("batch evaluator is not started")
+        return self.batch_evaluator.submit(inputs, size)
+
+    def stop(self) -> None:
+        if self.batch_evaluator is not None:
+            self.batch_evaluator.stop()
+            self.batch_evaluator = None
+
+
+class TorchEvaluator(Evaluator):
+    """PyTorchのモデルをそのまま実行する(quantizeコマンドで作成したINT8量子化モデルも読み込める)"""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.device = torch.device(f"cuda:{self.gpu_id}") if self.gpu_id >= 0 else torch.device("cpu")
+        self.model: Optional[torch.nn.Module] = None
+        if self.intra_op_threads > 0:
+            torch.set_num_threads(self.intra_op_threads)
+        if self.inter_op_threads > 0:
+            # 並列処理を始めた後は変更できない
+            try:
+                torch.set_num_interop_threads(self.inter_op_threads)
+            except RuntimeError:
+                pass
+
+    def load(self, modelfile: str) -> None:
+        # quantizeコマンドで作成したINT8量子化モデル
+        if is_quantized_model_file(modelfile):
+            self.model, metadata = load_quantized_model(modelfile)
+            self.check_model_metadata(metadata)
+            # 量子化した演算はCPUでのみ実行できる
+            self.device = torch.device("cpu")
+            return
+
+        # train()のチェックポイント、またはexportコマンドで作成した推論専用のモデルファイル
+        checkpoint = load_model_file(modelfile, self.device)
+        fused_batch_norm = False
+        if is_inference_model(checkpoint):
+            self.check_model_metadata(checkpoint)
+            fused_batch_norm = checkpoint["fused_batch_norm"]
+        self.model = PolicyValueNetwork(
+            input_features=self.features_setting.features_num,
+            activation_function_mode=self.activation_function_mode,
+            fused_batch_norm=fused_batch_norm,
+        )
+        # メモリマップしたパラメータをコピーせずにそのまま使う
+        self.model.load_state_dict(checkpoint["model"], assign=True)
+        self.model.to(self.device)
+        # モデルを評価モードにする
+        self.model.eval()
+
+    # モデルファイルに記録された入力特徴量の数と活性化関数が、エンジンの設定と一致するか確認する
+    def check_model_metadata(self, metadata: dict) -> None:
+        if metadata["features_num"] != self.features_setting.features_num:
+            raise ValueError(
+                "the model expects {} input features, but the features mode has {}".format(
+                    metadata["features_num"], self.features_setting.features_num
+                )
+            )
+        if metadata["activation_function_mode"] != self.activation_function_mode:
+            raise ValueError(
+                "the model was exported with activation function mode {}, but the engine uses {}".format(
+                    metadata["activation_function_mode"], self.activation_function_mode
+                )
+            )
+
+    def init_features(self, batch_size: int) -> torch.Tensor:
+        return torch.empty(
+            (batch_size, self.features_setting.features_num, 9, 9),
+            dtype=torch.float32,
+            pin_memory=(self.device.type == "cuda"),
+        )
+
+    def init_move_labels(self, batch_size: int) -> tuple[torch.Tensor, torch.Tensor]:
+        pin_memory = self.device.type == "cuda"
+        return (
+            torch.zeros((batch_size, MAX_LEGAL_MOVES), dtype=torch.int16, pin_memory=pin_memory),
+            torch.zeros(batch_size, dtype=torch.int64, pin_memory=pin_memory),
+        )
+
+    def make_input_features(self, board: Board, features: torch.Tensor, index: int) -> None:
+        self.features_setting.make_features(board, features.numpy()[index])
+
+    def set_move_labels(
+        self, move_labels: torch.Tensor, legal_moves_num: torch.Tensor, index: int, labels: np.ndarray
+    ) -> None:
+        super().set_move_labels(move_labels.numpy(), legal_moves_num.numpy(), index, labels)
+
+    def infer(self, features: torch.Tensor, size: int) -> tuple[np.ndarray, np.ndarray]:
+        with torch.no_grad(), autocast(self.device, self.precision):
+            if self.model is None:
+                raise ValueError("model is None")
+            x = features[0:size].to(self.device)
+            policy_logits, value_logits = self.model(x)
+            # bf16の場合も結果はfloat32で返す
+            return policy_logits.float().cpu().numpy(), torch.sigmoid(value_logits.float()).cpu().numpy()
+
+    # 合法手の確率を推論デバイス上で求め、バッチ全体の方策のロジットの代わりに合法手の確率だけをコピーする
+    def infer_legal_moves(
+        self, inputs: tuple[torch.Tensor, torch.Tensor, torch.Tensor], size: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        features, move_labels, legal_moves_num = inputs
+        max_legal_moves = int(legal_moves_num[:size].max())
+        with torch.no_grad():
+            with autocast(self.device, self.precision):
+                if self.model is None:
+                    raise ValueError("model is None")
+                x = features[0:size].to(self.device)
+                policy_logits, value_logits = self.model(x)
+            probabilities = softmax_legal_moves_tensor(
+                policy_logits.float(),
+                move_labels[0:size, 0:max_legal_moves].to(self.device).long(),
+                legal_moves_num[0:size].to(self.device),
+                self.temperature,
+            )
+            return probabilities.cpu().numpy(), torch.sigmoid(value_logits.float()).cpu().numpy()
+
+
+class CompiledTorchEvaluator(TorchEvaluator):
+    """PyTorchのモデルをTorchScript、もしくはtorch.compileで変換してから実行する(変換結果はディスクにキャッシュする)"""
+
+    def __init__(self, backend: str, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.backend = backend
+        self.cache_path: Optional[str] = None
+
+    def load(self, modelfile: str) -> None:
+        super().load(modelfile)
+        # INT8量子化モデルは変換済み
+        if isinstance(self.model, torch.jit.ScriptModule):
+            return
+        self.cache_path = compile_cache_path(
+            modelfile,
+            self.backend,
+            self.device,
+            self.features_setting.features_num,
+            self.activation_function_mode,
+            self.precision,
+        )
+        self.model = compile_model(self.model, self.backend, self.device, self.cache_path)
+
+    def warmup(self, batch_sizes: list[int]) -> None:
+        features = self.init_features(max(batch_sizes))
+        features.zero_()
+        for batch_size in batch_sizes:
+            for _ in range(2):
+                self.infer(features, batch_size)
+        if self.cache_path is not None:
+            save_compile_cache(self.backend, self.cache_path)
+
+
+class OnnxRuntimeEvaluator(Evaluator):
+    """export-onnxで出力したONNXモデルをONNX Runtime(CPU)で実行する"""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.session: Optional[onnxruntime.InferenceSession] = None
+
+    def load(self, modelfile: str) -> None:
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = self.intra_op_threads
+        options.inter_op_num_threads = self.inter_op_threads
+        # 独立した演算がある場合のみ、演算を並列に実行する
+        if self.inter_op_threads > 1:
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+        options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[self.graph_optimization_level]
+        self.session = onnxruntime.InferenceSession(modelfile, options, providers=["CPUExecutionProvider"])
+
+        features_num = self.session.get_inputs()[0].shape[1]
+        if features_num != self.features_setting.features_num:
+            raise ValueError(
+                "the model expects {} input features, but the features mode has {}".format(
+                    features_num, self.features_setting.features_num
+                )
+            )
+
+    # 推論(IO Bindingで入力特徴量の配列の先頭size局面をコピーせずにONNX Runtimeの入力にする)
+    def infer(self, features: np.ndarray, size: int) -> tuple[np.ndarray, np.ndarray]:
+        if self.session is None:
+            raise ValueError("session is None")
+        io_binding = self.session.io_binding()
+        io_binding.bind_input(
+            "input",
+            device_type="cpu",
+            device_id=0,
+            element_type=np.float32,
+            shape=(size,) + features.shape[1:],
+            buffer_ptr=features.ctypes.data,
+        )
+        io_binding.bind_output("output_policy")
+        io_binding.bind_output("output_value")
+        self.session.run_with_iobinding(io_binding)
+        policy_logits, values = io_binding.copy_outputs_to_cpu()
+        return policy_logits, values
+
+
+# バックエンドの評価器を作成する
+def create_evaluator(backend: str, *args: Any, **kwargs: Any) -> Evaluator:
+    check_backend(backend)
+    if backend == BACKEND_ONNXRUNTIME:
+        return OnnxRuntimeEvaluator(*args, **kwargs)
+    if backend in (BACKEND_SCRIPT, BACKEND_COMPILE):
+        return CompiledTorchEvaluator(backend, *args, **kwargs)
+    return TorchEvaluator(*args, **kwargs)
@@ -0,0 +1,54 @@
+import hashlib
+import io
+import os
+import torch
+
+# モデルの変換方法
+INFERENCE_BACKEND_EAGER = "eager"  # 変換しない
+INFERENCE_BACKEND_SCRIPT = "script"  # TorchScriptに変換してfreezeする
+INFERENCE_BACKEND_COMPILE = "compile"  # torch.compileでカーネルを融合する
+
+
+# コンパイル結果のキャッシュファイルのパス(モデルファイルの隣に置き、モデルや実行環境が変わると別のファイルになる)
+def compile_cache_path(modelfile: str, backend: str, device: torch.device, *keys: object) -> str:
+    stat = os.stat(modelfile)
+    key = "|".join(str(k) for k in [backend, stat.st_size, stat.st_mtime_ns, device, torch.__version__, *keys])
+    return "{}.{}-{}.cache".format(modelfile, backend, hashlib.blake2b(key.encode(), digest_size=8).hexdigest())
+
+
+# 途中で中断しても壊れたキャッシュが残らないように、一時ファイルに書いてから置き換える
+def write_cache(path: str, data: bytes) -> None:
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+# モデルを推論用に変換する(キャッシュがあれば変換せずに読み込む)
+def compile_model(model: torch.nn.Module, backend: str, device: torch.device, cache_path: str) -> torch.nn.Module:
+    model.eval()
+    if backend == INFERENCE_BACKEND_SCRIPT:
+        if os.path.exists(cache_path):
+            return torch.jit.load(cache_path, map_location=device)
+        scripted = torch.jit.freeze(torch.jit.script(model))
+        buffer = io.BytesIO()
+        torch.jit.save(scripted, buffer)
+        write_cache(cache_path, buffer.getvalue())
+        return scripted
+    if backend == INFERENCE_BACKEND_COMPILE:
+        # 前回のコンパイル結果を読み込んでおくと、torch.compileはコード生成を省略する
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as f:
+                torch.compiler.load_cache_artifacts(f.read())
+        # 探索中のバッチサイズは毎回変わるため、バッチサイズを可変にしてコンパイルする
+        return torch.compile(model, dynamic=True)
+    return model
+
+
+# ウォームアップ後に、torch.compileのコンパイル結果をキャッシュファイルに保存する
+def save_compile_cache(backend: str, cache_path: str) -> None:
+    if backend != INFERENCE_BACKEND_COMPILE or os.path.exists(cache_path):
+        return
+    artifacts = torch.compiler.save_cache_artifacts()
+    if artifacts is not None:
+        write_cache(cache_path, artifacts[0])
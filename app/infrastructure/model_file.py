@@ -0,0 +1,31 @@
+import torch
+from typing import Union
+
+# exportコマンドで作成する推論専用のモデルファイルの形式(train()のチェックポイントと区別する)
+INFERENCE_MODEL_FORMAT = "inference"
+
+
+# モデルファイルを読み込む(メモリマップするため、オプティマイザの状態など使わない部分は読み込まない)
+def load_model_file(path: str, device: Union[str, torch.device]) -> dict:
+    return torch.load(path, map_location=device, mmap=True)
+
+
+def is_inference_model(checkpoint: dict) -> bool:
+    return checkpoint.get("format") == INFERENCE_MODEL_FORMAT
+
+
+# 推論専用のモデルファイルを保存する(バッチ正規化を畳み込んだパラメータと、モデルの構成だけを保存する)
+def save_inference_model(
+    model: torch.nn.Module, path: str, features_num: int, activation_function_mode: int, fused_batch_norm: bool
+) -> None:
+    torch.save(
+        {
+            "format": INFERENCE_MODEL_FORMAT,
+            "features_num": features_num,
+            "activation_function_mode": activation_function_mode,
+            "fused_batch_norm": fused_batch_norm,
+            # 他のパラメータと記憶領域を共有するテンソルがあると、そのテンソル全体が保存されるため複製する
+            "model": {name: tensor.detach().cpu().contiguous().clone() for name, tensor in model.state_dict().items()},
+        },
+        path,
+    )
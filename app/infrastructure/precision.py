@@ -0,0 +1,21 @@
+import contextlib
+import torch
+
+# 推論・学習の数値精度
+PRECISION_FP32 = "fp32"
+PRECISION_BF16 = "bf16"
+PRECISIONS = [PRECISION_FP32, PRECISION_BF16]
+DEFAULT_PRECISION = PRECISION_FP32
+
+
+def check_precision(precision: str) -> str:
+    if precision not in PRECISIONS:
+        raise ValueError("unknown precision {} (choose from {})".format(precision, ", ".join(PRECISIONS)))
+    return precision
+
+
+# 数値精度に応じた自動混合精度のコンテキスト(bf16の場合は畳み込みと全結合をbfloat16で計算する)
+def autocast(device: torch.device, precision: str) -> contextlib.AbstractContextManager:
+    if precision == PRECISION_BF16:
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
@@ -0,0 +1,60 @@
+import json
+import zipfile
+import torch
+from typing import Iterable
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+# INT8量子化のバックエンド(x86 CPU向け)
+QUANTIZATION_BACKEND = "x86"
+# 量子化モデルのファイルに埋め込むメタデータの名前
+QUANTIZATION_METADATA = "quantization"
+
+
+# 学習済みモデルを静的量子化する(キャリブレーション用の入力特徴量で各層の値の範囲を観測してからINT8に変換する)
+def quantize_model(model: torch.nn.Module, calibration_batches: Iterable[torch.Tensor]) -> torch.jit.ScriptModule:
+    torch.backends.quantized.engine = QUANTIZATION_BACKEND
+    model.eval()
+    example_inputs = None
+    prepared = None
+    with torch.no_grad():
+        for x in calibration_batches:
+            x = x.cpu()
+            if prepared is None:
+                example_inputs = (x,)
+                prepared = prepare_fx(model, get_default_qconfig_mapping(QUANTIZATION_BACKEND), example_inputs)
+            prepared(x)
+        if prepared is None:
+            raise ValueError("no calibration data")
+        quantized = convert_fx(prepared)
+        # TorchScriptにしてPolicyValueNetworkのクラス定義なしで読み込めるようにする
+        return torch.jit.freeze(torch.jit.trace(quantized, example_inputs))
+
+
+# 量子化モデルを保存する(入力特徴量の数と活性化関数をメタデータとして埋め込む)
+def save_quantized_model(
+    model: torch.jit.ScriptModule, path: str, features_num: int, activation_function_mode: int
+) -> None:
+    metadata = {
+        "backend": QUANTIZATION_BACKEND,
+        "features_num": features_num,
+        "activation_function_mode": activation_function_mode,
+    }
+    torch.jit.save(model, path, _extra_files={QUANTIZATION_METADATA: json.dumps(metadata)})
+
+
+# 量子化モデルのファイルかどうか(train()のチェックポイントはtorch.saveのzipで、量子化のメタデータを含まない)
+def is_quantized_model_file(path: str) -> bool:
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as archive:
+        return any(name.endswith("/extra/" + QUANTIZATION_METADATA) for name in archive.namelist())
+
+
+# 量子化モデルを読み込む(量子化した演算はCPUでのみ実行できる)
+def load_quantized_model(path: str) -> tuple[torch.jit.ScriptModule, dict]:
+    torch.backends.quantized.engine = QUANTIZATION_BACKEND
+    extra_files = {QUANTIZATION_METADATA: ""}
+    model = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+    model.eval()
+    return model, json.loads(extra_files[QUANTIZATION_METADATA])
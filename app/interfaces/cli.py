@@ -4,6 +4,10 @@ from app.domain.features import FEATURES_KIKI, FEATURES_SMALL
 from app.interfaces.logger import Logger
 from app.usecases.train import train_app
 from app.usecases.test import test_app
+from app.usecases.bench import bench_app
+from app.usecases.preprocess import preprocess_app
+from app.usecases.quantize import quantize_app
+from app.usecases.export import export_app
 from app.usecases.mcts_player import MCTSPlayer
 
 cli_app = typer.Typer()
@@ -11,6 +15,10 @@ cli_app = typer.Typer()
 
 cli_app.add_typer(train_app)
 cli_app.add_typer(test_app)
+cli_app.add_typer(bench_app)
+cli_app.add_typer(preprocess_app)
+cli_app.add_typer(quantize_app)
+cli_app.add_typer(export_app)
 
 
 @cli_app.command()
@@ -0,0 +1,578 @@
+import contextlib
+import io
+import random
+import time
+import numpy as np
+import torch
+import typer
+from cshogi import Board
+from typing import Callable, Optional
+from typing_extensions import Annotated
+from app.domain.features import FEATURES_SETTINGS, MAX_LEGAL_MOVES
+from app.domain.policy_value_network import PolicyValueNetwork
+from app.domain.ucb import (
+    MAX_DESCEND_LEVELS,
+    descend_max_ucb_path,
+    descend_max_ucb_path_numpy,
+    make_ucb_scratch,
+    numba,
+)
+from app.domain.uct_node import NULL_NODE, NodePool
+from app.infrastructure.dataloader import HcpeDataLoader
+from app.infrastructure.evaluator import (
+    BACKEND_EAGER,
+    BACKEND_SCRIPT,
+    BACKEND_COMPILE,
+    BACKEND_ONNXRUNTIME,
+    DEFAULT_BACKEND,
+    DEFAULT_INTRA_OP_THREADS,
+    DEFAULT_INTER_OP_THREADS,
+    check_backend,
+    create_evaluator,
+)
+from app.infrastructure.precision import PRECISIONS, check_precision
+from app.interfaces.logger import Logger
+from app.usecases.mcts_player import VIRTUAL_LOSS, EvalBatch, MCTSPlayer
+from app.usecases.test import test_model, report_test_result
+
+bench_app = typer.Typer()
+
+# デフォルトのベンチマーク局面(USIのpositionコマンドの引数)
+DEFAULT_BENCH_POSITIONS = [
+    "startpos",
+    "startpos moves 7g7f 3c3d 2g2f 8c8d 2f2e 8d8e 6i7h 4a3b",
+    "startpos moves 2g2f 8c8d 7g7f 8d8e 8h7g 3c3d 7i8h 2b7g+ 8h7g 3a2b",
+    "sfen l6nl/5+P1gk/2np1S3/p1p4Pp/3P2Sp1/1PPb2P1P/P5GS1/R8/LN4bKL w RGgsn5p 1",
+]
+
+# 推論時間を計測するバッチサイズ
+DEFAULT_LATENCY_BATCH_SIZES = [1, 8, 32, 128, 256]
+
+
+# 1バッチの推論時間の平均(ミリ秒)
+def measure_latency(model: torch.nn.Module, x: torch.Tensor, repeat: int) -> float:
+    with torch.no_grad():
+        # ウォームアップ
+        model(x)
+        begin_time = time.perf_counter()
+        for _ in range(repeat):
+            model(x)
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        return (time.perf_counter() - begin_time) / repeat * 1000
+
+
+# バックエンドで使うモデルファイル(onnxruntimeはexport-onnxで出力したONNXモデルを使う)
+def select_modelfile(backend: str, modelfile: str, onnx_modelfile: Optional[str]) -> str:
+    check_backend(backend)
+    if backend != BACKEND_ONNXRUNTIME:
+        return modelfile
+    if onnx_modelfile is None:
+        raise ValueError("the onnxruntime backend needs --onnx-modelfile")
+    return onnx_modelfile
+
+
+# ベンチマーク局面の盤面
+def make_bench_board(position: str) -> Board:
+    args = position.split("moves")
+    board = Board()
+    sfen = args[0].strip()
+    if sfen[:5] == "sfen ":
+        board.set_sfen(sfen[5:])
+    for usi_move in args[1].split() if len(args) > 1 else []:
+        board.push_usi(usi_move)
+    return board
+
+
+# ベンチマーク局面を読み込む(1行に1局面、USIのpositionコマンドの引数の形式)
+def load_bench_positions(path: Optional[str]) -> list[str]:
+    if path is None:
+        return DEFAULT_BENCH_POSITIONS
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+# 各局面を指定したプレイアウト数だけ探索し、合計のプレイアウト数と探索時間を返す
+def bench_player(player: MCTSPlayer, positions: list[str], nodes: int) -> tuple[int, float]:
+    total_playouts = 0
+    total_time = 0.0
+    for position in positions:
+        args = position.split("moves")
+        player.position(args[0].strip(), args[1].split() if len(args) > 1 else [])
+        player.set_limits(nodes=nodes)
+        # 探索中のinfoの出力は表示しない
+        with contextlib.redirect_stdout(io.StringIO()):
+            begin_time = time.time()
+            player.go()
+            total_time += time.time() - begin_time
+        total_playouts += player.playout_count
+    return total_playouts, total_time
+
+
+@bench_app.command()
+def bench_search(
+    modelfile: Annotated[str, typer.Option("-m", help="model file")] = MCTSPlayer.DEFAULT_MODELFILE,
+    gpu: Annotated[int, typer.Option("-g", help="GPU ID")] = 0,
+    backend: Annotated[
+        list[str], typer.Option(help="inference backend (eager, script, compile, onnxruntime) (repeatable)")
+    ] = [DEFAULT_BACKEND],
+    onnx_modelfile: Annotated[
+        Optional[str], typer.Option(help="ONNX model made by export-onnx for the onnxruntime backend")
+    ] = None,
+    threads: Annotated[list[int], typer.Option(help="number of search threads (repeatable)")] = [1],
+    batchsize: Annotated[list[int], typer.Option("-b", help="batch size per search thread (repeatable)")] = [32],
+    nodes: Annotated[int, typer.Option("-n", help="playouts per position")] = 10000,
+    positions: Annotated[
+        Optional[str], typer.Option(help="file of positions (USI position arguments per line)")
+    ] = None,
+    option: Annotated[list[str], typer.Option("-o", help="extra USI option as name=value (repeatable)")] = [],
+    log: Annotated[Optional[str], typer.Option(help="log file path")] = None,
+    input_features: Annotated[
+        int, typer.Option("-i", help="select custom input features mode (default: 0, kiki: 1, himo: 2)")
+    ] = 0,
+    activation_function: Annotated[
+        int, typer.Option("-a", help="select custom input features mode (relu: 0, : 1)")
+    ] = 0,
+) -> None:
+    """Measure search speed (nps) for each inference backend, number of search threads and batch size"""
+
+    logging = Logger("bench", log_file=log).get_logger()
+    bench_positions = load_bench_positions(positions)
+    logging.info("positions = {}, nodes = {}".format(len(bench_positions), nodes))
+
+    base_nps = None
+    for inference_backend in backend:
+        backend_modelfile = select_modelfile(inference_backend, modelfile, onnx_modelfile)
+        for search_threads in threads:
+            for batch_size in batchsize:
+                player = MCTSPlayer(features_mode=input_features, activation_function_mode=activation_function)
+                player.setoption(["name", "modelfile", "value", backend_modelfile])
+                player.setoption(["name", "gpu_id", "value", str(gpu)])
+                player.setoption(["name", "backend", "value", inference_backend])
+                player.setoption(["name", "search_threads", "value", str(search_threads)])
+                player.setoption(["name", "batchsize", "value", str(batch_size)])
+                player.setoption(["name", "pv_interval", "value", "0"])
+                for name_value in option:
+                    name, value = name_value.split("=", 1)
+                    player.setoption(["name", name, "value", value])
+                # コンパイルとウォームアップの時間(キャッシュがあれば短くなる)
+                begin_time = time.time()
+                player.isready()
+                isready_time = time.time() - begin_time
+
+                playouts, elapsed_time = bench_player(player, bench_positions, nodes)
+                player.quit()
+
+                nps = playouts / elapsed_time if elapsed_time > 0 else 0
+                if base_nps is None:
+                    base_nps = nps
+                logging.info(
+                    "backend = {}, threads = {}, batchsize = {}, isready = {:.2f}s, playouts = {}, time = {:.2f}s, "
+                    "nps = {:.0f}, speedup = {:.2f}x".format(
+                        inference_backend,
+                        search_threads,
+                        batch_size,
+                        isready_time,
+                        playouts,
+                        elapsed_time,
+                        nps,
+                        nps / base_nps if base_nps > 0 else 0,
+                    )
+                )
+
+
+# ベンチマーク局面からランダムに指した1〜max_plies手の経路
+def make_random_paths(boards: list[Board], paths: int, max_plies: int, seed: Optional[int]) -> list[list[int]]:
+    rng = random.Random(seed)
+    random_paths = []
+    for i in range(paths):
+        board = boards[i % len(boards)]
+        path: list[int] = []
+        for _ in range(rng.randint(1, max_plies)):
+            legal_moves = list(board.legal_moves)
+            if not legal_moves:
+                break
+            path.append(rng.choice(legal_moves))
+            board.push(path[-1])
+        for _ in path:
+            board.pop()
+        random_paths.append(path)
+    return random_paths
+
+
+@bench_app.command()
+def bench_playout(
+    paths: Annotated[int, typer.Option(help="Number of random playout paths")] = 2000,
+    max_plies: Annotated[int, typer.Option(help="maximum plies of a playout path")] = 8,
+    repeat: Annotated[int, typer.Option(help="Number of times all paths are played")] = 10,
+    seed: Annotated[Optional[int], typer.Option(help="random seed for the playout paths")] = 0,
+    positions: Annotated[
+        Optional[str], typer.Option(help="file of positions (USI position arguments per line)")
+    ] = None,
+    log: Annotated[Optional[str], typer.Option(help="log file path")] = None,
+) -> None:
+    """Compare the board overhead per playout of copying the root board and of push/pop on one board"""
+
+    logging = Logger("bench", log_file=log).get_logger()
+    boards = [make_bench_board(position) for position in load_bench_positions(positions)]
+    random_paths = make_random_paths(boards, paths, max_plies, seed)
+    logging.info(
+        "paths = {}, average plies = {:.2f}".format(
+            len(random_paths), sum(len(path) for path in random_paths) / max(1, len(random_paths))
+        )
+    )
+
+    # プレイアウトごとにルート局面をコピーして指す
+    begin_time = time.perf_counter()
+    for _ in range(repeat):
+        for i, path in enumerate(random_paths):
+            board = boards[i % len(boards)].copy()
+            for move in path:
+                board.push(move)
+    copy_time = (time.perf_counter() - begin_time) / (repeat * len(random_paths))
+
+    # 1つの盤面で指して、経路の手数だけ戻す
+    begin_time = time.perf_counter()
+    for _ in range(repeat):
+        for i, path in enumerate(random_paths):
+            board = boards[i % len(boards)]
+            for move in path:
+                board.push(move)
+            for _ in range(len(path)):
+                board.pop()
+    push_pop_time = (time.perf_counter() - begin_time) / (repeat * len(random_paths))
+
+    logging.info(
+        "copy + push = {:.2f}us/playout, push + pop = {:.2f}us/playout, speedup = {:.2f}x".format(
+            copy_time * 1e6, push_pop_time * 1e6, copy_time / push_pop_time if push_pop_time > 0 else 0
+        )
+    )
+
+
+# バッチの推論結果をノードごとにset_node_evalで書き込む(set_eval_resultsの比較用)
+def set_eval_results_per_node(
+    player: MCTSPlayer, batch: EvalBatch, legal_move_probabilities: np.ndarray, values: np.ndarray
+) -> None:
+    pool = player.tree.pool
+    for i, value in enumerate(values):
+        node = batch.eval_queue[i].node
+        player.set_node_eval(node, legal_move_probabilities[i, : pool.child_num.item(node)], float(value))
+
+
+@bench_app.command()
+def bench_eval_results(
+    batchsize: Annotated[int, typer.Option("-b", help="batch size")] = 256,
+    max_plies: Annotated[int, typer.Option(help="maximum plies from a bench position to an evaluated position")] = 8,
+    repeat: Annotated[int, typer.Option(help="Number of times the results of a batch are written")] = 100,
+    seed: Annotated[Optional[int], typer.Option(help="random seed for the positions and results")] = 0,
+    positions: Annotated[
+        Optional[str], typer.Option(help="file of positions (USI position arguments per line)")
+    ] = None,
+    log: Annotated[Optional[str], typer.Option(help="log file path")] = None,
+) -> None:
+    """Compare the overhead per batch of writing evaluation results into the nodes at once and per node"""
+
+    logging = Logger("bench", log_file=log).get_logger()
+    boards = [make_bench_board(position) for position in load_bench_positions(positions)]
+
+    # ベンチマーク局面からランダムに指した局面のノードを展開し、評価待ちキューに入れる
+    player = MCTSPlayer()
+    pool = player.tree.pool
+    batch = EvalBatch((None, None, None), batchsize)
+    for i, path in enumerate(make_random_paths(boards, batchsize, max_plies, seed)):
+        board = boards[i % len(boards)].copy()
+        for move in path:
+            board.push(move)
+        node = pool.new_node()
+        pool.expand_node(node, board)
+        batch.eval_queue[i].set(node, board.turn)
+    legal_moves_num = pool.child_num[[element.node for element in batch.eval_queue]]
+    logging.info("batchsize = {}, average legal moves = {:.1f}".format(batchsize, legal_moves_num.mean()))
+
+    rng = np.random.default_rng(seed)
+    legal_move_probabilities = rng.random((batchsize, MAX_LEGAL_MOVES), dtype=np.float32)
+    values = rng.random((batchsize, 1), dtype=np.float32)
+
+    # どちらの書き込みも同じ結果になることを確認する
+    set_eval_results_per_node(player, batch, legal_move_probabilities, values)
+    expected_policy = pool.policy.copy()
+    pool.policy[:] = 0
+    player.set_eval_results(batch, legal_move_probabilities, values)
+    if not np.array_equal(pool.policy, expected_policy):
+        raise ValueError("set_eval_results differs from writing the results per node")
+
+    begin_time = time.perf_counter()
+    for _ in range(repeat):
+        set_eval_results_per_node(player, batch, legal_move_probabilities, values)
+    per_node_time = (time.perf_counter() - begin_time) / repeat
+
+    begin_time = time.perf_counter()
+    for _ in range(repeat):
+        player.set_eval_results(batch, legal_move_probabilities, values)
+    batched_time = (time.perf_counter() - begin_time) / repeat
+
+    logging.info(
+        "per node = {:.3f}ms/batch, batched = {:.3f}ms/batch, speedup = {:.2f}x".format(
+            per_node_time * 1000, batched_time * 1000, per_node_time / batched_time if batched_time > 0 else 0
+        )
+    )
+
+
+# 1段ずつNumPyで子のUCB値を計算して経路を辿る(descend_max_ucb_pathの比較用)
+def descend_max_ucb_path_per_level(
+    pool: NodePool,
+    node: int,
+    c_puct: float,
+    nodes: np.ndarray,
+    edges: np.ndarray,
+    scratch: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray],
+) -> int:
+    depth = 0
+    while True:
+        first = pool.first_child.item(node)
+        last = first + pool.child_num.item(node)
+        child_move_count = pool.child_move_count[first:last]
+        q = np.divide(
+            pool.child_sum_value[first:last],
+            child_move_count,
+            out=np.zeros(last - first, np.float32),
+            where=child_move_count != 0,
+        )
+        move_count = pool.move_count.item(node)
+        u = 1.0 if move_count == 0 else np.sqrt(np.float32(move_count)) / (1 + child_move_count)
+        edge = first + int(np.argmax(q + c_puct * u * pool.policy[first:last]))
+
+        pool.move_count[node] = move_count + VIRTUAL_LOSS
+        pool.child_move_count[edge] = pool.child_move_count.item(edge) + VIRTUAL_LOSS
+        nodes[depth] = node
+        edges[depth] = edge
+        depth += 1
+
+        next_node = pool.child_node.item(edge)
+        if depth == len(edges) or next_node == NULL_NODE:
+            return depth
+        if not (0.0 <= pool.value.item(next_node) <= 1.0) or pool.child_num.item(next_node) == 0:
+            return depth
+        node = next_node
+
+
+# descend_max_ucb_pathの実装をノードプールから呼び出せるようにする
+def descend_pool(kernel: Callable[..., int]) -> Callable[..., int]:
+    def descend(
+        pool: NodePool,
+        node: int,
+        c_puct: float,
+        nodes: np.ndarray,
+        edges: np.ndarray,
+        scratch: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray],
+    ) -> int:
+        return kernel(
+            pool.move_count,
+            pool.value,
+            pool.first_child,
+            pool.child_num,
+            pool.child_move_count,
+            pool.child_sum_value,
+            pool.policy,
+            pool.child_node,
+            node,
+            c_puct,
+            VIRTUAL_LOSS,
+            nodes,
+            edges,
+            scratch,
+        )
+
+    return descend
+
+
+@bench_app.command()
+def bench_select(
+    modelfile: Annotated[str, typer.Option("-m", help="model file")] = MCTSPlayer.DEFAULT_MODELFILE,
+    gpu: Annotated[int, typer.Option("-g", help="GPU ID")] = 0,
+    nodes: Annotated[int, typer.Option("-n", help="playouts searched per position before measuring")] = 3000,
+    descents: Annotated[int, typer.Option(help="Number of selections from the root measured per position")] = 2000,
+    positions: Annotated[
+        Optional[str], typer.Option(help="file of positions (USI position arguments per line)")
+    ] = None,
+    log: Annotated[Optional[str], typer.Option(help="log file path")] = None,
+    input_features: Annotated[
+        int, typer.Option("-i", help="select custom input features mode (default: 0, kiki: 1, himo: 2)")
+    ] = 0,
+    activation_function: Annotated[
+        int, typer.Option("-a", help="select custom input features mode (relu: 0, : 1)")
+    ] = 0,
+) -> None:
+    """Compare the selection time per playout of descending the searched tree per level, with NumPy and with Numba"""
+
+    logging = Logger("bench", log_file=log).get_logger()
+    descenders = {"per level": descend_max_ucb_path_per_level, "numpy": descend_pool(descend_max_ucb_path_numpy)}
+    if numba is not None:
+        descenders["numba"] = descend_pool(descend_max_ucb_path)
+    else:
+        logging.info("numba is not installed, measuring the NumPy selection only")
+
+    player = MCTSPlayer(features_mode=input_features, activation_function_mode=activation_function)
+    player.setoption(["name", "modelfile", "value", modelfile])
+    player.setoption(["name", "gpu_id", "value", str(gpu)])
+    player.setoption(["name", "pv_interval", "value", "0"])
+    player.isready()
+
+    path_nodes = np.zeros(MAX_DESCEND_LEVELS, dtype=np.int64)
+    path_edges = np.zeros(MAX_DESCEND_LEVELS, dtype=np.int64)
+    scratch = make_ucb_scratch()
+    total_times = dict.fromkeys(descenders, 0.0)
+    total_levels = 0
+    bench_positions = load_bench_positions(positions)
+    for position in bench_positions:
+        bench_player(player, [position], nodes)
+        pool = player.tree.pool
+        root = player.tree.current_head
+
+        # 選択した経路のVirtual Lossを戻し、毎回同じ木から選択する
+        for name, descend in descenders.items():
+            begin_time = time.perf_counter()
+            for _ in range(descents):
+                depth = descend(pool, root, player.c_puct, path_nodes, path_edges, scratch)
+                np.subtract.at(pool.move_count, path_nodes[:depth], VIRTUAL_LOSS)
+                np.subtract.at(pool.child_move_count, path_edges[:depth], VIRTUAL_LOSS)
+                if name == "per level":
+                    total_levels += depth
+            total_times[name] += time.perf_counter() - begin_time
+    player.quit()
+
+    # Virtual Lossを戻す時間も含む
+    measured = descents * len(bench_positions)
+    logging.info(
+        "positions = {}, nodes = {}, average depth = {:.2f}".format(
+            len(bench_positions), nodes, total_levels / measured
+        )
+    )
+    base_time = total_times["per level"]
+    for name, total_time in total_times.items():
+        logging.info(
+            "{} = {:.2f}us/playout, speedup = {:.2f}x".format(
+                name, total_time / measured * 1e6, base_time / total_time if total_time > 0 else 0
+            )
+        )
+
+
+@bench_app.command()
+def bench_backend(
+    modelfile: Annotated[str, typer.Option("-m", help="model file")] = MCTSPlayer.DEFAULT_MODELFILE,
+    onnx_modelfile: Annotated[
+        Optional[str], typer.Option(help="ONNX model made by export-onnx for the onnxruntime backend")
+    ] = None,
+    gpu: Annotated[int, typer.Option("-g", help="GPU ID")] = 0,
+    backend: Annotated[
+        Optional[list[str]],
+        typer.Option(help="inference backend (repeatable, default: eager, script, compile and onnxruntime if given)"),
+    ] = None,
+    batchsize: Annotated[list[int], typer.Option("-b", help="batch size (repeatable)")] = DEFAULT_LATENCY_BATCH_SIZES,
+    repeat: Annotated[int, typer.Option(help="Number of inferences averaged for each batch size")] = 10,
+    intra_op_threads: Annotated[
+        int, typer.Option(help="threads within an operator (0: library default)")
+    ] = DEFAULT_INTRA_OP_THREADS,
+    inter_op_threads: Annotated[
+        int, typer.Option(help="threads running independent operators (0: library default)")
+    ] = DEFAULT_INTER_OP_THREADS,
+    positions: Annotated[
+        Optional[str], typer.Option(help="file of positions (USI position arguments per line)")
+    ] = None,
+    log: Annotated[Optional[str], typer.Option(help="log file path")] = None,
+    input_features: Annotated[
+        int, typer.Option("-i", help="select custom input features mode (default: 0, kiki: 1, himo: 2)")
+    ] = 0,
+    activation_function: Annotated[
+        int, typer.Option("-a", help="select custom input features mode (relu: 0, : 1)")
+    ] = 0,
+) -> None:
+    """Compare inference latency and throughput of each backend at each batch size"""
+
+    logging = Logger("bench", log_file=log).get_logger()
+    if backend is None:
+        backend = [BACKEND_EAGER, BACKEND_SCRIPT, BACKEND_COMPILE]
+        if onnx_modelfile is not None:
+            backend.append(BACKEND_ONNXRUNTIME)
+    boards = [make_bench_board(position) for position in load_bench_positions(positions)]
+
+    for inference_backend in backend:
+        evaluator = create_evaluator(
+            inference_backend,
+            FEATURES_SETTINGS[input_features],
+            activation_function_mode=activation_function,
+            gpu_id=gpu,
+            intra_op_threads=intra_op_threads,
+            inter_op_threads=inter_op_threads,
+        )
+        begin_time = time.time()
+        evaluator.load(select_modelfile(inference_backend, modelfile, onnx_modelfile))
+        evaluator.warmup(sorted(batchsize))
+        load_time = time.time() - begin_time
+
+        # ベンチマーク局面を繰り返し並べた入力特徴量
+        features = evaluator.init_features(max(batchsize))
+        for i in range(max(batchsize)):
+            evaluator.make_input_features(boards[i % len(boards)], features, i)
+
+        for batch_size in batchsize:
+            # ウォームアップ
+            evaluator.infer(features, batch_size)
+            begin_time = time.perf_counter()
+            for _ in range(repeat):
+                evaluator.infer(features, batch_size)
+            latency = (time.perf_counter() - begin_time) / repeat
+            logging.info(
+                "backend = {}, load = {:.2f}s, batchsize = {}, latency = {:.2f}ms, throughput = {:.0f} positions/sec".format(
+                    inference_backend, load_time, batch_size, latency * 1000, batch_size / latency if latency > 0 else 0
+                )
+            )
+
+
+@bench_app.command()
+def bench_precision(
+    test_data: Annotated[str, typer.Option(help="test data file (hcpe, or packed .npy made by preprocess)")],
+    modelfile: Annotated[str, typer.Option("-m", help="model file")] = MCTSPlayer.DEFAULT_MODELFILE,
+    gpu: Annotated[int, typer.Option("-g", help="GPU ID")] = 0,
+    batchsize: Annotated[int, typer.Option("-b", help="Number of positions in each mini-batch")] = 256,
+    limit: Annotated[int, typer.Option("-l", help="Number of test positions")] = 10000,
+    precision: Annotated[list[str], typer.Option(help="precision to compare (repeatable)")] = PRECISIONS,
+    log: Annotated[Optional[str], typer.Option(help="log file path")] = None,
+    input_features: Annotated[
+        int, typer.Option("-i", help="select custom input features mode (default: 0, kiki: 1, himo: 2)")
+    ] = 0,
+    activation_function: Annotated[
+        int, typer.Option("-a", help="select custom input features mode (relu: 0, : 1)")
+    ] = 0,
+) -> None:
+    """Compare policy/value accuracy and positions/sec of the same checkpoint for each precision"""
+
+    logging = Logger("bench", log_file=log).get_logger()
+    device = torch.device(f"cuda:{gpu}") if gpu >= 0 else torch.device("cpu")
+
+    model = PolicyValueNetwork(
+        input_features=FEATURES_SETTINGS[input_features].features_num, activation_function_mode=activation_function
+    )
+    model.to(device)
+    model.load_state_dict(torch.load(modelfile, map_location=device)["model"])
+
+    # 入力特徴量の作成時間を含めないように、先にすべてのバッチを作成しておく
+    test_dataloader = HcpeDataLoader(test_data, batchsize, device, features_mode=input_features, limit=limit)
+    batches = list(test_dataloader)
+    test_dataloader.close()
+    logging.info("positions = {}, batchsize = {}".format(len(batches) * batchsize, batchsize))
+
+    for p in precision:
+        check_precision(p)
+        # ウォームアップ
+        test_model(model, batches[:1], p)
+        begin_time = time.time()
+        report = test_model(model, batches, p)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        elapsed_time = time.time() - begin_time
+        logging.info(
+            "precision = {}, {}, {:.0f} positions/sec".format(
+                p, report_test_result(report), len(batches) * batchsize / elapsed_time if elapsed_time > 0 else 0
+            )
+        )
@@ -0,0 +1,167 @@
+import copy
+import os
+import numpy as np
+import onnxruntime
+import torch
+import typer
+from typing import Optional
+from typing_extensions import Annotated
+from app.domain.features import FEATURES_SETTINGS
+from app.domain.policy_value_network import PolicyValueNetwork
+from app.infrastructure.model_file import load_model_file, save_inference_model
+from app.interfaces.logger import Logger
+from app.usecases.bench import DEFAULT_LATENCY_BATCH_SIZES, measure_latency
+
+export_app = typer.Typer()
+
+# 元のモデルと推論用モデルの出力の差の許容値(バッチ正規化の畳み込みによる丸め誤差)
+DEFAULT_EXPORT_TOLERANCE = 1e-3
+# ONNXのopsetのバージョン
+DEFAULT_ONNX_OPSET = 17
+
+
+class OnnxOutput(torch.nn.Module):
+    """ONNXに出力するモデル(dlshogiのONNXモデルと同じく、価値はシグモイド関数を適用した勝率を出力する)"""
+
+    def __init__(self, model: PolicyValueNetwork) -> None:
+        super(OnnxOutput, self).__init__()
+        self.model = model
+
+    def forward(self, x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        policy, value = self.model(x)
+        return policy, torch.sigmoid(value)
+
+
+# 2つのモデルの方策と価値のロジットの差の最大値
+def max_output_difference(model: torch.nn.Module, other: torch.nn.Module, x: torch.Tensor) -> tuple[float, float]:
+    with torch.no_grad():
+        policy, value = model(x)
+        other_policy, other_value = other(x)
+    return (policy - other_policy).abs().max().item(), (value - other_value).abs().max().item()
+
+
+@export_app.command()
+def export(
+    resume: Annotated[str, typer.Option("-r", help="checkpoint made by train")],
+    output: Annotated[str, typer.Option("-o", help="output file of the inference model")],
+    gpu: Annotated[int, typer.Option("-g", help="GPU ID")] = 0,
+    tolerance: Annotated[
+        float, typer.Option(help="maximum allowed difference of the logits from the original model")
+    ] = DEFAULT_EXPORT_TOLERANCE,
+    latency_batchsize: Annotated[
+        list[int], typer.Option(help="batch size to measure the inference latency (repeatable)")
+    ] = DEFAULT_LATENCY_BATCH_SIZES,
+    repeat: Annotated[int, typer.Option(help="Number of inferences averaged for each latency")] = 10,
+    log: Annotated[Optional[str], typer.Option(help="log file path")] = None,
+    input_features: Annotated[
+        int, typer.Option("-i", help="select custom input features mode (default: 0, kiki: 1, himo: 2)")
+    ] = 0,
+    activation_function: Annotated[
+        int, typer.Option("-a", help="select custom input features mode (relu: 0, : 1)")
+    ] = 0,
+) -> None:
+    """Export a checkpoint to an inference-only model file with BatchNorm folded into the convolutions"""
+
+    logging = Logger("export", log_file=log).get_logger()
+    device = torch.device(f"cuda:{gpu}") if gpu >= 0 else torch.device("cpu")
+    features_num = FEATURES_SETTINGS[input_features].features_num
+
+    model = PolicyValueNetwork(input_features=features_num, activation_function_mode=activation_function)
+    logging.info("Loading the checkpoint from {}".format(resume))
+    model.load_state_dict(load_model_file(resume, "cpu")["model"])
+    model.eval()
+
+    # バッチ正規化を畳み込み、オプティマイザの状態を除いたパラメータだけを保存する
+    fused_model = copy.deepcopy(model)
+    fused_model.fuse_batch_norm()
+    save_inference_model(fused_model, output, features_num, activation_function, fused_batch_norm=True)
+    logging.info(
+        "Saved the inference model to {} ({:.1f}MB, checkpoint {:.1f}MB)".format(
+            output, os.path.getsize(output) / 1024 / 1024, os.path.getsize(resume) / 1024 / 1024
+        )
+    )
+
+    # 保存したファイルを読み込み直し、元のモデルと出力が一致することを確認する
+    exported_model = PolicyValueNetwork(
+        input_features=features_num, activation_function_mode=activation_function, fused_batch_norm=True
+    )
+    exported_model.load_state_dict(load_model_file(output, "cpu")["model"], assign=True)
+    exported_model.eval()
+    model.to(device)
+    exported_model.to(device)
+
+    x = torch.randint(0, 2, (max(latency_batchsize), features_num, 9, 9), dtype=torch.float32, device=device)
+    policy_difference, value_difference = max_output_difference(model, exported_model, x)
+    logging.info("max difference: policy = {:.3e}, value = {:.3e}".format(policy_difference, value_difference))
+    if max(policy_difference, value_difference) > tolerance:
+        raise ValueError(
+            "the exported model differs from the checkpoint by more than the tolerance {}".format(tolerance)
+        )
+
+    # バッチサイズごとの推論時間の比較
+    for batch_size in latency_batchsize:
+        checkpoint_latency = measure_latency(model, x[:batch_size], repeat)
+        exported_latency = measure_latency(exported_model, x[:batch_size], repeat)
+        logging.info(
+            "batchsize = {}, checkpoint = {:.2f}ms, exported = {:.2f}ms, speedup = {:.2f}x".format(
+                batch_size,
+                checkpoint_latency,
+                exported_latency,
+                checkpoint_latency / exported_latency if exported_latency > 0 else 0,
+            )
+        )
+
+
+@export_app.command()
+def export_onnx(
+    resume: Annotated[str, typer.Option("-r", help="checkpoint made by train")],
+    output: Annotated[str, typer.Option("-o", help="output ONNX file")],
+    opset: Annotated[int, typer.Option(help="ONNX opset version")] = DEFAULT_ONNX_OPSET,
+    tolerance: Annotated[
+        float, typer.Option(help="maximum allowed difference of the outputs from the PyTorch model")
+    ] = DEFAULT_EXPORT_TOLERANCE,
+    log: Annotated[Optional[str], typer.Option(help="log file path")] = None,
+    input_features: Annotated[
+        int, typer.Option("-i", help="select custom input features mode (default: 0, kiki: 1, himo: 2)")
+    ] = 0,
+    activation_function: Annotated[
+        int, typer.Option("-a", help="select custom input features mode (relu: 0, : 1)")
+    ] = 0,
+) -> None:
+    """Export a checkpoint to ONNX with a dynamic batch axis for OnnxPlayer"""
+
+    logging = Logger("export", log_file=log).get_logger()
+    features_num = FEATURES_SETTINGS[input_features].features_num
+
+    model = PolicyValueNetwork(input_features=features_num, activation_function_mode=activation_function)
+    logging.info("Loading the checkpoint from {}".format(resume))
+    model.load_state_dict(load_model_file(resume, "cpu")["model"])
+    model.eval()
+    # バッチ正規化はONNX Runtimeでも畳み込まれるが、出力するモデルを小さくするために先に畳み込む
+    fused_model = copy.deepcopy(model)
+    fused_model.fuse_batch_norm()
+
+    # 入力はバッチサイズを可変にする(探索中のバッチサイズは毎回変わる)
+    torch.onnx.export(
+        OnnxOutput(fused_model),
+        (torch.zeros((1, features_num, 9, 9), dtype=torch.float32),),
+        output,
+        dynamo=False,
+        opset_version=opset,
+        input_names=["input"],
+        output_names=["output_policy", "output_value"],
+        dynamic_axes={"input": {0: "batch"}, "output_policy": {0: "batch"}, "output_value": {0: "batch"}},
+    )
+    logging.info("Saved the ONNX model to {} ({:.1f}MB)".format(output, os.path.getsize(output) / 1024 / 1024))
+
+    # ONNX Runtimeで推論し、PyTorchのモデルと出力が一致することを確認する
+    session = onnxruntime.InferenceSession(output, providers=["CPUExecutionProvider"])
+    x = torch.randint(0, 2, (max(DEFAULT_LATENCY_BATCH_SIZES), features_num, 9, 9), dtype=torch.float32)
+    with torch.no_grad():
+        policy, value = OnnxOutput(model)(x)
+    onnx_policy, onnx_value = session.run(["output_policy", "output_value"], {"input": x.numpy()})
+    policy_difference = float(np.abs(onnx_policy - policy.numpy()).max())
+    value_difference = float(np.abs(onnx_value - value.numpy()).max())
+    logging.info("max difference: policy = {:.3e}, value = {:.3e}".format(policy_difference, value_difference))
+    if max(policy_difference, value_difference) > tolerance:
+        raise ValueError("the ONNX model differs from the checkpoint by more than the tolerance {}".format(tolerance))
@@ -1,6 +1,8 @@
 import numpy as np
-import torch
-from typing import Optional, Union
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Optional
 
 from cshogi import (
     Board,
@@ -11,9 +13,36 @@ from cshogi import (
     REPETITION_SUPERIOR,
     move_to_usi,
 )
-from app.domain.features import FEATURES_SETTINGS, make_move_label
-from app.domain.uct_node import NodeTree, UctNode
-from app.domain.policy_value_network import PolicyValueNetwork
+from app.domain.features import FEATURES_SETTINGS, make_move_labels
+from app.domain.uct_node import (
+    NodeTree,
+    NodePool,
+    TranspositionTable,
+    NULL_NODE,
+    DEFAULT_NODE_POOL_MB,
+    DEFAULT_TRANSPOSITION_TABLE_MB,
+)
+from app.domain.eval_cache import EvalCache, DEFAULT_EVAL_CACHE_MB
+from app.domain.ucb import (
+    MAX_DESCEND_LEVELS,
+    compile_ucb_kernels,
+    descend_max_ucb_path,
+    make_ucb_scratch,
+    select_max_ucb_child,
+)
+from app.infrastructure.precision import PRECISIONS, DEFAULT_PRECISION, check_precision
+from app.infrastructure.evaluator import (
+    BACKENDS,
+    DEFAULT_BACKEND,
+    DEFAULT_INTRA_OP_THREADS,
+    DEFAULT_INTER_OP_THREADS,
+    GRAPH_OPTIMIZATION_LEVELS,
+    DEFAULT_GRAPH_OPTIMIZATION_LEVEL,
+    Evaluator,
+    check_backend,
+    check_graph_optimization_level,
+    create_evaluator,
+)
 from app.usecases.base_player import BasePlayer
 
 import time
@@ -21,8 +50,10 @@ import math
 
 # デフォルトGPU ID
 DEFAULT_GPU_ID = 0
-# デフォルトバッチサイズ
+# デフォルトバッチサイズ(探索スレッドごと)
 DEFAULT_BATCH_SIZE = 32
+# デフォルト探索スレッド数
+DEFAULT_SEARCH_THREADS = 1
 # デフォルト投了閾値
 DEFAULT_RESIGN_THRESHOLD = 0.01
 # デフォルトPUCTの定数
@@ -51,39 +82,82 @@ DISCARDED = -2
 VIRTUAL_LOSS = 1
 
 
-# 温度パラメータを適用した確率分布を取得
-def softmax_temperature_with_normalize(logits: np.ndarray, temperature: float) -> np.ndarray[np.float32, np.float32]:
-    # 温度パラメータを適用
-    logits /= temperature
+# ノード更新(NumPyのスカラー演算は遅いため、item()でPythonの数値として読み出して計算する)
+def update_result(pool: NodePool, current_node: int, next_edge: int, result: float) -> None:
+    pool.sum_value[current_node] = pool.sum_value.item(current_node) + result
+    pool.move_count[current_node] = pool.move_count.item(current_node) + 1 - VIRTUAL_LOSS
+    pool.child_sum_value[next_edge] = pool.child_sum_value.item(next_edge) + result
+    pool.child_move_count[next_edge] = pool.child_move_count.item(next_edge) + 1 - VIRTUAL_LOSS
+
 
-    # 確率を計算(オーバーフローを防止するため最大値で引く)
-    max_logit = max(logits)
-    probabilities = np.exp(logits - max_logit)
+# 複数の探索経路のノードをまとめて更新
+def update_results(pool: NodePool, nodes: list[int], edges: list[int], results: list[float]) -> None:
+    np.add.at(pool.sum_value, nodes, results)
+    np.add.at(pool.move_count, nodes, 1 - VIRTUAL_LOSS)
+    np.add.at(pool.child_sum_value, edges, results)
+    np.add.at(pool.child_move_count, edges, 1 - VIRTUAL_LOSS)
 
-    # 合計が1になるように正規化
-    sum_probabilities = sum(probabilities)
-    probabilities /= sum_probabilities
 
-    return probabilities
+# 複数の探索経路のVirtual Lossをまとめて戻す
+def revert_virtual_loss(pool: NodePool, nodes: list[int], edges: list[int]) -> None:
+    np.subtract.at(pool.move_count, nodes, VIRTUAL_LOSS)
+    np.subtract.at(pool.child_move_count, edges, VIRTUAL_LOSS)
 
 
-# ノード更新
-def update_result(current_node: UctNode, next_index: int, result: float) -> None:
-    current_node.sum_value += result
-    current_node.move_count += 1 - VIRTUAL_LOSS
-    current_node.child_sum_value[next_index] += result
-    current_node.child_move_count[next_index] += 1 - VIRTUAL_LOSS
+# 千日手の種類からノードの価値と探索結果を求める
+def repetition_result(draw: int) -> tuple[float, float]:
+    if draw == REPETITION_DRAW:
+        # 千日手
+        return VALUE_DRAW, 0.5
+    elif draw == REPETITION_WIN or draw == REPETITION_SUPERIOR:
+        # 連続王手の千日手で勝ち、もしくは優越局面の場合
+        return VALUE_WIN, 0.0
+    else:  # draw == REPETITION_LOSE or draw == REPETITION_INFERIOR
+        # 連続王手の千日手で負け、もしくは劣等局面の場合
+        return VALUE_LOSE, 1.0
 
 
 # 評価待ちキューの要素
 class EvalQueueElement:
     def __init__(self) -> None:
-        self.node: Optional[UctNode] = None
+        self.node: int = NULL_NODE
         self.color: Optional[int] = None
+        # 評価キャッシュのキー
+        self.key: Optional[tuple[int, int]] = None
 
-    def set(self, node: UctNode, color: int) -> None:
+    def set(self, node: int, color: int, key: Optional[tuple[int, int]] = None) -> None:
         self.node = node
         self.color = color
+        self.key = key
+
+
+# 評価待ちのバッチ(探索スレッドごとに入力特徴量と評価待ちキューを持つ)
+class EvalBatch:
+    def __init__(self, inputs: tuple[Any, Any, Any], batch_size: int) -> None:
+        # 推論の入力(入力特徴量, 合法手のラベル, 合法手の数)
+        self.inputs = inputs
+        self.features, self.move_labels, self.legal_moves_num = inputs
+        # 評価待ちキュー
+        self.eval_queue = [EvalQueueElement() for _ in range(batch_size)]
+        # バッチインデックス
+        self.current_batch_index: int = 0
+        # バッチ内でキューに追加した局面(キー → バッチインデックス)
+        self.queued_keys: dict[tuple[int, int], int] = {}
+        # バッチ内で同一局面が既にキューにあるノード(ノード, バッチインデックス)
+        self.eval_queue_duplicates: list[tuple[int, int]] = []
+        # シミュレーション用の盤面(探索開始時にルート局面をコピーし、着手と戻すを繰り返して使う)
+        self.board = Board()
+        # 1回の選択で辿った経路のノードと辺
+        self.path_nodes = np.zeros(MAX_DESCEND_LEVELS, dtype=np.int64)
+        self.path_edges = np.zeros(MAX_DESCEND_LEVELS, dtype=np.int64)
+        # UCB値の計算に使う作業用の配列(Numbaがない場合のNumPy版の選択で使う)
+        self.ucb_scratch = make_ucb_scratch()
+
+    # 評価待ちキューを空にする
+    def clear(self) -> None:
+        self.current_batch_index = 0
+        self.queued_keys.clear()
+        self.eval_queue_duplicates.clear()
 
 
 class MCTSPlayer(BasePlayer):
@@ -91,19 +165,27 @@ class MCTSPlayer(BasePlayer):
     name = "python-dlshogi2"
     # デフォルトチェックポイント
     DEFAULT_MODELFILE = "checkpoints/checkpoint.pth"
+    # デフォルトの推論のバックエンド
+    DEFAULT_BACKEND = DEFAULT_BACKEND
 
     def __init__(self, features_mode: int = 0, activation_function_mode: int = 0) -> None:
         super().__init__()
         # チェックポイントのパス
         self.modelfile: str = self.DEFAULT_MODELFILE
-        # モデル
-        self.model: Optional[PolicyValueNetwork] = None
-        # 入力特徴量
-        self.features: Optional[torch.Tensor] = None
-        # 評価待ちキュー
-        self.eval_queue: Optional[list[EvalQueueElement]] = None
-        # バッチインデックス
-        self.current_batch_index: int = 0
+        # 局面を評価する推論のバックエンド(探索スレッドが複数の場合とパイプライン探索の場合は推論スレッドも持つ)
+        self.evaluator: Optional[Evaluator] = None
+        # 探索スレッドごとの評価待ちのバッチ(先頭はルート局面の評価にも使う)
+        self.eval_batches: list[EvalBatch] = []
+        # 探索スレッド
+        self.search_executor: Optional[ThreadPoolExecutor] = None
+        # ゲーム木を更新するときのロック
+        self.tree_lock = threading.Lock()
+        # 探索の終了を探索スレッドに通知する
+        self.search_stopped = threading.Event()
+        # 評価キャッシュ
+        self.eval_cache: Optional[EvalCache] = None
+        # 評価キャッシュのサイズ(MB)
+        self.eval_cache_mb: int = DEFAULT_EVAL_CACHE_MB
 
         # ルート局面
         self.root_board: Board = Board()
@@ -117,10 +199,21 @@ class MCTSPlayer(BasePlayer):
 
         # GPU ID
         self.gpu_id: int = DEFAULT_GPU_ID
-        # デバイス
-        self.device: Optional[Union[str, torch.device, int]] = None
-        # バッチサイズ
+        # 推論の数値精度
+        self.precision: str = DEFAULT_PRECISION
+        # 推論のバックエンド(eager、TorchScript、torch.compile、ONNX Runtime)
+        self.backend: str = self.DEFAULT_BACKEND
+        # 推論のスレッド数(0はライブラリのデフォルト)
+        self.intra_op_threads: int = DEFAULT_INTRA_OP_THREADS
+        self.inter_op_threads: int = DEFAULT_INTER_OP_THREADS
+        # ONNX Runtimeのグラフ最適化のレベル
+        self.graph_optimization_level: str = DEFAULT_GRAPH_OPTIMIZATION_LEVEL
+        # バッチサイズ(探索スレッドごと)
         self.batch_size: int = DEFAULT_BATCH_SIZE
+        # 探索スレッド数
+        self.search_threads: int = DEFAULT_SEARCH_THREADS
+        # 2つのバッチを交互に使い、推論中に次のバッチを選択するか(探索スレッドが1つの場合)
+        self.pipeline: bool = False
 
         # 投了する勝率の閾値
         self.resign_threshold: float = DEFAULT_RESIGN_THRESHOLD
@@ -134,7 +227,14 @@ class MCTSPlayer(BasePlayer):
         self.byoyomi_margin: int = DEFAULT_BYOYOMI_MARGIN
         # PV表示間隔
         self.pv_interval: int = DEFAULT_PV_INTERVAL
-
+        # ノードプールのサイズ(MB)
+        self.node_pool_mb: int = DEFAULT_NODE_POOL_MB
+        # 置換表を使用するか
+        self.use_transposition_table: bool = False
+        # 置換表のサイズ(MB)
+        self.transposition_table_mb: int = DEFAULT_TRANSPOSITION_TABLE_MB
+
+        self.features_mode = features_mode
         self.features_setting = FEATURES_SETTINGS[features_mode]
         self.activation_function_mode = activation_function_mode
 
@@ -146,6 +246,25 @@ class MCTSPlayer(BasePlayer):
         print("option name modelfile type string default " + self.DEFAULT_MODELFILE)
         print("option name gpu_id type spin default " + str(DEFAULT_GPU_ID) + " min -1 max 7")
         print("option name batchsize type spin default " + str(DEFAULT_BATCH_SIZE) + " min 1 max 256")
+        print("option name search_threads type spin default " + str(DEFAULT_SEARCH_THREADS) + " min 1 max 64")
+        print("option name pipeline type check default false")
+        print(
+            "option name precision type combo default "
+            + DEFAULT_PRECISION
+            + "".join(" var " + precision for precision in PRECISIONS)
+        )
+        print(
+            "option name backend type combo default "
+            + self.DEFAULT_BACKEND
+            + "".join(" var " + backend for backend in BACKENDS)
+        )
+        print("option name intra_op_threads type spin default " + str(DEFAULT_INTRA_OP_THREADS) + " min 0 max 256")
+        print("option name inter_op_threads type spin default " + str(DEFAULT_INTER_OP_THREADS) + " min 0 max 256")
+        print(
+            "option name graph_optimization_level type combo default "
+            + DEFAULT_GRAPH_OPTIMIZATION_LEVEL
+            + "".join(" var " + level for level in GRAPH_OPTIMIZATION_LEVELS)
+        )
         print(
             "option name resign_threshold type spin default "
             + str(int(DEFAULT_RESIGN_THRESHOLD * 100))
@@ -156,75 +275,137 @@ class MCTSPlayer(BasePlayer):
         print("option name time_margin type spin default " + str(DEFAULT_TIME_MARGIN) + " min 0 max 1000")
         print("option name byoyomi_margin type spin default " + str(DEFAULT_BYOYOMI_MARGIN) + " min 0 max 1000")
         print("option name pv_interval type spin default " + str(DEFAULT_PV_INTERVAL) + " min 0 max 10000")
+        print("option name node_pool_mb type spin default " + str(DEFAULT_NODE_POOL_MB) + " min 1 max 65536")
+        print("option name transposition_table type check default false")
+        print("option name EvalCacheMB type spin default " + str(DEFAULT_EVAL_CACHE_MB) + " min 0 max 65536")
+        print(
+            "option name transposition_table_mb type spin default "
+            + str(DEFAULT_TRANSPOSITION_TABLE_MB)
+            + " min 1 max 65536"
+        )
         print("option name debug type check default false")
 
     def setoption(self, args: list[str]) -> None:
         if args[1] == "modelfile":
             self.modelfile = args[3]
+            # モデルが変わると評価結果も変わるため、評価キャッシュを破棄する
+            self.eval_cache = None
         elif args[1] == "gpu_id":
             self.gpu_id = int(args[3])
+            # 推論するデバイスが変わると評価結果もわずかに変わるため、評価キャッシュを破棄する
+            self.eval_cache = None
         elif args[1] == "batchsize":
             self.batch_size = int(args[3])
+        elif args[1] == "search_threads":
+            self.search_threads = int(args[3])
+        elif args[1] == "pipeline":
+            self.pipeline = args[3] == "true"
+        elif args[1] == "precision":
+            self.precision = check_precision(args[3])
+            if self.evaluator is not None:
+                self.evaluator.precision = self.precision
+            # 数値精度が変わると評価結果も変わるため、評価キャッシュを破棄する
+            self.eval_cache = None
+        elif args[1] == "backend":
+            self.backend = check_backend(args[3])
+            # 推論のバックエンドが変わると評価結果もわずかに変わるため、評価キャッシュを破棄する
+            self.eval_cache = None
+        elif args[1] == "intra_op_threads":
+            self.intra_op_threads = int(args[3])
+        elif args[1] == "inter_op_threads":
+            self.inter_op_threads = int(args[3])
+        elif args[1] == "graph_optimization_level":
+            self.graph_optimization_level = check_graph_optimization_level(args[3])
         elif args[1] == "resign_threshold":
             self.resign_threshold = int(args[3]) / 100
         elif args[1] == "c_puct":
             self.c_puct = int(args[3]) / 100
         elif args[1] == "temperature":
             self.temperature = int(args[3]) / 100
+            if self.evaluator is not None:
+                self.evaluator.temperature = self.temperature
+            # 温度パラメータを適用した方策を保持しているため、評価キャッシュを破棄する
+            self.eval_cache = None
         elif args[1] == "time_margin":
             self.time_margin = int(args[3])
         elif args[1] == "byoyomi_margin":
             self.byoyomi_margin = int(args[3])
         elif args[1] == "pv_interval":
             self.pv_interval = int(args[3])
+        elif args[1] == "node_pool_mb":
+            self.node_pool_mb = int(args[3])
+        elif args[1] == "transposition_table":
+            self.use_transposition_table = args[3] == "true"
+        elif args[1] == "transposition_table_mb":
+            self.transposition_table_mb = int(args[3])
+        elif args[1] == "EvalCacheMB":
+            self.eval_cache_mb = int(args[3])
         elif args[1] == "debug":
             self.debug = args[3] == "true"
 
-    # モデルのロード
-    def load_model(self) -> None:
-        self.model = PolicyValueNetwork(
-            input_features=self.features_setting.features_num,
+    def isready(self) -> None:
+        # 推論のバックエンドを作成してモデルをロード
+        self.stop_search_threads()
+        self.evaluator = create_evaluator(
+            self.backend,
+            self.features_setting,
             activation_function_mode=self.activation_function_mode,
+            gpu_id=self.gpu_id,
+            precision=self.precision,
+            intra_op_threads=self.intra_op_threads,
+            inter_op_threads=self.inter_op_threads,
+            graph_optimization_level=self.graph_optimization_level,
+            temperature=self.temperature,
         )
-        self.model.to(self.device)
-        checkpoint = torch.load(self.modelfile, map_location=self.device)
-        self.model.load_state_dict(checkpoint["model"])
-        # モデルを評価モードにする
-        self.model.eval()
-
-    # 入力特徴量の初期化
-    def init_features(self) -> None:
-        self.features = torch.empty(
-            (self.batch_size, self.features_setting.features_num, 9, 9),
-            dtype=torch.float32,
-            pin_memory=(self.gpu_id >= 0),
+        self.evaluator.load(self.modelfile)
+        # 選択のカーネルをコンパイルしておく
+        compile_ucb_kernels()
+
+        # 探索中のバッチは1局面(ルート局面)から推論スレッドでまとめたバッチの大きさまで変わる。
+        # 畳み込みの実装はバッチサイズの範囲ごとに切り替わり、torch.compileはその範囲ごとに再コンパイルするため、
+        # 2のべき乗の大きさと探索スレッドごとのバッチの大きさで推論しておく
+        max_batch_size = self.batch_size * self.search_threads
+        self.evaluator.warmup(
+            sorted({self.batch_size, max_batch_size} | {1 << i for i in range(max_batch_size.bit_length())})
         )
 
-    def isready(self) -> None:
-        # デバイス
-        if self.gpu_id >= 0:
-            self.device = torch.device(f"cuda:{self.gpu_id}")
-        else:
-            self.device = torch.device("cpu")
-
-        # モデルをロード
-        self.load_model()
+        # ノードプールと置換表を確保してゲーム木を初期化
+        self.tree = NodeTree(
+            NodePool.from_megabytes(self.node_pool_mb),
+            TranspositionTable(self.transposition_table_mb) if self.use_transposition_table else None,
+        )
 
         # 局面初期化
         self.root_board.reset()
         self.tree.reset_to_position(self.root_board.zobrist_hash(), [])
 
-        # 入力特徴量と評価待ちキューを初期化
-        self.init_features()
-        self.eval_queue = [EvalQueueElement() for _ in range(self.batch_size)]
-        self.current_batch_index = 0
+        # 評価キャッシュ(対局をまたいで使用するため、サイズが変わった場合のみ作り直す)
+        if self.eval_cache_mb <= 0:
+            self.eval_cache = None
+        elif self.eval_cache is None or self.eval_cache.megabytes != self.eval_cache_mb:
+            self.eval_cache = EvalCache(self.eval_cache_mb)
+
+        # 探索スレッドごとに入力特徴量と評価待ちキューを初期化(パイプライン探索の場合は2つ)
+        use_pipeline = self.pipeline and self.search_threads == 1
+        self.eval_batches = [
+            EvalBatch(self.evaluator.init_inputs(self.batch_size), self.batch_size)
+            for _ in range(2 if use_pipeline else self.search_threads)
+        ]
+
+        # 探索スレッドが複数の場合とパイプライン探索の場合は、推論スレッドを起動する
+        if self.search_threads > 1 or use_pipeline:
+            self.evaluator.start(max_batch_size)
+        if self.search_threads > 1:
+            self.search_executor = ThreadPoolExecutor(max_workers=self.search_threads)
 
         # モデルをキャッシュして初回推論を速くする
+        batch = self.eval_batches[0]
+        batch.clear()
         current_node = self.tree.current_head
-        current_node.expand_node(self.root_board)
+        self.tree.pool.expand_node(current_node, self.root_board)
         for _ in range(self.batch_size):
-            self.queue_node(self.root_board, current_node)
-        self.eval_node()
+            self.enqueue_node(self.root_board, current_node, batch)
+        self.eval_node(batch)
 
     def position(self, sfen: str, usi_moves: list[str]) -> None:
         if sfen == "startpos":
@@ -293,10 +474,11 @@ class MCTSPlayer(BasePlayer):
         if self.root_board.is_nyugyoku():
             return "win", None
 
+        pool = self.tree.pool
         current_node = self.tree.current_head
 
         # 詰みの場合
-        if current_node.value == VALUE_WIN:
+        if pool.value[current_node] == VALUE_WIN:
             matemove = self.root_board.mate_move(3)
             if matemove != 0:
                 print("info score mate 3 pv {}".format(move_to_usi(matemove)), flush=True)
@@ -310,45 +492,103 @@ class MCTSPlayer(BasePlayer):
         # プレイアウト数をクリア
         self.playout_count = 0
 
+        # 置換表の世代を進める
+        if self.tree.tt is not None:
+            self.tree.tt.new_generation()
+            self.tree.tt.reset_stats()
+        if self.eval_cache is not None:
+            self.eval_cache.reset_stats()
+
         # ルートノードが未展開の場合、展開する
-        if current_node.child_move is None:
-            current_node.expand_node(self.root_board)
+        if not pool.is_expanded(current_node):
+            pool.expand_node(current_node, self.root_board)
 
         # 候補手が1つの場合は、その手を返す
-        if self.halt is None and len(current_node.child_move) == 1:
-            if current_node.child_move_count[0] > 0:
+        first = pool.first_child[current_node]
+        if self.halt is None and pool.child_num[current_node] == 1:
+            if pool.child_move_count[first] > 0:
                 bestmove, bestvalue, ponder_move = self.get_bestmove_and_print_pv()
                 return move_to_usi(bestmove), move_to_usi(ponder_move) if ponder_move else None
             else:
-                return move_to_usi(current_node.child_move[0]), None
+                return move_to_usi(int(pool.child_move[first])), None
 
         # ルートノードが未評価の場合、評価する
-        if current_node.policy is None:
-            self.current_batch_index = 0
-            self.queue_node(self.root_board, current_node)
-            self.eval_node()
+        if not pool.evaluated[current_node]:
+            batch = self.eval_batches[0]
+            batch.clear()
+            if self.queue_node(self.root_board, current_node, batch):
+                self.eval_node(batch)
+
+        # シミュレーション用の盤面をルート局面に合わせる
+        for batch in self.eval_batches:
+            batch.board = self.root_board.copy()
 
         # 探索
-        self.search()
+        if self.search_threads > 1:
+            self.search_parallel()
+        elif self.pipeline:
+            self.search_pipelined()
+        else:
+            self.search()
 
         # 最善手の取得とPVの表示
         bestmove, bestvalue, ponder_move = self.get_bestmove_and_print_pv()
 
         # for debug
         if self.debug:
-            for i in range(len(current_node.child_move)):
+            for i, edge in enumerate(pool.child_range(current_node)):
                 print(
                     "{:3}:{:5} move_count:{:4} nn_rate:{:.5f} win_rate:{:.5f}".format(
                         i,
-                        move_to_usi(current_node.child_move[i]),
-                        current_node.child_move_count[i],
-                        current_node.policy[i],
-                        current_node.child_sum_value[i] / current_node.child_move_count[i]
-                        if current_node.child_move_count[i] > 0
+                        move_to_usi(pool.child_move[edge]),
+                        pool.child_move_count[edge],
+                        pool.policy[edge],
+                        pool.child_sum_value[edge] / pool.child_move_count[edge]
+                        if pool.child_move_count[edge] > 0
                         else 0,
                     )
                 )
 
+        # ノードプールの使用状況
+        print(
+            "info string node pool nodes {}/{} edges {}/{} memory {}MB".format(
+                pool.node_size,
+                pool.node_capacity,
+                pool.edge_size,
+                pool.edge_capacity,
+                pool.memory_usage() // (1024 * 1024),
+            ),
+            flush=True,
+        )
+        # 置換表の使用状況
+        tt = self.tree.tt
+        if tt is not None:
+            print(
+                "info string transposition table hit {}/{} ({:.1f}%) entries {}/{} replaced {} memory {}MB".format(
+                    tt.hits,
+                    tt.probes,
+                    tt.hit_rate() * 100,
+                    tt.used(),
+                    tt.capacity,
+                    tt.replacements,
+                    tt.memory_usage() // (1024 * 1024),
+                ),
+                flush=True,
+            )
+        # 評価キャッシュの使用状況
+        eval_cache = self.eval_cache
+        if eval_cache is not None:
+            print(
+                "info string eval cache hit {} miss {} ({:.1f}%) entries {} memory {}MB".format(
+                    eval_cache.hits,
+                    eval_cache.misses,
+                    eval_cache.hit_rate() * 100,
+                    len(eval_cache),
+                    eval_cache.memory_usage() // (1024 * 1024),
+                ),
+                flush=True,
+            )
+
         # 閾値未満の場合投了
         if bestvalue < self.resign_threshold:
             return "resign", None
@@ -372,28 +612,175 @@ class MCTSPlayer(BasePlayer):
 
     def quit(self) -> None:
         self.stop()
+        self.stop_search_threads()
+
+    # 推論スレッドと探索スレッドを終了する
+    def stop_search_threads(self) -> None:
+        if self.evaluator is not None:
+            self.evaluator.stop()
+        if self.search_executor is not None:
+            self.search_executor.shutdown()
+            self.search_executor = None
 
     def search(self) -> None:
         self.last_pv_print_time: float = 0
 
         # 探索経路のバッチ
-        trajectories_batch = []
-        trajectories_batch_discarded = []
+        trajectories_batch: list[list[tuple[int, int]]] = []
+        trajectories_batch_discarded: list[list[tuple[int, int]]] = []
+        batch = self.eval_batches[0]
 
         # 探索回数が閾値を超える、または探索が打ち切られたらループを抜ける
         while True:
-            trajectories_batch.clear()
-            trajectories_batch_discarded.clear()
-            self.current_batch_index = 0
-
             # バッチサイズの回数だけシミュレーションを行う
-            for i in range(self.batch_size):
-                # 盤面のコピー
-                board = self.root_board.copy()
+            self.playout_batch(batch, trajectories_batch, trajectories_batch_discarded)
+
+            # 評価
+            if len(trajectories_batch) > 0:
+                self.eval_node(batch)
+
+            # バックアップ
+            self.backup_batch(trajectories_batch, trajectories_batch_discarded)
+
+            # 探索を打ち切るか確認
+            if self.check_interruption():
+                return
+
+            # PV表示
+            self.print_pv_at_interval()
+
+    # 2つのバッチを交互に使い、一方の推論中にもう一方のバッチを選択する
+    def search_pipelined(self) -> None:
+        self.last_pv_print_time = 0
+        if self.evaluator is None:
+            raise ValueError("evaluator is None")
+
+        # 推論中のバッチ(バッチ, 探索経路, 破棄した探索経路, 推論結果のFuture)
+        in_flight: deque[tuple[EvalBatch, list, list, Optional[Future]]] = deque()
+        trajectories = [([], []), ([], [])]
+        index = 0
+
+        # 探索回数が閾値を超える、または探索が打ち切られたらループを抜ける
+        while True:
+            # 前のバッチの推論中に、次のバッチのシミュレーションを行う(前のバッチの経路にはVirtual Lossがかかっている)
+            batch = self.eval_batches[index]
+            trajectories_batch, trajectories_batch_discarded = trajectories[index]
+            self.playout_batch(batch, trajectories_batch, trajectories_batch_discarded)
+            future = None
+            if len(trajectories_batch) > 0:
+                future = self.evaluator.submit(batch.inputs, batch.current_batch_index)
+            in_flight.append((batch, trajectories_batch, trajectories_batch_discarded, future))
+            index ^= 1
+            if len(in_flight) < 2:
+                continue
+
+            # 先に推論を始めたバッチの結果を待ってバックアップ
+            self.complete_batch(*in_flight.popleft())
+
+            # 探索を打ち切るか確認(推論中のバッチもバックアップしてから終了する)
+            if self.check_interruption():
+                self.complete_batch(*in_flight.popleft())
+                return
 
+            # PV表示
+            self.print_pv_at_interval()
+
+    # 推論結果を待ってノードに反映し、バックアップする
+    def complete_batch(
+        self,
+        batch: EvalBatch,
+        trajectories_batch: list[list[tuple[int, int]]],
+        trajectories_batch_discarded: list[list[tuple[int, int]]],
+        future: Optional[Future],
+    ) -> None:
+        if future is not None:
+            probabilities, values = future.result()
+            self.set_eval_results(batch, probabilities, values)
+        self.backup_batch(trajectories_batch, trajectories_batch_discarded)
+
+    # 複数の探索スレッドで1つのゲーム木を探索する
+    def search_parallel(self) -> None:
+        self.last_pv_print_time = 0
+        if self.search_executor is None or self.evaluator is None or self.evaluator.batch_evaluator is None:
+            raise ValueError("search threads are not started")
+        batch_evaluator = self.evaluator.batch_evaluator
+        batch_evaluator.reset_stats()
+
+        # 探索スレッドを開始する
+        self.search_stopped.clear()
+        futures = [self.search_executor.submit(self.search_thread, batch) for batch in self.eval_batches]
+
+        # 探索スレッドが探索を打ち切るまでPVを表示する
+        pv_interval = self.pv_interval / 1000 if self.pv_interval > 0 else None
+        while not self.search_stopped.wait(pv_interval):
+            with self.tree_lock:
+                self.print_pv_at_interval()
+
+        # すべての探索スレッドの終了を待つ(例外が発生した場合はここで送出される)
+        for future in futures:
+            future.result()
+
+        if self.debug:
+            print(
+                "info string batch evaluator batches {} average batch size {:.1f}".format(
+                    batch_evaluator.batches,
+                    batch_evaluator.positions / max(1, batch_evaluator.batches),
+                ),
+                flush=True,
+            )
+
+    # 探索スレッド
+    def search_thread(self, batch: EvalBatch) -> None:
+        if self.evaluator is None:
+            raise ValueError("evaluator is None")
+
+        trajectories_batch: list[list[tuple[int, int]]] = []
+        trajectories_batch_discarded: list[list[tuple[int, int]]] = []
+        try:
+            while not self.search_stopped.is_set():
+                # バッチサイズの回数だけシミュレーションを行う
+                self.playout_batch(batch, trajectories_batch, trajectories_batch_discarded)
+
+                # 推論スレッドで評価する(待っている間も他の探索スレッドは選択を続ける)
+                if len(trajectories_batch) > 0:
+                    probabilities, values = self.evaluator.submit(batch.inputs, batch.current_batch_index).result()
+
+                with self.tree_lock:
+                    if len(trajectories_batch) > 0:
+                        self.set_eval_results(batch, probabilities, values)
+
+                    # バックアップ
+                    self.backup_batch(trajectories_batch, trajectories_batch_discarded)
+
+                    # 探索を打ち切るか確認
+                    if self.check_interruption():
+                        self.search_stopped.set()
+        finally:
+            # 例外で終了した場合も他の探索スレッドを止める
+            self.search_stopped.set()
+
+    # バッチサイズの回数だけシミュレーションを行い、評価待ちの探索経路と破棄した探索経路を求める
+    def playout_batch(
+        self,
+        batch: EvalBatch,
+        trajectories_batch: list[list[tuple[int, int]]],
+        trajectories_batch_discarded: list[list[tuple[int, int]]],
+    ) -> None:
+        trajectories_batch.clear()
+        trajectories_batch_discarded.clear()
+        batch.clear()
+        board = batch.board
+
+        for i in range(self.batch_size):
+            # 探索スレッドが複数の場合にゲーム木を同時に更新しないよう、1回のシミュレーションごとにロックする
+            with self.tree_lock:
                 # 探索
                 trajectories_batch.append([])
-                result = self.uct_search(board, self.tree.current_head, trajectories_batch[-1])
+                result = self.uct_search(board, self.tree.current_head, trajectories_batch[-1], batch)
+
+                # 探索で指した手を戻してルート局面に戻す(経路の辺ごとに1手指している)
+                for _ in range(len(trajectories_batch[-1])):
+                    board.pop()
 
                 if result != DISCARDED:
                     # 探索回数を1回増やす
@@ -410,134 +797,168 @@ class MCTSPlayer(BasePlayer):
                 if result == DISCARDED or result != QUEUING:
                     trajectories_batch.pop()
 
-            # 評価
-            if len(trajectories_batch) > 0:
-                self.eval_node()
-
-            # 破棄した探索経路のVirtual Lossを戻す
-            for trajectories in trajectories_batch_discarded:
-                for i in range(len(trajectories)):
-                    current_node, next_index = trajectories[i]
-                    current_node.move_count -= VIRTUAL_LOSS
-                    current_node.child_move_count[next_index] -= VIRTUAL_LOSS
-
-            # バックアップ
-            for trajectories in trajectories_batch:
-                result = None
-                for i in reversed(range(len(trajectories))):
-                    current_node, next_index = trajectories[i]
-                    if result is None:
-                        # 葉ノード
-                        result = 1.0 - current_node.child_node[next_index].value
-                    update_result(current_node, next_index, result)
-                    result = 1.0 - result
-
-            # 探索を打ち切るか確認
-            if self.check_interruption():
-                return
-
-            # PV表示
-            if self.pv_interval > 0:
-                elapsed_time = int((time.time() - self.begin_time) * 1000)
-                if elapsed_time > self.last_pv_print_time + self.pv_interval:
-                    self.last_pv_print_time = elapsed_time
-                    self.get_bestmove_and_print_pv()
+    # 評価した探索経路のバックアップと、破棄した探索経路のVirtual Lossを戻す
+    def backup_batch(
+        self,
+        trajectories_batch: list[list[tuple[int, int]]],
+        trajectories_batch_discarded: list[list[tuple[int, int]]],
+    ) -> None:
+        # 破棄した探索経路のVirtual Lossを戻す
+        pool = self.tree.pool
+        nodes: list[int] = []
+        edges: list[int] = []
+        for trajectories in trajectories_batch_discarded:
+            for current_node, next_edge in trajectories:
+                nodes.append(current_node)
+                edges.append(next_edge)
+        if nodes:
+            revert_virtual_loss(pool, nodes, edges)
+
+        # バックアップ(バッチ内のすべての経路をまとめて反映する)
+        nodes.clear()
+        edges.clear()
+        results: list[float] = []
+        for trajectories in trajectories_batch:
+            # 葉ノード
+            _, leaf_edge = trajectories[-1]
+            result = 1.0 - pool.value.item(pool.child_node.item(leaf_edge))
+            for current_node, next_edge in reversed(trajectories):
+                nodes.append(current_node)
+                edges.append(next_edge)
+                results.append(result)
+                result = 1.0 - result
+        if nodes:
+            update_results(pool, nodes, edges, results)
+
+    # 一定間隔でPVを表示
+    def print_pv_at_interval(self) -> None:
+        if self.pv_interval > 0:
+            elapsed_time = int((time.time() - self.begin_time) * 1000)
+            if elapsed_time > self.last_pv_print_time + self.pv_interval:
+                self.last_pv_print_time = elapsed_time
+                self.get_bestmove_and_print_pv()
 
     # UCT探索
-    def uct_search(self, board: Board, current_node: UctNode, trajectories: list) -> float:
-        # 子ノードのリストが初期化されていない場合、初期化する
-        if not current_node.child_node:
-            current_node.child_node = [None for _ in range(len(current_node.child_move))]
-        # UCB値が最大の手を求める
-        next_index = self.select_max_ucb_child(current_node)
-        # 選んだ手を着手
-        board.push(current_node.child_move[next_index])
-
-        # Virtual Lossを加算
-        current_node.move_count += VIRTUAL_LOSS
-        current_node.child_move_count[next_index] += VIRTUAL_LOSS
-
-        # 経路を記録
-        trajectories.append((current_node, next_index))
+    def uct_search(self, board: Board, current_node: int, trajectories: list, batch: EvalBatch) -> float:
+        pool = self.tree.pool
+        # UCB値が最大の手を選んでVirtual Lossを加算する(評価済みのノードが続く限りまとめて辿る)
+        path = self.select_max_ucb_path(current_node, batch)
+        for node, edge in path:
+            # 選んだ手を着手
+            board.push(pool.child_move.item(edge))
+            # 経路を記録
+            trajectories.append((node, edge))
+        current_node, next_edge = path[-1]
 
         # ノードの展開の確認
-        if current_node.child_node[next_index] is None:
-            # ノードの作成
-            child_node = current_node.create_child_node(next_index)
-
-            # 千日手チェック
+        next_node = pool.child_node.item(next_edge)
+        use_tt = self.tree.tt is not None
+        if next_node == NULL_NODE or use_tt:
+            # 千日手チェック(置換表でノードを共有する場合、千日手は経路によって変わるため毎回確認する)
             draw = board.is_draw()
-            if draw != NOT_REPETITION:
-                if draw == REPETITION_DRAW:
-                    # 千日手
-                    child_node.value = VALUE_DRAW
-                    result = 0.5
-                elif draw == REPETITION_WIN or draw == REPETITION_SUPERIOR:
-                    # 連続王手の千日手で勝ち、もしくは優越局面の場合
-                    child_node.value = VALUE_WIN
-                    result = 0.0
-                else:  # draw == REPETITION_LOSE or draw == REPETITION_INFERIOR
-                    # 連続王手の千日手で負け、もしくは劣等局面の場合
-                    child_node.value = VALUE_LOSE
-                    result = 1.0
-            else:
+        else:
+            draw = NOT_REPETITION
+
+        if draw != NOT_REPETITION:
+            value, result = repetition_result(draw)
+            # 置換表を使う場合は千日手のノードを作成しない
+            if next_node == NULL_NODE and not use_tt:
+                child_node = pool.create_child_node(next_edge)
+                pool.value[child_node] = value
+        else:
+            created = False
+            if next_node == NULL_NODE:
+                # ノードの作成(置換表に同一局面のノードがある場合は共有する)
+                next_node, created = self.tree.create_child_node(next_edge, board)
+
+            if created:
                 # 入玉宣言と3手詰めチェック
                 if board.is_nyugyoku() or board.mate_move(3):
-                    child_node.value = VALUE_WIN
+                    pool.value[next_node] = VALUE_WIN
                     result = 0.0
                 else:
                     # 候補手を展開する
-                    child_node.expand_node(board)
+                    pool.expand_node(next_node, board)
                     # 候補手がない場合
-                    if len(child_node.child_move) == 0:
-                        child_node.value = VALUE_LOSE
+                    if pool.child_num.item(next_node) == 0:
+                        pool.value[next_node] = VALUE_LOSE
                         result = 1.0
                     else:
                         # ノードを評価待ちキューに追加
-                        self.queue_node(board, child_node)
-                        return QUEUING
-        else:
-            # 評価待ちのため破棄する
-            next_node = current_node.child_node[next_index]
-            if next_node.value is None:
-                return DISCARDED
-
-            # 詰みと千日手チェック
-            if next_node.value == VALUE_WIN:
-                result = 0.0
-            elif next_node.value == VALUE_LOSE:
-                result = 1.0
-            elif next_node.value == VALUE_DRAW:
-                result = 0.5
-            elif len(next_node.child_move) == 0:
-                result = 1.0
+                        if self.queue_node(board, next_node, batch):
+                            return QUEUING
+                        # 評価キャッシュから評価できた場合
+                        result = 1.0 - pool.value.item(next_node)
             else:
-                # 手番を入れ替えて1手深く読む
-                result = self.uct_search(board, next_node, trajectories)
+                # 評価待ちのため破棄する
+                next_value = pool.value.item(next_node)
+                if math.isnan(next_value):
+                    return DISCARDED
+
+                # 詰みと千日手チェック
+                if next_value == VALUE_WIN:
+                    result = 0.0
+                elif next_value == VALUE_LOSE:
+                    result = 1.0
+                elif next_value == VALUE_DRAW:
+                    result = 0.5
+                elif pool.child_num.item(next_node) == 0:
+                    result = 1.0
+                else:
+                    # 手番を入れ替えて1手深く読む
+                    result = self.uct_search(board, next_node, trajectories, batch)
 
         if result == QUEUING or result == DISCARDED:
             return result
 
-        # 探索結果の反映
-        update_result(current_node, next_index, result)
-
-        return 1.0 - result
-
-    # UCB値が最大の手を求める
-    def select_max_ucb_child(self, node: UctNode):
-        q = np.divide(
-            node.child_sum_value,
-            node.child_move_count,
-            out=np.zeros(len(node.child_move), np.float32),
-            where=node.child_move_count != 0,
+        # 探索結果の反映(経路を葉から戻りながら手番ごとに反転する)
+        for node, edge in reversed(path):
+            update_result(pool, node, edge, result)
+            result = 1.0 - result
+
+        return result
+
+    # UCB値が最大の手を選んでVirtual Lossを加算し、選んだ経路(ノード, 辺)を返す
+    def select_max_ucb_path(self, node: int, batch: EvalBatch) -> list[tuple[int, int]]:
+        pool = self.tree.pool
+        if self.tree.tt is not None:
+            # 置換表でノードを共有する場合は、千日手を経路ごとに確認するため1手ずつ辿る
+            edge = self.select_max_ucb_child(node, batch)
+            pool.move_count[node] = pool.move_count.item(node) + VIRTUAL_LOSS
+            pool.child_move_count[edge] = pool.child_move_count.item(edge) + VIRTUAL_LOSS
+            return [(node, edge)]
+
+        depth = descend_max_ucb_path(
+            pool.move_count,
+            pool.value,
+            pool.first_child,
+            pool.child_num,
+            pool.child_move_count,
+            pool.child_sum_value,
+            pool.policy,
+            pool.child_node,
+            node,
+            self.c_puct,
+            VIRTUAL_LOSS,
+            batch.path_nodes,
+            batch.path_edges,
+            batch.ucb_scratch,
+        )
+        return list(zip(batch.path_nodes[:depth].tolist(), batch.path_edges[:depth].tolist()))
+
+    # UCB値が最大の手を求める(戻り値は辺のインデックス)
+    def select_max_ucb_child(self, node: int, batch: EvalBatch) -> int:
+        pool = self.tree.pool
+        return select_max_ucb_child(
+            pool.child_sum_value,
+            pool.child_move_count,
+            pool.policy,
+            pool.first_child.item(node),
+            pool.child_num.item(node),
+            pool.move_count.item(node),
+            self.c_puct,
+            batch.ucb_scratch,
         )
-        if node.move_count == 0:
-            u = 1.0
-        else:
-            u = np.sqrt(np.float32(node.move_count)) / (1 + node.child_move_count)
-        ucb = q + self.c_puct * u * node.policy
-
-        return np.argmax(ucb)
 
     # 最善手取得とinfoの表示
     def get_bestmove_and_print_pv(self) -> tuple[str, float, Optional[int]]:
@@ -545,13 +966,14 @@ class MCTSPlayer(BasePlayer):
         finish_time = time.time() - self.begin_time
 
         # 訪問回数最大の手を選択する
+        pool = self.tree.pool
         current_node = self.tree.current_head
-        selected_index = np.argmax(current_node.child_move_count)
+        selected_edge = self.select_max_visit_child(current_node)
 
         # 選択した着手の勝率の算出
-        bestvalue = current_node.child_sum_value[selected_index] / current_node.child_move_count[selected_index]
+        bestvalue = float(pool.child_sum_value[selected_edge] / pool.child_move_count[selected_edge])
 
-        bestmove = current_node.child_move[selected_index]
+        bestmove = int(pool.child_move[selected_edge])
 
         # 勝率を評価値に変換
         if bestvalue == 1.0:
@@ -564,21 +986,26 @@ class MCTSPlayer(BasePlayer):
         # PV
         pv = move_to_usi(bestmove)
         ponder_move = None
-        pv_node = current_node
-        while pv_node.child_node:
-            pv_node = pv_node.child_node[selected_index]
-            if pv_node is None or pv_node.child_move is None or pv_node.move_count == 0:
+        pv_node = int(pool.child_node[selected_edge])
+        # 置換表でノードを共有している場合に同じノードを繰り返し辿らないようにする
+        pv_nodes = {current_node}
+        while True:
+            if pv_node == NULL_NODE or not pool.is_expanded(pv_node) or pool.move_count[pv_node] == 0:
                 break
-            selected_index = np.argmax(pv_node.child_move_count)
-            pv += " " + move_to_usi(pv_node.child_move[selected_index])
+            if pv_node in pv_nodes:
+                break
+            pv_nodes.add(pv_node)
+            selected_edge = self.select_max_visit_child(pv_node)
+            pv += " " + move_to_usi(int(pool.child_move[selected_edge]))
             if ponder_move is None:
-                ponder_move = pv_node.child_move[selected_index]
+                ponder_move = int(pool.child_move[selected_edge])
+            pv_node = int(pool.child_node[selected_edge])
 
         print(
             "info nps {} time {} nodes {} score cp {} pv {}".format(
                 int(self.playout_count / finish_time) if finish_time > 0 else 0,
                 int(finish_time * 1000),
-                current_node.move_count,
+                pool.move_count[current_node],
                 cp,
                 pv,
             ),
@@ -587,6 +1014,12 @@ class MCTSPlayer(BasePlayer):
 
         return bestmove, bestvalue, ponder_move
 
+    # 訪問回数が最大の手を求める(戻り値は辺のインデックス)
+    def select_max_visit_child(self, node: int) -> int:
+        pool = self.tree.pool
+        first = int(pool.first_child[node])
+        return first + int(np.argmax(pool.child_move_count[first : first + pool.child_num[node]]))
+
     # 探索を打ち切るか確認
     def check_interruption(self) -> bool:
         # プレイアウト数が閾値を超えている
@@ -594,8 +1027,9 @@ class MCTSPlayer(BasePlayer):
             return self.playout_count >= self.halt
 
         # 候補手が1つの場合、中断する
+        pool = self.tree.pool
         current_node = self.tree.current_head
-        if current_node is not None and current_node.child_move is not None and len(current_node.child_move) == 1:
+        if current_node != NULL_NODE and pool.is_expanded(current_node) and pool.child_num[current_node] == 1:
             return True
 
         # 消費時間
@@ -606,7 +1040,9 @@ class MCTSPlayer(BasePlayer):
             return False
 
         # 探索回数が最も多い手と次に多い手を求める
-        child_move_count = current_node.child_move_count
+        child_range = pool.child_range(current_node)
+        child_move_count = pool.child_move_count[child_range.start : child_range.stop]
+        child_sum_value = pool.child_sum_value[child_range.start : child_range.stop]
         second_index, first_index = np.argpartition(child_move_count, -2)[-2:]
         second, first = child_move_count[[second_index, first_index]]
 
@@ -627,8 +1063,8 @@ class MCTSPlayer(BasePlayer):
             and self.remaining_time > self.time_limit * 2
             and (
                 first < second * 1.5
-                or current_node.child_sum_value[first_index] / child_move_count[first_index]
-                < current_node.child_sum_value[second_index] / child_move_count[second_index]
+                or child_sum_value[first_index] / child_move_count[first_index]
+                < child_sum_value[second_index] / child_move_count[second_index]
             )
         ):
             # 探索時間を2倍に延長
@@ -640,57 +1076,94 @@ class MCTSPlayer(BasePlayer):
 
         return True
 
-    # 入力特徴量の作成
-    def make_input_features(self, board: Board) -> None:
-        features_numpy = self.features.numpy()
-        self.features_setting.make_features(board, features_numpy[self.current_batch_index])
+    # ノードをキューに追加(評価キャッシュから評価できた場合はFalseを返す)
+    def queue_node(self, board: Board, node: int, batch: EvalBatch) -> bool:
+        key = (board.zobrist_hash(), self.features_mode)
+
+        # 評価キャッシュを確認
+        if self.eval_cache is not None:
+            cached = self.eval_cache.get(key)
+            if cached is not None:
+                probabilities, value = cached
+                self.set_node_eval(node, probabilities, value)
+                return False
+
+        # バッチ内に同一局面がある場合は、その推論結果を使う
+        index = batch.queued_keys.get(key)
+        if index is not None:
+            batch.eval_queue_duplicates.append((node, index))
+            return True
+        batch.queued_keys[key] = batch.current_batch_index
 
-    # ノードをキューに追加
-    def queue_node(self, board: Board, node: UctNode) -> None:
+        self.enqueue_node(board, node, batch, key)
+        return True
+
+    # 入力特徴量と合法手のラベルを作成してノードをキューに追加
+    def enqueue_node(self, board: Board, node: int, batch: EvalBatch, key: Optional[tuple[int, int]] = None) -> None:
         # 入力特徴量を作成
-        self.make_input_features(board)
+        if self.evaluator is None:
+            raise ValueError("evaluator is None")
+        self.evaluator.make_input_features(board, batch.features, batch.current_batch_index)
+
+        # 合法手のラベルを作成(推論結果から合法手の確率だけを取り出すのに使う)
+        pool = self.tree.pool
+        child_range = pool.child_range(node)
+        move_labels = self.make_move_labels(pool.child_move[child_range.start : child_range.stop], board.turn)
+        self.evaluator.set_move_labels(batch.move_labels, batch.legal_moves_num, batch.current_batch_index, move_labels)
 
         # ノードをキューに追加
-        if self.eval_queue is None:
-            raise ValueError("eval_queue is None")
-        self.eval_queue[self.current_batch_index].set(node, board.turn)
-        self.current_batch_index += 1
-
-    # 推論
-    def infer(self) -> tuple[np.ndarray, np.ndarray]:
-        with torch.no_grad():
-            if self.features is None or self.model is None:
-                raise ValueError("features or model is None")
-            x = self.features[0 : self.current_batch_index].to(self.device)
-            policy_logits, value_logits = self.model(x)
-            return policy_logits.cpu().numpy(), torch.sigmoid(value_logits).cpu().numpy()
-
-    # 着手を表すラベル作成
-    def make_move_label(self, move: int, color: int) -> int:
-        return make_move_label(move, color)
+        batch.eval_queue[batch.current_batch_index].set(node, board.turn, key)
+        batch.current_batch_index += 1
+
+    # 着手を表すラベルをまとめて作成
+    def make_move_labels(self, moves: np.ndarray, color: int) -> np.ndarray:
+        return make_move_labels(moves, color)
 
     # 局面の評価
-    def eval_node(self) -> None:
+    def eval_node(self, batch: EvalBatch) -> None:
         # 推論
-        policy_logits, values = self.infer()
-
-        for i, (policy_logit, value) in enumerate(zip(policy_logits, values)):
-            current_node = self.eval_queue[i].node
-            color = self.eval_queue[i].color
-
-            # 合法手一覧
-            legal_move_probabilities = np.empty(len(current_node.child_move), dtype=np.float32)
-            for j in range(len(current_node.child_move)):
-                move = current_node.child_move[j]
-                move_label = self.make_move_label(move, color)
-                legal_move_probabilities[j] = policy_logit[move_label]
-
-            # Boltzmann分布
-            probabilities = softmax_temperature_with_normalize(legal_move_probabilities, self.temperature)
-
-            # ノードの値を更新
-            current_node.policy = probabilities
-            current_node.value = float(value)
+        if self.evaluator is None:
+            raise ValueError("evaluator is None")
+        probabilities, values = self.evaluator.infer_legal_moves(batch.inputs, batch.current_batch_index)
+
+        # 推論結果をノードに反映
+        self.set_eval_results(batch, probabilities, values)
+
+    # バッチの推論結果(温度パラメータを適用した合法手の確率と勝率)をノードに反映
+    def set_eval_results(self, batch: EvalBatch, legal_move_probabilities: np.ndarray, values: np.ndarray) -> None:
+        pool = self.tree.pool
+        size = len(values)
+        eval_queue = batch.eval_queue[:size]
+        nodes = np.fromiter((element.node for element in eval_queue), dtype=np.int64, count=size)
+        values = values.reshape(size)
+
+        # 合法手の数だけ先頭から取り出し、各ノードの子の辺にまとめて書き込む(ノードの子の辺は連続している)
+        child_nums = pool.child_num[nodes]
+        legal_moves = np.arange(legal_move_probabilities.shape[1]) < child_nums[:, None]
+        edges = pool.first_child[nodes][:, None] + np.arange(legal_move_probabilities.shape[1])
+        pool.policy[edges[legal_moves]] = legal_move_probabilities[legal_moves]
+        pool.value[nodes] = values
+        pool.evaluated[nodes] = True
+
+        # 評価キャッシュに登録
+        if self.eval_cache is not None:
+            for i, (element, child_num, value) in enumerate(zip(eval_queue, child_nums.tolist(), values.tolist())):
+                if element.key is not None:
+                    self.eval_cache.put(element.key, legal_move_probabilities[i, :child_num], value)
+
+        # バッチ内の同一局面のノードに推論結果をコピーする
+        for node, i in batch.eval_queue_duplicates:
+            source_node = batch.eval_queue[i].node
+            source_range = pool.child_range(source_node)
+            self.set_node_eval(node, pool.policy[source_range.start : source_range.stop], pool.value.item(source_node))
+
+    # 評価結果をノードに設定
+    def set_node_eval(self, node: int, probabilities: np.ndarray, value: float) -> None:
+        pool = self.tree.pool
+        child_range = pool.child_range(node)
+        pool.policy[child_range.start : child_range.stop] = probabilities
+        pool.value[node] = value
+        pool.evaluated[node] = True
 
 
 if __name__ == "__main__":
@@ -0,0 +1,140 @@
+import multiprocessing
+import os
+import time
+import numpy as np
+import typer
+from typing import Optional
+from typing_extensions import Annotated
+from cshogi import Board, HuffmanCodedPosAndEval
+from app.domain.features import FEATURES_SETTINGS
+from app.infrastructure.dataloader import (
+    PACKED_FEATURES_EXTENSION,
+    make_batch,
+    packed_features_dtype,
+    save_packed_features_metadata,
+)
+from app.interfaces.logger import Logger
+
+preprocess_app = typer.Typer()
+
+# デフォルトの1シャードあたりの局面数
+DEFAULT_SHARD_SIZE = 1_000_000
+# 1回にまとめて入力特徴量を作成する局面数
+PREPROCESS_CHUNK_SIZE = 1024
+
+# シャードに含める局面の範囲(ファイル名, 開始位置, 終了位置)のリスト
+ShardSegments = list[tuple[str, int, int]]
+
+
+# 入力ファイルの局面を先頭から順にシャードの大きさごとに分割する
+def split_shards(files: list[str], shard_size: int) -> list[ShardSegments]:
+    shards: list[ShardSegments] = []
+    segments: ShardSegments = []
+    remaining = shard_size
+    for path in files:
+        size = os.path.getsize(path) // HuffmanCodedPosAndEval.itemsize
+        start = 0
+        while start < size:
+            stop = min(size, start + remaining)
+            segments.append((path, start, stop))
+            remaining -= stop - start
+            start = stop
+            if remaining == 0:
+                shards.append(segments)
+                segments = []
+                remaining = shard_size
+    if segments:
+        shards.append(segments)
+    return shards
+
+
+# 1シャード分の局面の入力特徴量を作成し、ビット単位で詰めて書き込む(戻り値は局面数と書き込んだbyte数)
+def preprocess_shard(segments: ShardSegments, output_path: str, features_mode: int) -> tuple[int, int]:
+    features_setting = FEATURES_SETTINGS[features_mode]
+    positions = sum(stop - start for _, start, stop in segments)
+    records = np.lib.format.open_memmap(
+        output_path, mode="w+", dtype=packed_features_dtype(features_setting.features_num), shape=(positions,)
+    )
+
+    board = Board()
+    features = np.empty((PREPROCESS_CHUNK_SIZE, features_setting.features_num, 9, 9), dtype=np.float32)
+    move_label = np.empty(PREPROCESS_CHUNK_SIZE, dtype=np.int64)
+    result = np.empty(PREPROCESS_CHUNK_SIZE, dtype=np.float32)
+    color = np.empty(PREPROCESS_CHUNK_SIZE, dtype=np.int32)
+
+    offset = 0
+    for path, start, stop in segments:
+        hcpes = np.memmap(path, dtype=HuffmanCodedPosAndEval, mode="r")
+        for i in range(start, stop, PREPROCESS_CHUNK_SIZE):
+            hcpevec = hcpes[i : min(stop, i + PREPROCESS_CHUNK_SIZE)]
+            size = len(hcpevec)
+            make_batch(board, features_setting, hcpevec, features, move_label, result, color)
+            chunk = records[offset : offset + size]
+            chunk["features"] = np.packbits(features[:size].reshape(size, -1) != 0, axis=1)
+            chunk["moveLabel"] = move_label[:size]
+            chunk["result"] = result[:size]
+            offset += size
+        del hcpes
+
+    records.flush()
+    nbytes = records.nbytes
+    del records
+    save_packed_features_metadata(output_path, features_mode)
+    return positions, nbytes
+
+
+def preprocess_shard_task(task: tuple[ShardSegments, str, int]) -> tuple[str, int, int]:
+    segments, output_path, features_mode = task
+    positions, nbytes = preprocess_shard(segments, output_path, features_mode)
+    return output_path, positions, nbytes
+
+
+@preprocess_app.command()
+def preprocess(
+    hcpe: Annotated[list[str], typer.Option(help="hcpe file (repeatable)")],
+    output: Annotated[str, typer.Option(help="output file prefix (writes {prefix}-00000.npy, ...)")],
+    shard_size: Annotated[int, typer.Option(help="Number of positions in each shard")] = DEFAULT_SHARD_SIZE,
+    workers: Annotated[int, typer.Option(help="Number of worker processes (0: in this process)")] = 0,
+    log: Annotated[Optional[str], typer.Option(help="log file path")] = None,
+    input_features: Annotated[
+        int, typer.Option("-i", help="select custom input features mode (default: 0, kiki: 1, himo: 2)")
+    ] = 0,
+) -> None:
+    """Precompute bit-packed input features, move labels and results for training"""
+
+    logging = Logger("preprocess", log_file=log).get_logger()
+
+    shards = split_shards(hcpe, shard_size)
+    tasks = [
+        (segments, "{}-{:05}{}".format(output, i, PACKED_FEATURES_EXTENSION), input_features)
+        for i, segments in enumerate(shards)
+    ]
+    logging.info("shards = {}, input features mode = {}".format(len(tasks), input_features))
+
+    total_positions = 0
+    total_bytes = 0
+    begin_time = time.time()
+    if workers > 0:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.imap_unordered(preprocess_shard_task, tasks)
+            for output_path, positions, nbytes in results:
+                total_positions += positions
+                total_bytes += nbytes
+                logging.info("{}: {} positions".format(output_path, positions))
+    else:
+        for task in tasks:
+            output_path, positions, nbytes = preprocess_shard_task(task)
+            total_positions += positions
+            total_bytes += nbytes
+            logging.info("{}: {} positions".format(output_path, positions))
+    elapsed_time = time.time() - begin_time
+
+    logging.info(
+        "positions = {}, size = {:.1f}MB, time = {:.2f}s, {:.0f} positions/sec, {:.1f}MB/s".format(
+            total_positions,
+            total_bytes / 1024 / 1024,
+            elapsed_time,
+            total_positions / elapsed_time if elapsed_time > 0 else 0,
+            total_bytes / 1024 / 1024 / elapsed_time if elapsed_time > 0 else 0,
+        )
+    )
@@ -0,0 +1,101 @@
+import itertools
+import torch
+import typer
+from typing import Optional
+from typing_extensions import Annotated
+from app.domain.features import FEATURES_SETTINGS
+from app.domain.policy_value_network import PolicyValueNetwork
+from app.infrastructure.dataloader import HcpeDataLoader
+from app.infrastructure.quantization import quantize_model, save_quantized_model
+from app.interfaces.logger import Logger
+from app.usecases.bench import DEFAULT_LATENCY_BATCH_SIZES, measure_latency
+from app.usecases.test import test_model, report_test_result
+
+quantize_app = typer.Typer()
+
+
+@quantize_app.command()
+def quantize(
+    resume: Annotated[str, typer.Option("-r", help="checkpoint made by train")],
+    calibration_data: Annotated[
+        str, typer.Option(help="calibration data file (hcpe, or packed .npy made by preprocess)")
+    ],
+    output: Annotated[str, typer.Option("-o", help="output file of the INT8 quantized model")],
+    calibration_batches: Annotated[int, typer.Option(help="Number of mini-batches used for calibration")] = 32,
+    batchsize: Annotated[int, typer.Option("-b", help="Number of positions in each calibration mini-batch")] = 256,
+    test_data: Annotated[
+        Optional[str], typer.Option(help="test data file to compare the accuracy of the fp32 and INT8 models")
+    ] = None,
+    testbatchsize: Annotated[int, typer.Option(help="Number of positions in each test mini-batch")] = 1024,
+    limit: Annotated[Optional[int], typer.Option("-l", help="limit of test case")] = None,
+    latency_batchsize: Annotated[
+        list[int], typer.Option(help="batch size to measure the inference latency (repeatable)")
+    ] = DEFAULT_LATENCY_BATCH_SIZES,
+    repeat: Annotated[int, typer.Option(help="Number of inferences averaged for each latency")] = 10,
+    seed: Annotated[Optional[int], typer.Option(help="random seed for sampling the calibration positions")] = None,
+    log: Annotated[Optional[str], typer.Option(help="log file path")] = None,
+    input_features: Annotated[
+        int, typer.Option("-i", help="select custom input features mode (default: 0, kiki: 1, himo: 2)")
+    ] = 0,
+    activation_function: Annotated[
+        int, typer.Option("-a", help="select custom input features mode (relu: 0, : 1)")
+    ] = 0,
+) -> None:
+    """Quantize a checkpoint to INT8 with post-training static quantization (CPU inference)"""
+
+    logging = Logger("quantize", log_file=log).get_logger()
+    # 量子化した演算はCPUでのみ実行できるため、比較もCPUで行う
+    device = torch.device("cpu")
+    features_num = FEATURES_SETTINGS[input_features].features_num
+
+    model = PolicyValueNetwork(input_features=features_num, activation_function_mode=activation_function)
+    logging.info("Loading the checkpoint from {}".format(resume))
+    model.load_state_dict(torch.load(resume, map_location=device)["model"])
+    model.eval()
+
+    # 学習データからランダムに選んだ局面で各層の値の範囲を観測する
+    logging.info("Calibrating with {} x {} positions".format(calibration_batches, batchsize))
+    calibration_dataloader = HcpeDataLoader(
+        calibration_data, batchsize, device, shuffle=True, features_mode=input_features, seed=seed
+    )
+    batches = (x for x, _, _ in itertools.islice(calibration_dataloader, calibration_batches))
+    quantized_model = quantize_model(model, batches)
+    calibration_dataloader.close()
+
+    save_quantized_model(quantized_model, output, features_num, activation_function)
+    logging.info("Saved the quantized model to {}".format(output))
+
+    # fp32とINT8の正解率の比較
+    if test_data is not None:
+        test_dataloader = HcpeDataLoader(test_data, testbatchsize, device, features_mode=input_features, limit=limit)
+        logging.info("test position num = {}".format(len(test_dataloader)))
+        reports = {}
+        for name, m in [("fp32", model), ("int8", quantized_model)]:
+            reports[name] = test_model(m, test_dataloader)
+            logging.info("{}: {}".format(name, report_test_result(reports[name])))
+        test_dataloader.close()
+        test_steps = {name: report["test_steps"] for name, report in reports.items()}
+        logging.info(
+            "int8 - fp32: policy accuracy {:+.07f}, value accuracy {:+.07f}, policy loss {:+.07f}, value loss {:+.07f}".format(
+                *[
+                    reports["int8"][key] / test_steps["int8"] - reports["fp32"][key] / test_steps["fp32"]
+                    for key in [
+                        "sum_test_accuracy_policy",
+                        "sum_test_accuracy_value",
+                        "sum_test_loss_policy",
+                        "sum_test_loss_value",
+                    ]
+                ]
+            )
+        )
+
+    # バッチサイズごとの推論時間の比較
+    for batch_size in latency_batchsize:
+        x = torch.randint(0, 2, (batch_size, features_num, 9, 9), dtype=torch.float32)
+        fp32_latency = measure_latency(model, x, repeat)
+        int8_latency = measure_latency(quantized_model, x, repeat)
+        logging.info(
+            "batchsize = {}, fp32 = {:.2f}ms, int8 = {:.2f}ms, speedup = {:.2f}x".format(
+                batch_size, fp32_latency, int8_latency, fp32_latency / int8_latency if int8_latency > 0 else 0
+            )
+        )
@@ -4,7 +4,8 @@ from typing import Optional
 from typing_extensions import Annotated
 from app.interfaces.logger import Logger
 from app.domain.policy_value_network import PolicyValueNetwork
-from app.infrastructure.dataloader import HcpeDataLoader
+from app.infrastructure.dataloader import HcpeDataLoader, DEFAULT_PREFETCH
+from app.infrastructure.precision import DEFAULT_PRECISION, autocast, check_precision
 from app.domain.features import FEATURES_SETTINGS
 
 test_app = typer.Typer()
@@ -26,8 +27,8 @@ def binary_accuracy(y: torch.Tensor, t: torch.Tensor) -> float:
     return pred.eq(truth).sum().item() / len(t)
 
 
-def test_model(model, test_dataloader):
-    # テストデータすべてを使用して評価する
+def test_model(model, test_dataloader, precision: str = DEFAULT_PRECISION):
+    # テストデータすべてを使用して評価する(量子化モデルはパラメータを持たないため、デバイスは入力から決める)
     test_steps = 0
     sum_test_loss_policy = 0
     sum_test_loss_value = 0
@@ -36,13 +37,14 @@ def test_model(model, test_dataloader):
     model.eval()
     with torch.no_grad():
         for x, move_label, result in test_dataloader:
-            y1, y2 = model(x)
-
-            test_steps += 1
-            sum_test_loss_policy += cross_entropy_loss(y1, move_label).item()
-            sum_test_loss_value += bce_with_logits_loss(y2, result).item()
-            sum_test_accuracy_policy += accuracy(y1, move_label)
-            sum_test_accuracy_value += binary_accuracy(y2, result)
+            with autocast(x.device, precision):
+                y1, y2 = model(x)
+
+                test_steps += 1
+                sum_test_loss_policy += cross_entropy_loss(y1, move_label).item()
+                sum_test_loss_value += bce_with_logits_loss(y2, result).item()
+                sum_test_accuracy_policy += accuracy(y1, move_label)
+                sum_test_accuracy_value += binary_accuracy(y2, result)
     return {
         "test_steps": test_steps,
         "sum_test_loss_policy": sum_test_loss_policy,
@@ -70,7 +72,7 @@ def report_test_result(report: dict):
 
 @test_app.command("test_model")
 def test_model_cli(
-    test_data: Annotated[str, typer.Option(help="test data file")],
+    test_data: Annotated[str, typer.Option(help="test data file (hcpe, or packed .npy made by preprocess)")],
     resume: Annotated[str, typer.Option("-r", help="Resume from snapshot")],
     gpu: Annotated[int, typer.Option("-g", help="GPU ID")] = 0,
     testbatchsize: Annotated[int, typer.Option(help="Number of positions in each test mini-batch")] = 1024,
@@ -81,8 +83,15 @@ def test_model_cli(
     input_features: Annotated[
         int, typer.Option("-i", help="select custom input features mode (default: 0, kiki: 1, himo: 2)")
     ] = 0,
+    workers: Annotated[int, typer.Option(help="Number of data loader worker processes (0: single thread)")] = 0,
+    prefetch: Annotated[
+        int, typer.Option(help="Number of batches prefetched by the worker processes")
+    ] = DEFAULT_PREFETCH,
+    mmap: Annotated[bool, typer.Option(help="Memory-map the data files instead of reading them into memory")] = False,
+    precision: Annotated[str, typer.Option(help="inference precision (fp32, bf16)")] = DEFAULT_PRECISION,
 ) -> None:
     logging = Logger("test", log_file=log).get_logger()
+    check_precision(precision)
 
     # デバイス
     if gpu >= 0:
@@ -98,7 +107,15 @@ def test_model_cli(
     # テストデータ読み込み
     logging.info("Reading test data")
     test_dataloader = HcpeDataLoader(
-        test_data, testbatchsize, device, features_mode=input_features, limit=limit, shuffle=shuffle
+        test_data,
+        testbatchsize,
+        device,
+        features_mode=input_features,
+        limit=limit,
+        shuffle=shuffle,
+        workers=workers,
+        prefetch=prefetch,
+        mmap=mmap,
     )
     logging.info("test position num = {}".format(len(test_dataloader)))
 
@@ -108,4 +125,5 @@ def test_model_cli(
     model.load_state_dict(checkpoint_data["model"])
 
     logging.info("Testing")
-    logging.info(report_test_result(test_model(model, test_dataloader)))
+    logging.info(report_test_result(test_model(model, test_dataloader, precision)))
+    test_dataloader.close()
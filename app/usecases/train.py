@@ -6,8 +6,15 @@ import time
 from app.domain.features import FEATURES_SETTINGS
 from app.interfaces.logger import Logger
 from app.domain.policy_value_network import PolicyValueNetwork
-from app.infrastructure.dataloader import HcpeDataLoader
+from app.infrastructure.dataloader import (
+    HcpeDataLoader,
+    DEFAULT_PREFETCH,
+    DEFAULT_SHUFFLE_BUFFER,
+    DEFAULT_READ_AHEAD,
+    DEFAULT_FILES_IN_FLIGHT,
+)
 from app.infrastructure.directory import ensure_directory_exists
+from app.infrastructure.precision import DEFAULT_PRECISION, autocast, check_precision
 from app.usecases.test import test_model, report_test_result
 from typing_extensions import Annotated
 import typer
@@ -17,8 +24,8 @@ train_app = typer.Typer()
 
 @train_app.command()
 def train(
-    train_data: Annotated[list[str], typer.Option(help="training data file")],
-    test_data: Annotated[str, typer.Option(help="test data file")],
+    train_data: Annotated[list[str], typer.Option(help="training data file (hcpe, or packed .npy made by preprocess)")],
+    test_data: Annotated[str, typer.Option(help="test data file (hcpe, or packed .npy made by preprocess)")],
     gpu: Annotated[int, typer.Option("-g", help="GPU ID")] = 0,
     train_cnt: Annotated[int, typer.Option("-e", help="Number of epoch times")] = 1,
     batchsize: Annotated[int, typer.Option("-b", help="Number of positions in each mini-batch")] = 2048,
@@ -35,12 +42,35 @@ def train(
     activation_function: Annotated[
         int, typer.Option("-a", help="select custom input features mode (relu: 0, : 1)")
     ] = 0,
+    workers: Annotated[int, typer.Option(help="Number of data loader worker processes (0: single thread)")] = 0,
+    prefetch: Annotated[
+        int, typer.Option(help="Number of batches prefetched by the worker processes")
+    ] = DEFAULT_PREFETCH,
+    seed: Annotated[Optional[int], typer.Option(help="Random seed for shuffling the training data")] = None,
+    mmap: Annotated[bool, typer.Option(help="Memory-map the data files instead of reading them into memory")] = False,
+    eval_probe: Annotated[
+        bool, typer.Option(help="Evaluate on a fixed batch of the test data built once instead of a random batch")
+    ] = False,
+    stream: Annotated[
+        bool, typer.Option(help="Read the training data files sequentially and shuffle through a shuffle buffer")
+    ] = False,
+    shuffle_buffer: Annotated[
+        int, typer.Option(help="Number of positions in the shuffle buffer (with --stream)")
+    ] = DEFAULT_SHUFFLE_BUFFER,
+    read_ahead: Annotated[
+        int, typer.Option(help="Number of positions read from a file at once (with --stream)")
+    ] = DEFAULT_READ_AHEAD,
+    files_in_flight: Annotated[
+        int, typer.Option(help="Number of files read interleaved (with --stream)")
+    ] = DEFAULT_FILES_IN_FLIGHT,
+    precision: Annotated[str, typer.Option(help="training precision (fp32, bf16 autocast)")] = DEFAULT_PRECISION,
 ) -> None:
     """Train policy value network"""
 
     logging = Logger("train", log_file=log).get_logger()
     logging.info("batchsize={}".format(batchsize))
     logging.info("lr={}".format(lr))
+    logging.info("precision={}".format(check_precision(precision)))
 
     # デバイス
     if gpu >= 0:
@@ -79,10 +109,33 @@ def train(
 
     # 訓練データ読み込み
     logging.info("Reading training data")
-    train_dataloader = HcpeDataLoader(train_data, batchsize, device, shuffle=True, features_mode=input_features)
+    train_dataloader = HcpeDataLoader(
+        train_data,
+        batchsize,
+        device,
+        shuffle=True,
+        features_mode=input_features,
+        workers=workers,
+        prefetch=prefetch,
+        seed=seed,
+        mmap=mmap,
+        stream=stream,
+        shuffle_buffer=shuffle_buffer,
+        read_ahead=read_ahead,
+        files_in_flight=files_in_flight,
+    )
     # テストデータ読み込み
     logging.info("Reading test data")
-    test_dataloader = HcpeDataLoader(test_data, testbatchsize, device, features_mode=input_features)
+    test_dataloader = HcpeDataLoader(
+        test_data,
+        testbatchsize,
+        device,
+        features_mode=input_features,
+        workers=workers,
+        prefetch=prefetch,
+        mmap=mmap,
+        probe=eval_probe,
+    )
 
     # 読み込んだデータ数を表示
     logging.info("train position num = {}".format(len(train_dataloader)))
@@ -128,11 +181,12 @@ def train(
             model.train()
 
             # 順伝播
-            y1, y2 = model(x)
-            # 損失計算
-            loss_policy = cross_entropy_loss(y1, move_label)
-            loss_value = bce_with_logits_loss(y2, result)
-            loss = loss_policy + loss_value
+            with autocast(device, precision):
+                y1, y2 = model(x)
+                # 損失計算
+                loss_policy = cross_entropy_loss(y1, move_label)
+                loss_value = bce_with_logits_loss(y2, result)
+                loss = loss_policy + loss_value
             # 誤差逆伝播
             optimizer.zero_grad()
             loss.backward()
@@ -151,7 +205,7 @@ def train(
                 model.eval()
 
                 x, move_label, result = test_dataloader.sample()
-                with torch.no_grad():
+                with torch.no_grad(), autocast(device, precision):
                     # 推論
                     y1, y2 = model(x)
                     # 損失計算
@@ -204,7 +258,7 @@ def train(
                 sum_loss_policy_epoch / steps_epoch,
                 sum_loss_value_epoch / steps_epoch,
                 (sum_loss_policy_epoch + sum_loss_value_epoch) / steps_epoch,
-                {report_test_result(test_model(model, test_dataloader))},
+                {report_test_result(test_model(model, test_dataloader, precision))},
             )
         )
 
@@ -213,6 +267,10 @@ def train(
             save_checkpoint(checkpoint_base + checkpoint)
             # dlshogi 1/6
 
+    # ワーカープロセスを終了
+    train_dataloader.close()
+    test_dataloader.close()
+
 
 if __name__ == "__main__":
     train_app()
@@ -0,0 +1,100 @@
+import random
+from typing import Callable
+import cshogi
+import numpy as np
+import pytest
+from cshogi import WHITE
+from app.domain.features import FEATURES_KIKI_NUM
+from app.domain.moves import (
+    BASE_INDEX,
+    DIRECTION_NUM,
+    MOVE_OFFSET,
+    PIECE_DIRECTIONS,
+    make_himo_features,
+    make_kiki_features,
+)
+
+# 比較する局面数
+POSITIONS_NUM = 2000
+
+
+# 表を使う前の実装(駒ごとに方向をたどる)
+def reference_attack_features(board: cshogi.Board, features: np.ndarray, himo: bool) -> None:
+    for square, piece in enumerate(board.pieces):
+        piece_type = cshogi.piece_to_piece_type(piece)
+        if piece_type:
+            piece_color = 0 if piece == piece_type else 1
+            piece_direction_list = PIECE_DIRECTIONS.get(piece_type, ([], []))
+
+            is_own = piece_color == board.turn
+            direction_offset = BASE_INDEX + (0 if is_own else DIRECTION_NUM)
+
+            # 1マス移動
+            for direction in piece_direction_list[0]:
+                move_y, move_x = MOVE_OFFSET[direction]
+                x = square // 9 + move_x
+                y = square % 9 + move_y * (-1 if not is_own else 1)
+
+                if 0 <= y and y < 9 and 0 <= x and x < 9 and (not himo or board.piece_type(y + x * 9) != 0):
+                    features[direction_offset + direction][x][y] = 1
+
+            # 複数マス移動
+            for direction in piece_direction_list[1]:
+                move_y, move_x = MOVE_OFFSET[direction]
+                x = square // 9
+                y = square % 9
+                while True:
+                    x += move_x
+                    y += move_y * (-1 if not is_own else 1)
+                    if not (0 <= y and y < 9 and 0 <= x and x < 9):
+                        break
+                    if board.piece_type(y + x * 9) != 0:
+                        features[direction_offset + direction][x][y] = 1
+                        break
+                    if not himo:
+                        features[direction_offset + direction][x][y] = 1
+
+
+# 初期局面からランダムに指した局面(固定のシードで、後手番と成り駒を含む)
+def random_sfens(num: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    sfens: list[str] = []
+    board = cshogi.Board()
+    while len(sfens) < num:
+        legal_moves = list(board.legal_moves)
+        if not legal_moves or board.move_number > 200:
+            board.reset()
+            continue
+        # 成る手を優先して成り駒を増やす
+        promotions = [move for move in legal_moves if cshogi.move_is_promotion(move)]
+        board.push(rng.choice(promotions if promotions and rng.random() < 0.5 else legal_moves))
+        sfens.append(board.sfen())
+    return sfens
+
+
+@pytest.fixture(scope="module")
+def sfens() -> list[str]:
+    return random_sfens(POSITIONS_NUM)
+
+
+def test_random_positions_cover_white_and_promoted_pieces(sfens: list[str]) -> None:
+    boards = [cshogi.Board(sfen) for sfen in sfens]
+    assert any(board.turn == WHITE for board in boards)
+    assert any(cshogi.piece_to_piece_type(piece) >= cshogi.PROM_PAWN for board in boards for piece in board.pieces)
+
+
+# 利き(入力特徴量のモード1)とヒモ(モード2)
+@pytest.mark.parametrize("make_features, himo", [(make_kiki_features, False), (make_himo_features, True)])
+def test_attack_features_match_reference(
+    sfens: list[str], make_features: Callable[[cshogi.Board, np.ndarray], None], himo: bool
+) -> None:
+    board = cshogi.Board()
+    features = np.zeros((FEATURES_KIKI_NUM, 9, 9), dtype=np.float32)
+    expected = np.zeros_like(features)
+    for sfen in sfens:
+        board.set_sfen(sfen)
+        features.fill(0)
+        expected.fill(0)
+        make_features(board, features)
+        reference_attack_features(board, expected, himo)
+        np.testing.assert_array_equal(features, expected, err_msg=sfen)
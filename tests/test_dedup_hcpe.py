@@ -0,0 +1,95 @@
+import subprocess
+import sys
+from collections import Counter, defaultdict
+from pathlib import Path
+import numpy as np
+import pytest
+from cshogi import HuffmanCodedPosAndEval, BLACK_WIN, WHITE_WIN, DRAW
+
+DEDUP_HCPE = Path(__file__).resolve().parents[1] / "utils" / "dedup_hcpe.py"
+TOP_MOVES = 4
+
+
+def run_dedup(tmp_path: Path, inputs: list[Path], *options: str) -> tuple[np.ndarray, np.ndarray]:
+    output = tmp_path / "output.hcpe"
+    stats = tmp_path / "stats.npy"
+    subprocess.run(
+        [sys.executable, str(DEDUP_HCPE), *map(str, inputs), str(output), "--stats", str(stats)]
+        + ["--top_moves", str(TOP_MOVES), *options],
+        check=True,
+        capture_output=True,
+    )
+    return np.fromfile(output, dtype=HuffmanCodedPosAndEval), np.load(stats)
+
+
+# 局面の半分が同じ局面に偏った乱数のhcpe(hcpは局面として復号しないため乱数のバイト列でよい)
+def make_skewed_hcpes(size: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    positions = rng.integers(0, 256, (size // 4, 32), dtype=np.uint8)
+    hcpes = np.zeros(size, dtype=HuffmanCodedPosAndEval)
+    indices = np.where(rng.random(size) < 0.5, 0, rng.integers(0, len(positions), size))
+    hcpes["hcp"] = positions[indices]
+    # 上位ビットが立った指し手(int16では負の値)も含める
+    hcpes["bestMove16"] = rng.choice(np.array([-30000, -1, 7, 1234, 20000], dtype=np.int16), size)
+    hcpes["eval"] = rng.integers(-3000, 3000, size)
+    hcpes["gameResult"] = rng.choice([BLACK_WIN, WHITE_WIN, DRAW], size)
+    return hcpes
+
+
+# 辞書で局面ごとに集計した結果(局面 → 出力の局面と集計結果)
+def dedup_reference(hcpes: np.ndarray) -> dict[bytes, tuple]:
+    moves: dict[bytes, Counter] = defaultdict(Counter)
+    evals: dict[bytes, list[int]] = defaultdict(list)
+    results: dict[bytes, list[float]] = defaultdict(list)
+    for hcpe in hcpes:
+        key = hcpe["hcp"].tobytes()
+        moves[key][int(hcpe["bestMove16"])] += 1
+        evals[key].append(int(hcpe["eval"]))
+        game_result = hcpe["gameResult"]
+        results[key].append(1.0 if game_result == BLACK_WIN else 0.0 if game_result == WHITE_WIN else 0.5)
+
+    reference = {}
+    for key, move_counts in moves.items():
+        # 指された回数の多い順、同じ回数の場合はint16の値の小さい順
+        ranked = sorted(move_counts.items(), key=lambda item: (-item[1], item[0]))
+        result = sum(results[key]) / len(results[key])
+        game_result = BLACK_WIN if result > 0.5 else WHITE_WIN if result < 0.5 else DRAW
+        eval = int(np.rint(sum(evals[key]) / len(evals[key])))
+        reference[key] = (ranked[0][0], eval, game_result, len(evals[key]), result, ranked[:TOP_MOVES])
+    return reference
+
+
+def test_dedup_matches_dict_reference_on_skewed_input(tmp_path: Path) -> None:
+    hcpes = make_skewed_hcpes(30000, seed=0)
+    input_paths = [tmp_path / "a.hcpe", tmp_path / "b.hcpe"]
+    hcpes[:20000].tofile(input_paths[0])
+    hcpes[20000:].tofile(input_paths[1])
+    # メモリの上限とパーティション数を小さくし、パーティションを分割し直す場合も確認する
+    output, stats = run_dedup(tmp_path, input_paths, "--memory", "1", "--max_partitions", "2", "--chunk", "1000")
+
+    reference = dedup_reference(hcpes)
+    assert len(output) == len(stats) == len(reference)
+    for record, record_stats in zip(output, stats):
+        best_move, eval, game_result, count, result, ranked = reference[record["hcp"].tobytes()]
+        assert (int(record["bestMove16"]), int(record["eval"]), int(record["gameResult"])) == (
+            best_move,
+            eval,
+            game_result,
+        )
+        assert int(record_stats["count"]) == count
+        assert record_stats["result"] == pytest.approx(result, abs=1e-6)
+        ranked_moves = [move for move, _ in ranked]
+        assert record_stats["moves"][: len(ranked)].view(np.int16).tolist() == ranked_moves
+        assert record_stats["moveCounts"][: len(ranked)].tolist() == [move_count for _, move_count in ranked]
+
+
+def test_dedup_skips_empty_input(tmp_path: Path) -> None:
+    empty = tmp_path / "empty.hcpe"
+    empty.touch()
+    output, stats = run_dedup(tmp_path, [empty])
+    assert len(output) == len(stats) == 0
+
+    hcpes = make_skewed_hcpes(100, seed=1)
+    hcpes.tofile(tmp_path / "a.hcpe")
+    output, stats = run_dedup(tmp_path, [empty, tmp_path / "a.hcpe", empty])
+    assert len(output) == len(stats) == len(dedup_reference(hcpes))
@@ -0,0 +1,23 @@
+import numpy as np
+from cshogi import BLACK, WHITE
+from app.domain.features import MOVE16_NUM, MOVE_LABEL_TABLE, make_move_label, make_move_labels
+
+
+def test_move_label_table_matches_make_move_label() -> None:
+    for color in (BLACK, WHITE):
+        expected = np.array([make_move_label(move, color) for move in range(MOVE16_NUM)], dtype=np.int32)
+        np.testing.assert_array_equal(MOVE_LABEL_TABLE[color], expected)
+
+
+def test_make_move_labels_accepts_signed_move16() -> None:
+    # hcpeのbestMove16はint16で、上位ビットが立った指し手は負の値になる
+    moves = np.arange(MOVE16_NUM, dtype=np.uint16)
+    expected = MOVE_LABEL_TABLE[WHITE, moves]
+    np.testing.assert_array_equal(make_move_labels(moves.view(np.int16), WHITE), expected)
+    np.testing.assert_array_equal(make_move_labels(moves.astype(np.int32), WHITE), expected)
+
+
+def test_make_move_labels_ignores_upper_bits_of_move32() -> None:
+    moves = np.arange(MOVE16_NUM, dtype=np.int32)
+    colors = moves % 2
+    np.testing.assert_array_equal(make_move_labels(moves | (5 << 16), colors), MOVE_LABEL_TABLE[colors, moves])
@@ -0,0 +1,48 @@
+import copy
+import pytest
+import torch
+from torch import nn
+from app.domain.features import FEATURES_NUM
+from app.domain.policy_value_network import PolicyValueNetwork
+
+
+# バッチ正規化の統計量と係数を乱数にした小さいモデル(初期値のままでは畳み込んでも出力が変わらない)
+def make_random_model(activation_function_mode: int) -> PolicyValueNetwork:
+    torch.manual_seed(activation_function_mode)
+    model = PolicyValueNetwork(
+        input_features=FEATURES_NUM, activation_function_mode=activation_function_mode, blocks=2, channels=16, fcl=32
+    )
+    for module in model.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2.0)
+            nn.init.uniform_(module.weight, 0.5, 1.5)
+            nn.init.uniform_(module.bias, -0.5, 0.5)
+    return model.eval()
+
+
+@pytest.mark.parametrize("activation_function_mode", [0, 1])
+def test_fuse_batch_norm_preserves_outputs(activation_function_mode: int) -> None:
+    model = make_random_model(activation_function_mode)
+    fused_model = copy.deepcopy(model)
+    fused_model.fuse_batch_norm()
+
+    # 畳み込んだパラメータはfused_batch_norm=Trueで作成したモデルにそのまま読み込める
+    exported_model = PolicyValueNetwork(
+        input_features=FEATURES_NUM,
+        activation_function_mode=activation_function_mode,
+        blocks=2,
+        channels=16,
+        fcl=32,
+        fused_batch_norm=True,
+    )
+    exported_model.load_state_dict(fused_model.state_dict())
+    exported_model.eval()
+
+    x = torch.randint(0, 2, (8, FEATURES_NUM, 9, 9), dtype=torch.float32)
+    with torch.no_grad():
+        policy, value = model(x)
+        for other in (fused_model, exported_model):
+            fused_policy, fused_value = other(x)
+            torch.testing.assert_close(fused_policy, policy, rtol=1e-4, atol=1e-4)
+            torch.testing.assert_close(fused_value, value, rtol=1e-4, atol=1e-4)
@@ -2,131 +2,214 @@ from cshogi import HuffmanCodedPosAndEval, Board, BLACK, move16, move_to_usi
 from cshogi import CSA
 import numpy as np
 import os
-import glob
+import time
+import hashlib
 import argparse
-from sklearn.model_selection import train_test_split
-
-parser = argparse.ArgumentParser(
-    description="Convert CSA format game records to a hcpe file", formatter_class=argparse.ArgumentDefaultsHelpFormatter
-)
-parser.add_argument("csa_dir", help="the directory where csa files are stored")
-parser.add_argument("hcpe_train")
-parser.add_argument("hcpe_test")
-parser.add_argument("--out_draw", action="store_true", help="output draw game records")
-parser.add_argument("--out_maxmove", action="store_true", help="output maxmove game records")
-parser.add_argument("--out_noeval", action="store_true", help="output positions without eval")
-parser.add_argument("--out_mate", action="store_true", help="output mated positions")
-parser.add_argument("--out_brinkmate", action="store_true")
-parser.add_argument("--uniq", action="store_true")
-parser.add_argument("--eval", type=int, help="eval threshold")
-parser.add_argument("--filter_moves", type=int, default=50, help="filter game records with moves less than this value")
-parser.add_argument(
-    "--filter_rating", type=int, default=3500, help="filter game records with both ratings below this value"
-)
-parser.add_argument("--test_ratio", type=float, default=0.1)
-args = parser.parse_args()
-
-csa_dir = args.csa_dir
-if not os.path.isdir(csa_dir):
-    print(f"Error: The directory '{csa_dir}' does not exist.")
-    exit(1)
-else:
-    print(f"The directory '{csa_dir}' exists and will be used.")
-
-# csa_file_list の取得
-print(f"Searching for .csa files in {csa_dir}")
-csa_file_list = glob.glob(os.path.join(csa_dir, "**", "*.csa"), recursive=True)
-print(f"Found {len(csa_file_list)} .csa files.")
-
-filter_moves = args.filter_moves
-filter_rating = args.filter_rating
-endgames = ["%TORYO", "%KACHI"]
-if args.out_draw:
-    endgames.append("%SENNICHITE")
-if args.out_maxmove:
-    endgames.append("%JISHOGI")
-
-csa_file_list = glob.glob(os.path.join(args.csa_dir, "**", "*.csa"), recursive=True)
-
-file_list_train, file_list_test = train_test_split(csa_file_list, test_size=args.test_ratio)
-
-hcpes = np.zeros(1024, HuffmanCodedPosAndEval)
-
-f_train = open(args.hcpe_train, "wb")
-f_test = open(args.hcpe_test, "wb")
-
-board = Board()
-for file_list, f in zip([file_list_train, file_list_test], [f_train, f_test]):
-    kif_num = 0
-    position_num = 0
-    duplicates = set()
-    for filepath in file_list:
-        for kif in CSA.Parser.parse_file(filepath):
-            if kif.endgame not in endgames or len(kif.moves) < filter_moves:
-                continue
-            if filter_rating > 0 and min(kif.ratings) < filter_rating:
-                continue
-            # 評価値がない棋譜を除外
-            if all(comment == "" for comment in kif.comments[0::2]) or all(
-                comment == "" for comment in kif.comments[1::2]
-            ):
-                continue
-            # 重複削除
-            if args.uniq:
-                dup_key = "".join([move_to_usi(move) for move in kif.moves])
-                if dup_key in duplicates:
-                    print(f"duplicate {filepath}")
-                    continue
-                duplicates.add(dup_key)
-
-            try:
-                if args.out_brinkmate:
-                    brinkmate_i = -1
-                    if kif.endgame == "%TORYO":
-                        board.set_sfen(kif.sfen)
-                        for move in kif.moves:
-                            assert board.is_legal(move)
-                            board.push(move)
-                        while board.is_check():
-                            board.pop()
-                            board.pop()
-                        brinkmate_i = board.move_number
+from game_records import GameRecord, decode_record, find_records, make_tasks, read_records, run_tasks, split_records
+
+# 棋譜ごとの変換結果(重複判定のキー, ファイル名, シャード内の先頭の位置, 局面数)
+GameEntry = tuple[bytes, str, int, int]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Convert CSA format game records to a hcpe file",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("csa_dir", help="the directory or zip/tar.gz archive where csa files are stored")
+    parser.add_argument("hcpe_train")
+    parser.add_argument("hcpe_test")
+    parser.add_argument("--out_draw", action="store_true", help="output draw game records")
+    parser.add_argument("--out_maxmove", action="store_true", help="output maxmove game records")
+    parser.add_argument("--out_noeval", action="store_true", help="output positions without eval")
+    parser.add_argument("--out_mate", action="store_true", help="output mated positions")
+    parser.add_argument("--out_brinkmate", action="store_true")
+    parser.add_argument("--uniq", action="store_true")
+    parser.add_argument("--eval", type=int, help="eval threshold")
+    parser.add_argument(
+        "--filter_moves", type=int, default=50, help="filter game records with moves less than this value"
+    )
+    parser.add_argument(
+        "--filter_rating", type=int, default=3500, help="filter game records with both ratings below this value"
+    )
+    parser.add_argument("--test_ratio", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, help="random seed for the train/test split of the files")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--files_per_task", type=int, default=100, help="number of csa files converted per shard")
+    parser.add_argument("--keep_shards", action="store_true", help="leave the per-task shards instead of merging them")
+    return parser.parse_args()
 
+
+# 出力する棋譜の終局の種類
+def make_endgames(args: argparse.Namespace) -> list[str]:
+    endgames = ["%TORYO", "%KACHI"]
+    if args.out_draw:
+        endgames.append("%SENNICHITE")
+    if args.out_maxmove:
+        endgames.append("%JISHOGI")
+    return endgames
+
+
+# シャードのファイル名
+def shard_path(path: str, index: int) -> str:
+    root, ext = os.path.splitext(path)
+    return f"{root}-{index:05}{ext}"
+
+
+# 棋譜1局分の局面をhcpeに変換する(変換しない棋譜の場合は0局面)
+def convert_kif(kif, filepath: str, args: argparse.Namespace, endgames: list[str], board: Board) -> np.ndarray:
+    hcpes = np.zeros(len(kif.moves), HuffmanCodedPosAndEval)
+    if kif.endgame not in endgames or len(kif.moves) < args.filter_moves:
+        return hcpes[:0]
+    if args.filter_rating > 0 and min(kif.ratings) < args.filter_rating:
+        return hcpes[:0]
+    # 評価値がない棋譜を除外
+    if all(comment == "" for comment in kif.comments[0::2]) or all(comment == "" for comment in kif.comments[1::2]):
+        return hcpes[:0]
+
+    try:
+        if args.out_brinkmate:
+            brinkmate_i = -1
+            if kif.endgame == "%TORYO":
                 board.set_sfen(kif.sfen)
-                p = 0
-                for i, (move, score, comment) in enumerate(zip(kif.moves, kif.scores, kif.comments)):
+                for move in kif.moves:
                     assert board.is_legal(move)
-                    if not args.out_noeval and comment == "":
-                        board.push(move)
-                        continue
-                    hcpe = hcpes[p]
-                    board.to_hcp(hcpe["hcp"])
-                    assert abs(score) <= 1000000
-                    eval = min(32767, max(score, -32767))
-                    if args.eval and abs(eval) > args.eval:
-                        break
-                    hcpe["eval"] = eval if board.turn == BLACK else -eval
-                    hcpe["bestMove16"] = move16(move)
-                    hcpe["gameResult"] = kif.win
-                    p += 1
-                    if args.out_brinkmate:
-                        if i == brinkmate_i:
-                            break
-                    elif not args.out_mate and abs(score) >= 100000:
-                        break
                     board.push(move)
-            except Exception as e:
-                print(f"skip {filepath}:{i}:{move_to_usi(move)}:{score}")
-                print(e)
-                continue
+                while board.is_check():
+                    board.pop()
+                    board.pop()
+                brinkmate_i = board.move_number
 
-            if p == 0:
+        board.set_sfen(kif.sfen)
+        p = 0
+        for i, (move, score, comment) in enumerate(zip(kif.moves, kif.scores, kif.comments)):
+            assert board.is_legal(move)
+            if not args.out_noeval and comment == "":
+                board.push(move)
                 continue
+            hcpe = hcpes[p]
+            board.to_hcp(hcpe["hcp"])
+            assert abs(score) <= 1000000
+            eval = min(32767, max(score, -32767))
+            if args.eval and abs(eval) > args.eval:
+                break
+            hcpe["eval"] = eval if board.turn == BLACK else -eval
+            hcpe["bestMove16"] = move16(move)
+            hcpe["gameResult"] = kif.win
+            p += 1
+            if args.out_brinkmate:
+                if i == brinkmate_i:
+                    break
+            elif not args.out_mate and abs(score) >= 100000:
+                break
+            board.push(move)
+    except Exception as e:
+        print(f"skip {filepath}:{i}:{move_to_usi(move)}:{score}")
+        print(e)
+        return hcpes[:0]
 
-            hcpes[:p].tofile(f)
+    return hcpes[:p]
 
-            kif_num += 1
-            position_num += p
+
+# 棋譜のリストを変換して1つのシャードに書き込む(ワーカープロセスで実行する)
+def convert_files(
+    task: tuple[int, list[GameRecord], str, argparse.Namespace],
+) -> tuple[int, str, int, list[GameEntry]]:
+    split, records, path, args = task
+    endgames = make_endgames(args)
+    board = Board()
+    games: list[GameEntry] = []
+    position_num = 0
+    with open(path, "wb") as f:
+        for filepath, data in records:
+            for kif in CSA.Parser.parse_str(decode_record(data)):
+                hcpes = convert_kif(kif, filepath, args, endgames, board)
+                if len(hcpes) == 0:
+                    continue
+                hcpes.tofile(f)
+                # 重複判定のキー(指し手の文字列のハッシュ値)
+                dup_key = hashlib.blake2b("".join([move_to_usi(move) for move in kif.moves]).encode(), digest_size=16)
+                games.append((dup_key.digest(), filepath, position_num, len(hcpes)))
+                position_num += len(hcpes)
+    return split, path, len(records), games
+
+
+# シャードを順番に連結する(重複削除する場合は、先に出現した棋譜を残す)
+def merge_shards(shards: list[tuple[str, list[GameEntry]]], output: str, args: argparse.Namespace) -> None:
+    kif_num = 0
+    position_num = 0
+    duplicates = set()
+    f = open(output, "wb") if not args.keep_shards else None
+    try:
+        for path, games in shards:
+            hcpes = np.fromfile(path, dtype=HuffmanCodedPosAndEval)
+            keep = []
+            for dup_key, filepath, start, size in games:
+                # 重複削除
+                if args.uniq:
+                    if dup_key in duplicates:
+                        print(f"duplicate {filepath}")
+                        continue
+                    duplicates.add(dup_key)
+                keep.append(hcpes[start : start + size])
+            kept = np.concatenate(keep) if keep else hcpes[:0]
+            if f is None:
+                if len(kept) < len(hcpes):
+                    kept.tofile(path)
+            else:
+                kept.tofile(f)
+                os.remove(path)
+            kif_num += len(keep)
+            position_num += len(kept)
+    finally:
+        if f is not None:
+            f.close()
 
     print("kif_num", kif_num)
     print("position_num", position_num)
+
+
+def main() -> None:
+    args = parse_args()
+
+    csa_dir = args.csa_dir
+    if not os.path.exists(csa_dir):
+        print(f"Error: The directory '{csa_dir}' does not exist.")
+        exit(1)
+    else:
+        print(f"The directory '{csa_dir}' exists and will be used.")
+
+    # csa_file_list の取得(分割をシードで再現できるように読み込む順に並べる)
+    print(f"Searching for .csa files in {csa_dir}")
+    csa_file_list = find_records(csa_dir, (".csa",))
+    print(f"Found {len(csa_file_list)} .csa files.")
+
+    splits = split_records(csa_file_list, args.test_ratio, args.seed)
+    outputs = [args.hcpe_train, args.hcpe_test]
+
+    # files_per_taskファイルごとに1つのシャードに変換する
+    def tasks():
+        records = read_records(csa_dir, csa_file_list)
+        for i, (split, task_records) in enumerate(make_tasks(records, splits, args.files_per_task)):
+            yield split, task_records, shard_path(outputs[split], i), args
+
+    begin_time = time.time()
+    files_done = 0
+    games_done = 0
+    results: list[list[tuple[str, list[GameEntry]]]] = [[], []]
+    for split, path, file_num, games in run_tasks(convert_files, tasks(), args.workers):
+        results[split].append((path, games))
+        files_done += file_num
+        games_done += len(games)
+        elapsed_time = time.time() - begin_time
+        print(
+            f"{files_done}/{len(csa_file_list)} files, {games_done} games, "
+            f"{games_done / elapsed_time if elapsed_time > 0 else 0:.0f} games/sec"
+        )
+
+    for shards, output in zip(results, outputs):
+        merge_shards(shards, output, args)
+
+
+if __name__ == "__main__":
+    main()
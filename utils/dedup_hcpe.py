@@ -0,0 +1,241 @@
+import argparse
+import math
+import os
+import tempfile
+import time
+import numpy as np
+from typing import BinaryIO, Iterator
+from cshogi import HuffmanCodedPosAndEval, BLACK_WIN, WHITE_WIN, DRAW
+
+parser = argparse.ArgumentParser(
+    description="Deduplicate positions across hcpe files, aggregating moves and results of duplicates",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+)
+parser.add_argument("hcpe", nargs="+", help="input hcpe files")
+parser.add_argument("output", help="output hcpe file (one record per unique position)")
+parser.add_argument(
+    "--stats", help="output .npy of aggregated statistics (occurrences, averaged result, move counts) per record"
+)
+parser.add_argument("--top_moves", type=int, default=8, help="number of most frequent moves kept in --stats")
+parser.add_argument("--memory", type=int, default=1024, help="memory budget for sorting a partition (MB)")
+parser.add_argument("--chunk", type=int, default=1 << 20, help="number of records read at once")
+parser.add_argument(
+    "--max_partitions", type=int, default=256, help="maximum number of partition files open at once (per pass)"
+)
+parser.add_argument("--tmpdir", help="directory for the partition files")
+args = parser.parse_args()
+
+# パーティションに書き出す集計途中の行(局面と指し手の組ごとの出現回数、評価値の合計、先手から見た勝率の合計)
+ROW_DTYPE = np.dtype(
+    [
+        ("hcp", np.uint8, (32,)),
+        ("move", np.int16),
+        ("count", np.int64),
+        ("evalSum", np.int64),
+        ("resultSum", np.float64),
+    ]
+)
+# ソート中に1行あたりに必要なメモリ量の目安(行、ソートのキーとインデックス、ソート後の行)
+SORT_BYTES_PER_ROW = ROW_DTYPE.itemsize * 3
+# パーティションを分割し直す最大の深さ(超えた場合はメモリの上限を超えても1度に集計する)
+MAX_PARTITION_DEPTH = 8
+
+
+# 集計結果の要素の型(出力するhcpeの各局面に対応する)
+def stats_dtype(top_moves: int) -> np.dtype:
+    return np.dtype(
+        [
+            ("count", np.uint32),  # 出現回数
+            ("result", np.float32),  # 先手から見た平均の勝率(勝ち: 1, 負け: 0, 引き分け: 0.5)
+            ("moves", np.uint16, (top_moves,)),  # 指された回数の多い順の指し手(move16)
+            ("moveCounts", np.uint32, (top_moves,)),  # 指し手ごとの指された回数
+        ]
+    )
+
+
+# 局面(hcp)のハッシュ値(分割し直すときはsaltを変えて別のハッシュ値にする)
+def hcp_hash(hcp: np.ndarray, salt: int = 0) -> np.ndarray:
+    words = np.ascontiguousarray(hcp).view(np.uint64)
+    h = np.full(len(hcp), salt, dtype=np.uint64)
+    for i in range(words.shape[1]):
+        h ^= words[:, i]
+        h *= np.uint64(0x9E3779B97F4A7C15)
+        h ^= h >> np.uint64(29)
+    return h
+
+
+# hcpeの局面を集計途中の行にする
+def records_to_rows(hcpes: np.ndarray) -> np.ndarray:
+    rows = np.empty(len(hcpes), dtype=ROW_DTYPE)
+    rows["hcp"] = hcpes["hcp"]
+    rows["move"] = hcpes["bestMove16"]
+    rows["count"] = 1
+    rows["evalSum"] = hcpes["eval"]
+    rows["resultSum"] = np.select([hcpes["gameResult"] == BLACK_WIN, hcpes["gameResult"] == WHITE_WIN], [1.0, 0.0], 0.5)
+    return rows
+
+
+# 局面と指し手の組が同じ行をまとめる(戻り値は局面、指し手の順に並べた行と、各行が局面の先頭か)
+def aggregate_rows(rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    keys = np.ascontiguousarray(rows["hcp"]).view(">u8")
+    moves = rows["move"]
+    order = np.lexsort((moves, keys[:, 3], keys[:, 2], keys[:, 1], keys[:, 0]))
+    rows = rows[order]
+    keys = keys[order]
+    moves = moves[order]
+
+    # 局面の先頭と、(局面, 指し手)の組の先頭
+    new_position = np.empty(len(rows), dtype=bool)
+    new_position[0] = True
+    np.any(keys[1:] != keys[:-1], axis=1, out=new_position[1:])
+    new_move = new_position.copy()
+    new_move[1:] |= moves[1:] != moves[:-1]
+    move_starts = np.flatnonzero(new_move)
+
+    aggregated = rows[move_starts]
+    for name in ("count", "evalSum", "resultSum"):
+        aggregated[name] = np.add.reduceat(rows[name], move_starts)
+    return aggregated, new_position[move_starts]
+
+
+# 集計した行を局面のハッシュ値で分割し、パーティションごとの一時ファイルに追記する
+def spill_rows(rows: np.ndarray, partition_files: list, salt: int) -> None:
+    partitions = hcp_hash(rows["hcp"], salt) % np.uint64(len(partition_files))
+    order = np.argsort(partitions, kind="stable")
+    bounds = np.searchsorted(partitions[order], np.arange(len(partition_files) + 1))
+    for k, f in enumerate(partition_files):
+        if bounds[k] < bounds[k + 1]:
+            rows[order[bounds[k] : bounds[k + 1]]].tofile(f)
+
+
+# 行数とメモリの上限からパーティション数を決める(同時に開くファイル数は上限までにし、足りない分は分割し直す)
+def partition_count(rows: int) -> int:
+    return min(args.max_partitions, max(1, math.ceil(rows * SORT_BYTES_PER_ROW / (args.memory * 1024 * 1024))))
+
+
+# 行のチャンクを集計してからパーティションに分割する(同じ局面はチャンク内で1行にまとまる)
+def partition_chunks(chunks: Iterator[np.ndarray], paths: list[str], salt: int) -> None:
+    partition_files = [open(path, "wb") for path in paths]
+    try:
+        for rows in chunks:
+            if len(rows) > 0:
+                spill_rows(aggregate_rows(rows)[0], partition_files, salt)
+    finally:
+        for f in partition_files:
+            f.close()
+
+
+# 入力ファイルをチャンクごとに読み込んで集計途中の行にする
+def read_input_chunks(files: list[str], counter: list[int]) -> Iterator[np.ndarray]:
+    for path in files:
+        # 空のファイルはmemmapできないため読み飛ばす(棋譜の変換で局面のないファイルが出力されることがある)
+        if os.path.getsize(path) == 0:
+            continue
+        hcpes = np.memmap(path, dtype=HuffmanCodedPosAndEval, mode="r")
+        for i in range(0, len(hcpes), args.chunk):
+            chunk = np.array(hcpes[i : i + args.chunk])
+            counter[0] += len(chunk)
+            yield records_to_rows(chunk)
+        del hcpes
+
+
+# パーティションのファイルをメモリの上限に収まるチャンクごとに読み込む
+def read_partition_chunks(path: str) -> Iterator[np.ndarray]:
+    rows = np.memmap(path, dtype=ROW_DTYPE, mode="r")
+    chunk_rows = max(1, args.memory * 1024 * 1024 // SORT_BYTES_PER_ROW)
+    for i in range(0, len(rows), chunk_rows):
+        yield np.array(rows[i : i + chunk_rows])
+    del rows
+
+
+# 局面ごとに集計した行から出力する局面と集計結果を作成する
+def summarize_positions(rows: np.ndarray, new_position: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    position_starts = np.flatnonzero(new_position)
+    move_counts = rows["count"]
+    counts = np.add.reduceat(move_counts, position_starts)
+
+    # 評価値と先手から見た勝率を平均する
+    mean_results = (np.add.reduceat(rows["resultSum"], position_starts) / counts).astype(np.float32)
+    mean_evals = np.add.reduceat(rows["evalSum"], position_starts) / counts
+
+    # 局面ごとに指された回数の多い順に指し手を並べる
+    move_positions = np.cumsum(new_position) - 1
+    move_order = np.lexsort((-move_counts, move_positions))
+    ranks = np.arange(len(rows)) - np.searchsorted(move_positions[move_order], move_positions[move_order])
+
+    output = np.zeros(len(position_starts), dtype=HuffmanCodedPosAndEval)
+    output["hcp"] = rows["hcp"][position_starts]
+    best = move_order[ranks == 0]
+    output["bestMove16"] = rows["move"][best]
+    output["eval"] = np.rint(mean_evals).astype(np.int16)
+    output["gameResult"] = np.select([mean_results > 0.5, mean_results < 0.5], [BLACK_WIN, WHITE_WIN], DRAW)
+
+    stats = np.zeros(len(position_starts), dtype=stats_dtype(args.top_moves))
+    stats["count"] = counts
+    stats["result"] = mean_results
+    top = ranks < args.top_moves
+    stats["moves"][move_positions[move_order[top]], ranks[top]] = rows["move"][move_order[top]]
+    stats["moveCounts"][move_positions[move_order[top]], ranks[top]] = move_counts[move_order[top]]
+    return output, stats
+
+
+# パーティションを集計して出力する(メモリの上限を超える場合は、別のハッシュ値で分割し直してから集計する)
+def process_partition(path: str, depth: int, f_output: BinaryIO, f_stats: BinaryIO) -> int:
+    rows_num = os.path.getsize(path) // ROW_DTYPE.itemsize
+    if rows_num == 0:
+        os.remove(path)
+        return 0
+    partition_num = partition_count(rows_num)
+    if partition_num > 1 and depth < MAX_PARTITION_DEPTH:
+        paths = [f"{path}.{k:03}" for k in range(partition_num)]
+        partition_chunks(read_partition_chunks(path), paths, salt=depth + 1)
+        os.remove(path)
+        return sum(process_partition(sub_path, depth + 1, f_output, f_stats) for sub_path in paths)
+
+    rows = np.fromfile(path, dtype=ROW_DTYPE)
+    os.remove(path)
+    output, stats = summarize_positions(*aggregate_rows(rows))
+    output.tofile(f_output)
+    if args.stats:
+        stats.tofile(f_stats)
+    return len(output)
+
+
+begin_time = time.time()
+
+# 全局面のサイズとメモリの上限からパーティション数を決める
+total_size = sum(os.path.getsize(path) for path in args.hcpe) // HuffmanCodedPosAndEval.itemsize
+partition_num = partition_count(total_size)
+print(f"records: {total_size}, partitions: {partition_num}")
+
+with tempfile.TemporaryDirectory(dir=args.tmpdir) as tmpdir:
+    partition_paths = [os.path.join(tmpdir, f"{k:03}") for k in range(partition_num)]
+    counter = [0]
+    partition_chunks(read_input_chunks(args.hcpe, counter), partition_paths, salt=0)
+    input_num = counter[0]
+    print(f"partitioned in {time.time() - begin_time:.1f}s")
+
+    output_num = 0
+    # 集計結果は出力する局面数が最後に分かるため、一時ファイルに書いてから.npyにする
+    stats_path = os.path.join(tmpdir, "stats")
+    with open(args.output, "wb") as f_output, open(stats_path, "wb") as f_stats:
+        for path in partition_paths:
+            output_num += process_partition(path, 0, f_output, f_stats)
+
+    if args.stats and output_num == 0:
+        np.save(args.stats, np.zeros(0, dtype=stats_dtype(args.top_moves)))
+    elif args.stats:
+        stats = np.memmap(stats_path, dtype=stats_dtype(args.top_moves), mode="r")
+        stats_output = np.lib.format.open_memmap(args.stats, mode="w+", dtype=stats.dtype, shape=(output_num,))
+        for i in range(0, output_num, args.chunk):
+            stats_output[i : i + args.chunk] = stats[i : i + args.chunk]
+        stats_output.flush()
+        del stats, stats_output
+
+elapsed_time = time.time() - begin_time
+print(f"input records: {input_num}")
+print(f"unique positions: {output_num}")
+print(
+    f"dedup ratio: {1 - output_num / input_num if input_num > 0 else 0:.4f} (kept {output_num / max(1, input_num):.4f})"
+)
+print(f"time: {elapsed_time:.1f}s, {input_num / elapsed_time if elapsed_time > 0 else 0:.0f} records/sec")
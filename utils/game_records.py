@@ -0,0 +1,105 @@
+import os
+import glob
+import tarfile
+import zipfile
+from collections import deque
+from multiprocessing.pool import Pool
+from typing import Any, Callable, Iterable, Iterator, Optional
+from sklearn.model_selection import train_test_split
+
+# 棋譜を読み込めるアーカイブの拡張子(標準ライブラリで読めるもの)
+ZIP_EXTENSIONS = (".zip",)
+TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
+# 棋譜の名前(ファイル名、アーカイブ内の棋譜は"アーカイブ名:アーカイブ内のファイル名")と内容
+GameRecord = tuple[str, bytes]
+
+
+def is_archive(path: str) -> bool:
+    return path.lower().endswith(ZIP_EXTENSIONS + TAR_EXTENSIONS)
+
+
+# ディレクトリ、またはアーカイブ内の指定した拡張子の棋譜のファイル名を探す(読み込む順番に並べる)
+def find_records(path: str, extensions: tuple[str, ...]) -> list[str]:
+    if os.path.isdir(path):
+        files = set()
+        for extension in extensions:
+            files.update(glob.glob(os.path.join(path, "**", "*" + extension), recursive=True))
+        return sorted(files)
+    if path.lower().endswith(ZIP_EXTENSIONS):
+        with zipfile.ZipFile(path) as archive:
+            return [f"{path}:{name}" for name in archive.namelist() if name.lower().endswith(extensions)]
+    if path.lower().endswith(TAR_EXTENSIONS):
+        # 圧縮されたtarは先頭から順にしか読めないため、アーカイブ内の順番のままにする
+        with tarfile.open(path) as archive:
+            return [
+                f"{path}:{member.name}"
+                for member in archive
+                if member.isfile() and member.name.lower().endswith(extensions)
+            ]
+    raise ValueError(f"{path} is neither a directory nor a zip/tar archive")
+
+
+# 棋譜を名前のリストの順番に読み込む(アーカイブは1度だけ開いて先頭から順に読む)
+def read_records(path: str, names: list[str]) -> Iterator[GameRecord]:
+    if os.path.isdir(path):
+        for name in names:
+            with open(name, "rb") as f:
+                yield name, f.read()
+    elif path.lower().endswith(ZIP_EXTENSIONS):
+        with zipfile.ZipFile(path) as archive:
+            for name in names:
+                yield name, archive.read(name[len(path) + 1 :])
+    else:
+        wanted = set(names)
+        with tarfile.open(path) as archive:
+            for member in archive:
+                name = f"{path}:{member.name}"
+                if name in wanted:
+                    yield name, archive.extractfile(member).read()
+
+
+# 棋譜の内容を文字列にする(UTF-8で読めない場合はShift_JISとみなす)
+def decode_record(data: bytes) -> str:
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return data.decode("cp932")
+
+
+# 棋譜を学習データとテストデータに分ける(シードが同じなら毎回同じに分かれる)
+def split_records(names: list[str], test_ratio: float, seed: Optional[int]) -> dict[str, int]:
+    _, names_test = train_test_split(names, test_size=test_ratio, random_state=seed)
+    test = set(names_test)
+    return {name: 1 if name in test else 0 for name in names}
+
+
+# 読み込んだ棋譜を、学習データとテストデータそれぞれでrecords_per_task局ずつのタスクにまとめる
+def make_tasks(
+    records: Iterable[GameRecord], splits: dict[str, int], records_per_task: int
+) -> Iterator[tuple[int, list[GameRecord]]]:
+    buffers: list[list[GameRecord]] = [[], []]
+    for name, data in records:
+        split = splits[name]
+        buffers[split].append((name, data))
+        if len(buffers[split]) == records_per_task:
+            yield split, buffers[split]
+            buffers[split] = []
+    for split, buffer in enumerate(buffers):
+        if buffer:
+            yield split, buffer
+
+
+# タスクをプロセスプールで実行し、投入した順番に結果を返す(同時に投入するタスク数を制限してメモリを抑える)
+def run_tasks(func: Callable[[Any], Any], tasks: Iterable[Any], workers: int) -> Iterator[Any]:
+    if workers <= 1:
+        yield from map(func, tasks)
+        return
+    with Pool(workers) as pool:
+        in_flight: deque = deque()
+        for task in tasks:
+            in_flight.append(pool.apply_async(func, (task,)))
+            if len(in_flight) >= workers * 2:
+                yield in_flight.popleft().get()
+        while in_flight:
+            yield in_flight.popleft().get()
@@ -1,108 +1,135 @@
 import os
-import glob
+import time
 import argparse
 import numpy as np
-from sklearn.model_selection import train_test_split
-from cshogi import HuffmanCodedPosAndEval, Board, move16
-import shogi
-import shogi.KIF
-
-parser = argparse.ArgumentParser(
-    description="Convert KIF format game records to a hcpe file",
-    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-)
-parser.add_argument("kif_dir", help="the directory where kif files are stored")
-parser.add_argument("save_path")
-parser.add_argument("--test_ratio", type=float, default=0.1)
-parser.add_argument("--filter_moves", type=int, default=100, help="filter game records with moves less than this value")
-args = parser.parse_args()
-
-kif_dir = args.kif_dir
-if not os.path.isdir(kif_dir):
-    print(f"Error: The directory '{kif_dir}' does not exist.")
-    exit(1)
-
-# KIFファイルの取得
-print(f"Searching for .kif files in {kif_dir}")
-kif_file_list = glob.glob(os.path.join(kif_dir, "**", "*.kif"), recursive=True)
-print(f"Found {len(kif_file_list)} .kif files.")
-
-# 学習データとテストデータに分割
-file_list_train, file_list_test = train_test_split(kif_file_list, test_size=args.test_ratio)
-
-# HCPEデータバッファ
-hcpes_begin = np.zeros(1024, HuffmanCodedPosAndEval)
-hcpes_middle = np.zeros(1024, HuffmanCodedPosAndEval)
-hcpes_end = np.zeros(1024, HuffmanCodedPosAndEval)
-
-# 出力ファイル
-f_train_begin = open(args.save_path + "_train_begin.hcpe", "wb")
-f_test_begin = open(args.save_path + "_test_begin.hcpe", "wb")
-f_train_middle = open(args.save_path + "_train_middle.hcpe", "wb")
-f_test_middle = open(args.save_path + "_test_middle.hcpe", "wb")
-f_train_end = open(args.save_path + "_train_end.hcpe", "wb")
-f_test_end = open(args.save_path + "_test_end.hcpe", "wb")
-
-board = Board()
-for file_list, fb, fm, fe in zip(
-    [file_list_train, file_list_test],
-    [f_train_begin, f_test_begin],
-    [f_train_middle, f_test_middle],
-    [f_train_end, f_test_end],
-):
+from cshogi import HuffmanCodedPosAndEval, Board, DRAW, move16
+from cshogi import KIF
+from game_records import GameRecord, decode_record, find_records, make_tasks, read_records, run_tasks, split_records
+
+# 序盤、中盤、終盤の出力ファイルの接尾辞
+PHASES = ["begin", "middle", "end"]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Convert KIF format game records to a hcpe file",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("kif_dir", help="the directory or zip/tar.gz archive where kif files are stored")
+    parser.add_argument("save_path")
+    parser.add_argument("--test_ratio", type=float, default=0.1)
+    parser.add_argument(
+        "--filter_moves", type=int, default=100, help="filter game records with moves less than this value"
+    )
+    parser.add_argument("--seed", type=int, help="random seed for the train/test split of the files")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--files_per_task", type=int, default=100, help="number of kif files converted per shard")
+    return parser.parse_args()
+
+
+# 出力ファイル名(split: 学習データ0、テストデータ1)
+def output_path(save_path: str, split: int, phase: str, index: int = -1) -> str:
+    name = f"{save_path}_{['train', 'test'][split]}_{phase}"
+    return f"{name}-{index:05}.hcpe" if index >= 0 else f"{name}.hcpe"
+
+
+# 棋譜1局分の局面を序盤、中盤、終盤に分けてhcpeに変換する
+def convert_kif(kif, filepath: str, board: Board) -> list[np.ndarray]:
+    board.set_sfen(kif.sfen)
+    moves = kif.moves
+    b_index = min(max(int(len(moves) * 0.25), 25), 50)
+    e_index = len(moves) - min(max(int(len(moves) * 0.2), 20), 40)
+    game_result = kif.win if kif.win is not None else DRAW
+    phases = []
+    for phase_moves in [moves[:b_index], moves[b_index:e_index], moves[e_index:]]:
+        hcpes = np.zeros(len(phase_moves), HuffmanCodedPosAndEval)
+        p = 0
+        for move in phase_moves:
+            if not board.is_legal(move):
+                print(f"is not legal move {filepath}: {move}")
+                continue
+
+            hcpe = hcpes[p]
+            board.to_hcp(hcpe["hcp"])
+            hcpe["eval"] = 0  # KIFは評価値がないことが多いためデフォルト0
+            hcpe["bestMove16"] = move16(move)
+            hcpe["gameResult"] = game_result
+            p += 1
+            board.push(move)
+        phases.append(hcpes[:p])
+    return phases
+
+
+# 棋譜のリストを変換して序盤、中盤、終盤のシャードに書き込む(ワーカープロセスで実行する)
+def convert_files(task: tuple[int, list[GameRecord], str, int, int]) -> tuple[int, int, int]:
+    split, records, save_path, index, filter_moves = task
+    board = Board()
+    files = [open(output_path(save_path, split, phase, index), "wb") for phase in PHASES]
+    try:
+        for filepath, data in records:
+            try:
+                kif = KIF.Parser.parse_str(decode_record(data))
+            except Exception as e:
+                print(f"Failed to parse {filepath}: {e}")
+                continue
+
+            if len(kif.moves) < filter_moves:
+                continue
+
+            try:
+                for hcpes, f in zip(convert_kif(kif, filepath, board), files):
+                    hcpes.tofile(f)
+            except Exception as e:
+                print(f"Error processing {filepath}: {e}")
+                continue
+    finally:
+        for f in files:
+            f.close()
+    return split, index, len(records)
+
+
+def main() -> None:
+    args = parse_args()
+
+    kif_dir = args.kif_dir
+    if not os.path.exists(kif_dir):
+        print(f"Error: The directory '{kif_dir}' does not exist.")
+        exit(1)
+
+    # KIFファイルの取得
+    print(f"Searching for .kif files in {kif_dir}")
+    kif_file_list = find_records(kif_dir, (".kif", ".kifu"))
+    print(f"Found {len(kif_file_list)} .kif files.")
+
+    # 学習データとテストデータに分割
+    splits = split_records(kif_file_list, args.test_ratio, args.seed)
+
+    # files_per_taskファイルごとに1つのシャードに変換する
+    def tasks():
+        records = read_records(kif_dir, kif_file_list)
+        for i, (split, task_records) in enumerate(make_tasks(records, splits, args.files_per_task)):
+            yield split, task_records, args.save_path, i, args.filter_moves
+
+    begin_time = time.time()
     kif_num = 0
+    shards: list[list[int]] = [[], []]
+    for split, index, file_num in run_tasks(convert_files, tasks(), args.workers):
+        shards[split].append(index)
+        kif_num += file_num
+        elapsed_time = time.time() - begin_time
+        print(f"kif_num: {kif_num}, {kif_num / elapsed_time if elapsed_time > 0 else 0:.0f} games/sec")
+
+    # シャードを順番に連結する
+    for split in [0, 1]:
+        for phase in PHASES:
+            with open(output_path(args.save_path, split, phase), "wb") as f:
+                for index in shards[split]:
+                    path = output_path(args.save_path, split, phase, index)
+                    with open(path, "rb") as shard:
+                        f.write(shard.read())
+                    os.remove(path)
+        print("kif_num", sum(splits[name] == split for name in kif_file_list))
+
 
-    for filepath in file_list:
-        kif_num += 1
-        if kif_num % 10000 == 0:
-            print(f"kif_num: {kif_num}")
-        try:
-            kif_data = shogi.KIF.Parser.parse_file(filepath)[0]
-        except Exception as e:
-            print(f"Failed to parse {filepath}: {e}")
-            continue
-
-        if len(kif_data["moves"]) < args.filter_moves:
-            continue
-
-        try:
-            board.set_sfen(kif_data["sfen"])
-            moves = kif_data["moves"]
-            b_index = min(max(int(len(moves) * 0.25), 25), 50)
-            e_index = len(moves) - min(max(int(len(moves) * 0.2), 20), 40)
-            for usi_moves, hcpes, f in zip(
-                [moves[:b_index], moves[b_index:e_index], moves[e_index:]],
-                [hcpes_begin, hcpes_middle, hcpes_end],
-                [fb, fm, fe],
-            ):
-                p = 0
-                hcpes.fill(0)
-                for usi_move in usi_moves:
-                    move = board.move_from_usi(usi_move)
-                    if not board.is_legal(move):
-                        print(f"is not legal move {filepath}: {move}")
-                        continue
-
-                    hcpe = hcpes[p]
-                    board.to_hcp(hcpe["hcp"])
-                    hcpe["eval"] = 0  # KIFは評価値がないことが多いためデフォルト0
-                    hcpe["bestMove16"] = move16(move)
-                    hcpe["gameResult"] = (
-                        1 if kif_data["win"] == "b" else 0 if kif_data["win"] == "w" else 2
-                    )  # 勝敗情報は簡単化
-                    p += 1
-                    board.push(move)
-                if p > 0:
-                    hcpes[:p].tofile(f)
-        except Exception as e:
-            print(f"Error processing {filepath}: {e}")
-            continue
-
-    print("kif_num", kif_num)
-
-f_train_begin.close()
-f_test_begin.close()
-f_train_middle.close()
-f_test_middle.close()
-f_train_end.close()
-f_test_end.close()
+if __name__ == "__main__":
+    main()